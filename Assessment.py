@@ -3,14 +3,7 @@ import numpy as np
 import sys
 
 from loguru import logger
-from imblearn.over_sampling import ADASYN, RandomOverSampler, KMeansSMOTE, SMOTE, BorderlineSMOTE, SVMSMOTE, SMOTENC, RandomOverSampler
-from sklearn.linear_model import LogisticRegression
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
-from sklearn.naive_bayes import GaussianNB
-from xgboost import XGBClassifier
-from lightgbm import LGBMClassifier
+import Registry
 from Data_Generator import ImbalancedDataGenerator, Multi_Modal_Dist_Generator
 from Data_Balancer import DataBalancer, DictIterDataBalancer
 from Classifier import Classifier, DictIterClassifier
@@ -18,12 +11,14 @@ from Metrics import IterMetrics
 from Assessors import CorStudy
 from gen_parameters import mixed_3d_test_dict
 from helper_tools import extract_table_info, create_simple_normal_dict_list
+from Results_Store import ResultsStore
 
 
 
 def run_CorStudy_experiment(class_ratio_list, n_samples_list, n_features_list, balancing_methods, classifiers, exp_title):
 
-    results_df = pd.DataFrame()
+    # rows are collected and turned into one DataFrame at the end, concatenating per row is quadratic
+    results_rows = []
 
     for class_ratio in class_ratio_list:
         for n_samples in n_samples_list:
@@ -42,13 +37,13 @@ def run_CorStudy_experiment(class_ratio_list, n_samples_list, n_features_list, b
                     
                     for classifier in classifiers:
 
-                        meta_df = pd.DataFrame({
+                        meta_dict = {
                             "class_ratio": class_ratio, 
                             "n_samples": n_samples, 
                             "n_features": n_features, 
                             "balancing_method": method, 
                             "classifier": classifier
-                        }, index=[0])
+                        }
 
                         logger.info(f"""({class_ratio},{int(n_samples)}) | {n_features} | {method} | {classifier}""")
                         
@@ -64,20 +59,16 @@ def run_CorStudy_experiment(class_ratio_list, n_samples_list, n_features_list, b
                         study.run()
                         results = study.calculate_metrics()
                         
-                        results_df = pd.concat(
-                            [
-                                results_df,
-                                meta_df.join(pd.DataFrame(results, index=[0]))
-                            ]
-                        )
-                        results_df = results_df.reset_index(drop=True)
+                        results_rows.append({**meta_dict, **results})
                         
                     
 
                         #print('Done: ', class_ratio, n_samples, n_features, method, classifier)
 
+    results_df = pd.DataFrame(results_rows)
+
     print(results_df)
-    results_df.to_csv(f'Experiments/{exp_title}.csv')
+    ResultsStore('Experiments/results.db', exp_title).append(results_df, if_exists = 'replace')
                 
                         
     
@@ -91,6 +82,7 @@ def run_CorStudy_experiment(class_ratio_list, n_samples_list, n_features_list, b
 
 def run_dict_iter_experiment(generator_dict_list, balancing_methods, classifiers_dict, results_df = pd.DataFrame()):
 
+    results_dfs = [results_df]
     experiment_sizes = [len(generator_dict_list), len(balancing_methods), len(classifiers_dict)]
     
     for generator_dict in generator_dict_list:
@@ -152,13 +144,10 @@ def run_dict_iter_experiment(generator_dict_list, balancing_methods, classifiers
 
         metrics_df = pd.concat(metrics_dfs).reset_index(drop=True)
 
-        results_df = pd.concat(
-                        [
-                            results_df,
-                            meta_df.join(metrics_df)
-                        ]
-                    ).reset_index(drop=True)
-        print(results_df)
+        results_dfs.append(meta_df.join(metrics_df))
+        print(results_dfs[-1])
+    
+    results_df = pd.concat(results_dfs).reset_index(drop=True)
     
     return results_df
 
@@ -172,23 +161,23 @@ Methods and Parameters for serialised execution
 """
 balancing_methods = {
 "Unbalanced": None,
-"ADASYN": ADASYN,
-"RandomOverSampler": RandomOverSampler,
-#"KMeansSMOTE": KMeansSMOTE,
-"SMOTE": SMOTE,
-"BorderlineSMOTE": BorderlineSMOTE,
-"SVMSMOTE": SVMSMOTE,
-#"SMOTENC": SMOTENC,
+"ADASYN": Registry.balancers["ADASYN"],
+"RandomOverSampler": Registry.balancers["RandomOverSampler"],
+#"KMeansSMOTE": Registry.balancers["KMeansSMOTE"],
+"SMOTE": Registry.balancers["SMOTE"],
+"BorderlineSMOTE": Registry.balancers["BorderlineSMOTE"],
+"SVMSMOTE": Registry.balancers["SVMSMOTE"],
+#"SMOTENC": Registry.balancers["SMOTENC"],
 }
 
 classifiers = {
-    "Logistic Regression": LogisticRegression,
-    "Decision Tree": DecisionTreeClassifier,
-    "Random Forest": RandomForestClassifier,
-    #"SVC": SVC,
-    #"Naive Bayes": GaussianNB,
-    "XGboost": XGBClassifier,
-    "Lightgbm": LGBMClassifier
+    "Logistic Regression": Registry.classifiers["Logistic Regression"],
+    "Decision Tree": Registry.classifiers["Decision Tree"],
+    "Random Forest": Registry.classifiers["Random Forest"],
+    #"SVC": Registry.classifiers["SVC"],
+    #"Naive Bayes": Registry.classifiers["Naive Bayes"],
+    "XGboost": Registry.classifiers["XGboost"],
+    "Lightgbm": Registry.classifiers["Lightgbm"]
 }
 
 class_ratio_list = [0.1, 0.01, 0.001]
@@ -215,7 +204,7 @@ gen_dict_list = create_simple_normal_dict_list(n_samples_list[1:2], n_features_l
 results_df = run_dict_iter_experiment(gen_dict_list, balancing_methods, classifiers)
 
 print(results_df)
-results_df.to_csv('Experiments/test_results.csv')
+ResultsStore('Experiments/results.db', 'test_results').append(results_df, if_exists = 'replace')
 
 
 """
@@ -2,11 +2,18 @@ from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_sc
 import numpy as np
 import pandas as pd
 from itertools import product
-from helper_tools import Data, extract_table_info, calculate_no_samples
+import weakref
+from contextlib import contextmanager, nullcontext
+from helper_tools import Data, FoldView, RaggedArray, RunningMoments, SeedStreams, SharedArrayStore, extract_table_info, calculate_no_samples, stable_hash
+from helper_tools import default_fill, dtype_policy, dtype_signature
 from Data_Generator import FMLP_Generator
-from Data_Balancer import FMLP_DataBalancer
+from Data_Balancer import FMLP_DataBalancer, emits_weights
 from Classifier import FMLP_DataClassifier
 from Metrics import FMLP_Metrics
+from Caching import DatasetCache
+from Sharding import parse_shard, shard_cells
+from Executor import CellExecutor
+from Instrumentation import Instrumentation
 
 
 
@@ -55,104 +62,623 @@ class CorStudy():
 
 class Assessor(Data):
 
-    def __init__(self, test_size, generation_dict_list, balancers_dict, classifiers_dict):
+    def __init__(self, test_size, generation_dict_list, balancers_dict, classifiers_dict, n_jobs = 1, shared = None, seed = None,
+                 clsf_params_dicts = {}, manifest = None, checkpoint = None, timeout = None, max_memory = None, isolate = False,
+                 instrument = False, repetitions = 1, repetition = 0, n_folds = None, shard = None, shard_weights = {}, dtypes = {}):
 
         Data.data_dict = {}
 
+        # dtypes of features, labels, probabilities and sample weights in all data_dict tensors, e.g. helper_tools.compact_dtypes
+        Data.dtypes = dtype_policy(dtypes)
+
+        self.seed = seed
+
+        # repeat runs the grid once per repetition, every repetition draws its own datasets, resamples and fits
+        if repetitions > 1 and (manifest is not None or checkpoint is not None):
+            raise ValueError("Repetitions run as independent jobs and cannot share a run manifest or checkpoint.")
+        
+        self.repetitions = repetitions
+        self.repetition = repetition
+
+        # incremental mode: cells already stored in the RunManifest are loaded instead of refitted
+        if manifest is not None and seed is None:
+            raise ValueError("A run manifest can only be used for a fixed seed of the Assessor.")
+        
+        self.manifest = manifest
+        self.clsf_params_dicts = clsf_params_dicts
+
+        # every random draw of generation, balancing and classification derives from this one seed
+        self.data_dict['seed_streams'] = SeedStreams(seed, repetition = repetition)
+
+        # failed balance and fit/predict jobs are recorded in data_dict['failures'] and the rest of the grid continues,
+        # with a timeout or memory cap every job runs in its own process so that hanging or crashing jobs are recorded as well
+        self.instrumentation = Instrumentation() if instrument else None
+        self.executor = CellExecutor(n_jobs, timeout = timeout, max_memory = max_memory, isolate = isolate, 
+                                     instrumentation = self.instrumentation)
+        self.data_dict['failures'] = {}
+
+        # parallel workers attach to the data_dict arrays by name, hence they have to live in shared memory
+        if shared is None:
+            shared = self.executor.uses_workers
+
+        Data.storage = SharedArrayStore() if shared else None
+        self._finalizer = weakref.finalize(self, release_storage, Data.storage, Data.data_dict)
+
         self.test_size = test_size
         self.generation_dict_list = generation_dict_list
+        self.n_jobs = n_jobs
 
-        balancer_list = [(name, balancer) for name, balancer in balancers_dict.items()]
+        self.balancer_list = [(name, balancer) for name, balancer in balancers_dict.items()]
         
-        clsf_list = [(name, classifier) for name, classifier in classifiers_dict.items()]
+        self.clsf_list = [(name, classifier) for name, classifier in classifiers_dict.items()]
 
-        self.exp_dim = (len(generation_dict_list), len(balancers_dict), len(classifiers_dict))
+        # K-fold mode: every dataset takes K rows of the grid, row i*K + f is evaluated on fold f and trained on the others.
+        # test_size is not used then
+        self.n_folds = n_folds
+        n_splits = 1 if n_folds is None else n_folds
+        self.fold_labels = None if n_folds is None else list(range(n_folds)) * len(generation_dict_list)
+
+        self.exp_dim = (len(generation_dict_list) * n_splits, len(balancers_dict), len(classifiers_dict))
         
-        self.data_dict['assignment_dict'] = {(a, b, c): [gen_dict, bal, clsf]
-                                             for (a, gen_dict), (b, bal), (c, clsf)
+        self.data_dict['assignment_dict'] = {(a * n_splits + f, b, c): [gen_dict, bal, clsf]
+                                             for (a, gen_dict), f, (b, bal), (c, clsf)
                                              in product(enumerate(generation_dict_list), 
-                                                        enumerate(balancer_list), 
-                                                        enumerate(clsf_list)
+                                                        range(n_splits),
+                                                        enumerate(self.balancer_list), 
+                                                        enumerate(self.clsf_list)
                                                         )
                                             }
+        
+        # finished datasets, resamples and predictions are written to the RunCheckpoint and skipped after a restart
+        if checkpoint is not None:
+            if seed is None:
+                raise ValueError("A run can only be checkpointed for a fixed seed of the Assessor.")
+            
+            checkpoint.open(self.run_signature())
+        
+        self.checkpoint = checkpoint
+
+        # hits, misses and size of the dataset and resample caches used by generate and balance
+        self.cache_stats = {}
+
+        # sharded mode: only the cells of shard i/N of the grid are run, their outputs are combined by Sharding.merge_shards
+        if shard is not None:
+            if seed is None:
+                raise ValueError("A run can only be sharded for a fixed seed of the Assessor.")
+            
+            if repetitions > 1:
+                raise ValueError("Repetitions run the whole grid, shard the Assessors of single repetitions instead.")
+            
+            shard = parse_shard(shard) if isinstance(shard, str) else tuple(shard)
+            self.shard_cells = shard_cells(self.data_dict['assignment_dict'], shard, shard_weights)
 
+        else:
+            self.shard_cells = set(self.data_dict['assignment_dict'])
+        
+        self.shard = shard
 
-    def generate(self):     
+
+    def generate(self, chunk_size = None, cache = None):     
 
         test_size = self.test_size
         table_infos = [extract_table_info(generation_dict) for generation_dict in self.generation_dict_list]
 
-        self.d = max([info[0] for info in table_infos])
-        n = max([info[1] for info in table_infos])
-        a = self.exp_dim[0]
+        d_list = [info[0] for info in table_infos]
+        n_list = [info[1] for info in table_infos]
+        a = len(self.generation_dict_list)
+
+        # widths of the grid rows, every dataset has n_folds rows in K-fold mode
+        self.d_list = d_list if self.n_folds is None else list(np.repeat(d_list, self.n_folds))
+
+        # datasets without cells in the shard are neither generated nor allocated
+        n_splits = self.n_folds or 1
+        shard_datasets = {i // n_splits for (i, j, k) in self.shard_cells}
+        n_list = [n if i in shard_datasets else 0 for i, n in enumerate(n_list)]
+
+        print('Size X array: \n', sum(n*d for n, d in zip(n_list, d_list)))
+        
+        if self.n_folds is None:
+            # same split sizes as train_test_split with a float test_size
+            testset_sizes = [int(np.ceil(test_size*n)) for n in n_list]
+            trainset_sizes = [n - n_test for n, n_test in zip(n_list, testset_sizes)]
+
+            self.allocate_ragged('org_X_train', (a,), trainset_sizes, widths = d_list, dtype = self.dtypes['features'])
+            self.allocate_ragged('org_y_train', (a,), trainset_sizes, dtype = self.dtypes['labels'])
+
+            self.allocate_ragged('org_X_test', (a,), testset_sizes, widths = d_list, dtype = self.dtypes['features'])
+            self.allocate_ragged('org_y_test', (a,), testset_sizes, dtype = self.dtypes['labels'])
+
+            split_keys = ['org_X_train', 'org_y_train', 'org_X_test', 'org_y_test']
         
-        trainset_size = int((1-test_size)*n)
-        testset_size = int(test_size*n)
-        print('Size X array: \n', a*n*self.d)
+        else:
+            # every dataset is stored once with an int8 fold index, the splits are FoldViews on it
+            self.allocate_ragged('org_X', (a,), n_list, widths = d_list, dtype = self.dtypes['features'])
+            self.allocate_ragged('org_y', (a,), n_list, dtype = self.dtypes['labels'])
+            self.allocate_ragged('folds', (a,), n_list, dtype = np.int8)
+
+            split_keys = ['org_X', 'org_y', 'folds']
+
+        seed_streams = self.data_dict['seed_streams']
 
-        self.data_dict['org_X_train'] = np.full(shape = (a, trainset_size, self.d), fill_value = np.nan)
-        self.data_dict['org_y_train'] = np.full(shape = (a, trainset_size,), fill_value = np.nan)
+        if cache is not None and self.seed is None:
+            raise ValueError("Datasets can only be cached for a fixed seed of the Assessor.")
 
-        self.data_dict['org_X_test'] = np.full(shape = (a, testset_size, self.d), fill_value = np.nan)
-        self.data_dict['org_y_test'] = np.full(shape = (a, testset_size,), fill_value = np.nan)
+        self.dataset_keys = []
+        self.chunk_size = chunk_size
+
+        remaining = self.restore_checkpoint('generate', {(i,) for i in shard_datasets}, split_keys)
 
         for i, generation_dict in enumerate(self.generation_dict_list):
             generation_dict['gen_index'] = i
-            generator = FMLP_Generator(**generation_dict)
-            generator.prepare_data(self.test_size)
+            generator = FMLP_Generator(**{'seed': seed_streams.seed_seq('generate', i), **generation_dict})
+
+            key = DatasetCache.dataset_key(generation_dict, generator.seed_seq, self.test_size, chunk_size, self.n_folds, 
+                                           dtype_signature(self.dtypes))
+            self.dataset_keys.append(key)
+
+            if (i,) not in remaining:
+                continue
 
+            cached_split = None if cache is None else cache.get(key)
 
-    def balance(self, bal_params_dicts = {}):
+            if cached_split is not None:
+                for split_key in split_keys:
+                    self.data_dict[split_key][i] = cached_split[split_key]
 
+            else:
+                with self.measure('generate', (i,)):
+                    generator.prepare_data(self.test_size, chunk_size = chunk_size, n_folds = self.n_folds)
+
+                if cache is not None:
+                    cache.store(key, {split_key: self.data_dict[split_key][i] for split_key in split_keys})
+            
+            self.checkpoint_cell('generate', (i,), split_keys)
+
+        if cache is not None:
+            self.cache_stats['dataset'] = cache.stats()
+            print('Dataset cache: \n', self.cache_stats['dataset'])
+
+        if self.n_folds is not None:
+            self.create_fold_views()
+
+            # the grid rows of a dataset share its generation, they differ in the fold
+            self.dataset_keys = [stable_hash((key, fold)) for key in self.dataset_keys for fold in range(self.n_folds)]
+        
+        if self.checkpoint is not None:
+            self.checkpoint.mark_stage('generate')
+
+
+    def create_fold_views(self):
+        """
+        Training and test sets of the K-fold mode as FoldViews on org_X, org_y and folds.
+        """
+        folds = self.data_dict['folds']
+
+        for split, test in (('train', False), ('test', True)):
+            for key in ('org_X', 'org_y'):
+                self.data_dict[f'{key}_{split}'] = FoldView(self.data_dict[key], folds, self.n_folds, test, (key, 'folds'))
+
+
+    def balance(self, bal_params_dicts = {}, cache = None):
+        """
+        Resamples the training sets of the pending cells, resamples in the ResampleCache cache are loaded instead.
+        Returns cache_stats, the stats of the dataset cache of generate and of the resample cache, as far as they were used.
+        """
         a, b, c = self.exp_dim
         y_train = self.data_dict['org_y_train']
 
+        self.bal_params_dicts = bal_params_dicts
+
+        data_balancer = FMLP_DataBalancer(bal_params_dicts, cache = cache, executor = self.executor)
+        sources = data_balancer.sources
+
+        if self.manifest is None:
+            self.pending_cells = set(self.shard_cells)
+
+        else:
+            self.cell_keys = self.create_cell_keys()
+            self.pending_cells = {cell for cell in self.shard_cells if not self.manifest.contains(self.cell_keys[cell])}
+            print('Number of cells not in the manifest: \n', len(self.pending_cells))
+
+        # a training set is only balanced if one of its classifiers has to be fitted,
+        # cells without own resample are read from the original training set or the cell they duplicate
+        bal_cells = {sources[(i, j)] for (i, j, k) in self.pending_cells if len(sources[(i, j)]) == 2}
+
         default_strategy = 'auto'
-        max_c1 = max([np.sum(y_train[data_ind] == 1) for data_ind in range(a)])
-        max_total_samples = 0
+        capacities = np.zeros(shape = (a, b), dtype = np.int64)
+        weight_capacities = np.zeros(shape = (a, b), dtype = np.int64)
 
         for data_ind in range(a):
-            #check if a balancer parameter dict is given
-            if bal_params_dicts:
-                #iterate over the parameter dictionaries that are given
-                for bal_dict in bal_params_dicts.values():
 
-                    max_total_samples = max(max_total_samples, sum(calculate_no_samples(y_train[data_ind], bal_dict['sampling_strategy']).values()))
+            y = y_train[data_ind]
+            n_c1 = np.sum(y == 1)
 
-            #compare to default strategy if not every balancer has a dict
-            if len(bal_params_dicts) < b:
-                max_total_samples = max(max_total_samples, sum(calculate_no_samples(y_train[data_ind], default_strategy).values()))
-        
-        k = max_c1 + max_total_samples
+            for bal_ind in range(b):
+
+                name, balancer = data_balancer.balancer_dict[(data_ind, bal_ind)]
+
+                if (data_ind, bal_ind) not in bal_cells:
+                    continue
 
-        print('Number of individual balancing steps: \n', a*b,
-              'Size balance array X: \n', a*b*k*self.d)
+                # virtual oversampling keeps the original rows and stores one weight per row
+                if emits_weights(balancer):
+                    weight_capacities[data_ind, bal_ind] = len(y)
+                    continue
+
+                strategy = bal_params_dicts.get(name, {}).get('sampling_strategy', default_strategy)
+                total_samples = sum(calculate_no_samples(y, strategy).values())
+
+                # resamplers like ADASYN only hit the targeted numbers approximately, hence the slack of n_c1
+                capacities[data_ind, bal_ind] = max(len(y), total_samples) + n_c1
+        
+        widths = np.repeat(np.array(self.d_list)[:, None], b, axis = 1)
 
-        self.data_dict['bal_X_train'] = np.full(shape = (a, b, k, self.d), fill_value = np.nan)
-        self.data_dict['bal_y_train'] = np.full(shape = (a, b, k, ), fill_value = np.nan)
+        print('Number of individual balancing steps: \n', len(bal_cells),
+              'Size balance array X: \n', np.sum(capacities * widths))
 
-        data_balancer = FMLP_DataBalancer(bal_params_dicts)
+        self.allocate_ragged('bal_X_train', (a, b), capacities, widths = widths, dtype = self.dtypes['features'])
+        self.allocate_ragged('bal_y_train', (a, b), capacities, dtype = self.dtypes['labels'])
+        self.allocate_ragged('bal_weights', (a, b), weight_capacities, dtype = self.dtypes['weights'])
         
-        data_balancer.balance_data()
+        split_keys = ['bal_X_train', 'bal_y_train', 'bal_weights']
+        remaining = self.restore_checkpoint('balance', bal_cells, split_keys)
+        
+        failures = data_balancer.balance_data(cells = remaining, 
+                                              callback = lambda cell, result: self.checkpoint_cell('balance', cell, split_keys))
+        
+        for (i, j), failure in failures.items():
+            for bal_ind in [bal_ind for bal_ind in range(b) if sources[(i, bal_ind)] == (i, j)]:
+                for k in range(c):
+                    self.record_failure((i, bal_ind, k), 'balance', failure)
+        
+        if cache is not None:
+            self.cache_stats['resample'] = cache.stats()
+            print('Resample cache: \n', self.cache_stats['resample'])
+        
+        if self.checkpoint is not None:
+            self.checkpoint.mark_stage('balance')
+
+        return self.cache_stats
         
 
     def clsf_pred(self):
 
-        a, n = np.shape(self.data_dict['org_y_test'])
+        y_test = self.data_dict['org_y_test']
+        
+        data_classifier = FMLP_DataClassifier(self.clsf_params_dicts, executor = self.executor)
+
+        # fit cells are predicted first and their predictions copied to their duplicates. A shard holds the fit cells
+        # of its training groups, only an oversampler that leaves the data unchanged can share the fit cell of another shard
+        fit_cells = {data_classifier.fit_cells[cell] for cell in self.shard_cells}
+        capacities = self.allocate_predictions(self.shard_cells | fit_cells)
 
-        self.data_dict['clsf_predictions_y'] = np.full(shape = self.exp_dim + (n,), fill_value = np.nan)
-        self.data_dict['clsf_predictions_proba'] = np.full(shape = self.exp_dim + (n, 2), fill_value = np.nan)
-        self.data_dict['classes_order'] = np.full(shape = self.exp_dim + (2,), fill_value = np.nan)
+        print('Size classifier array: \n', np.sum(capacities)*3)
 
-        print('Size classifier array: \n', self.exp_dim[0]*self.exp_dim[1]*self.exp_dim[2]*n*2)
-        data_classifier = FMLP_DataClassifier()
+        if self.manifest is not None:
+            self.load_cells(self.shard_cells - self.pending_cells)
 
-        data_classifier.fit()
+        # cells whose training set could not be balanced are not fitted
+        run_cells = self.pending_cells - self.data_dict['failures'].keys()
 
-        data_classifier.predict()
+        if self.checkpoint is None:
+            data_classifier.fit(cells = run_cells)
 
+            data_classifier.predict(cells = run_cells)
+        
+        else:
+            split_keys = ['clsf_predictions_y', 'clsf_predictions_proba', 'classes_order']
+            remaining = self.restore_checkpoint('classify', run_cells, split_keys)
+
+            # fitted classifiers of restored cells are only needed to fill the manifest
+            if self.manifest is not None:
+                for cell in run_cells - remaining:
+                    name = data_classifier.classifier_dict[cell][0]
+                    data_classifier.classifier_dict[cell] = (name, self.checkpoint.load_object(self.checkpoint_key('classify', cell), 'model'))
+
+            data_classifier.fit_predict(cells = remaining, 
+                                        callback = lambda cell, clsf: self.checkpoint_cell('classify', cell, split_keys, {'model': clsf}))
+            
+            self.checkpoint.mark_stage('classify')
+
+        for cell, (stage, failure) in data_classifier.failures.items():
+            self.record_failure(cell, stage, failure)
+
+        # failed cells are filled over the whole test set, which keeps the prediction blocks of a dataset complete.
+        # Integer labels have no NaN, the metrics read failed cells from data_dict['failures']
+        for (i,j,k) in self.data_dict['failures']:
+            n = y_test.lengths[i]
+            self.data_dict['clsf_predictions_y'][i,j,k] = np.full(n, default_fill(self.dtypes['labels']))
+            self.data_dict['clsf_predictions_proba'][i,j,k] = np.full((n, 2), np.nan)
+            self.data_dict['classes_order'][i,j,k] = np.nan
+
+        if self.manifest is not None:
+            self.store_cells(self.pending_cells - self.data_dict['failures'].keys(), data_classifier.classifier_dict)
+
+
+    def allocate_predictions(self, cells):
+        """
+        Allocates the prediction arrays, every cell of cells predicts on the test set of its dataset, the other cells take no space.
+        Returns the capacities of the cells.
+        """
+        mask = np.zeros(self.exp_dim, dtype = bool)
+        mask[tuple(np.array(sorted(cells), dtype = np.int64).reshape(-1, 3).T)] = True
+
+        capacities = np.where(mask, self.data_dict['org_y_test'].lengths[:, None, None], 0)
+
+        self.allocate_ragged('clsf_predictions_y', self.exp_dim, capacities, dtype = self.dtypes['labels'])
+        self.allocate_ragged('clsf_predictions_proba', self.exp_dim, capacities, widths = np.full(self.exp_dim, 2), 
+                             dtype = self.dtypes['proba'])
+        self.allocate('classes_order', shape = self.exp_dim + (2,))
+
+        return capacities
+
+
+    def record_failure(self, cell, stage, failure):
+
+        self.data_dict['failures'][cell] = {'stage': stage, 'reason': failure.reason, 'message': failure.message}
+        print(f'Cell {cell} failed in {stage}: \n', failure.reason, failure.message)
+
+
+    def checkpoint_key(self, stage, cell):
+        """
+        Checkpoint entry of a cell, the settings passed to generate and balance are part of the key.
+        """
+        if stage == 'generate':
+            params = self.chunk_size
+        else:
+            params = self.bal_params_dicts.get(self.balancer_list[cell[1]][0], {})
+        
+        return self.checkpoint.cell_key(stage, cell, params)
+
+
+    def restore_checkpoint(self, stage, cells, split_keys):
+        """
+        Loads the checkpointed cells of a stage into the data_dict arrays of split_keys 
+        and returns the set of cells that still have to be run.
+        """
+        if self.checkpoint is None:
+            return set(cells)
+        
+        remaining = set()
+
+        for cell in cells:
+
+            key = self.checkpoint_key(stage, cell)
+
+            if not self.checkpoint.contains(key):
+                remaining.add(cell)
+                continue
+
+            stored_cell = self.checkpoint.load(key)
+            for split_key in split_keys:
+                self.data_dict[split_key][cell] = stored_cell[split_key]
+        
+        print(f'Cells of stage {stage} restored from checkpoint: \n', len(cells) - len(remaining))
+        return remaining
+    
+
+    def checkpoint_cell(self, stage, cell, split_keys, objects_dict = {}):
 
-    def calc_std_metrics(self, std_metrics_dict = {}):
+        if self.checkpoint is None:
+            return
+        
+        self.checkpoint.store(self.checkpoint_key(stage, cell), 
+                              {split_key: self.data_dict[split_key][cell] for split_key in split_keys},
+                              objects_dict = objects_dict)
+
+
+    def create_cell_keys(self):
+        """
+        Returns a dict (i, j, k): signature of the cell in the run manifest. Next to the dataset, balancer, 
+        classifier and their parameters the signature contains the derived seeds of the cell.
+        """
+        seed_streams = self.data_dict['seed_streams']
+        sources = self.data_dict['training_sources']
+        cell_keys = {}
+
+        # cells that share a training set use the random states of the cell they duplicate
+        for (i,j,k), (gen_dict, (bal_name, balancer), (clsf_name, classifier)) in self.data_dict['assignment_dict'].items():
+
+            source = sources[(i,j)]
+            fit_ind = min(bal_ind for bal_ind in range(self.exp_dim[1]) if sources[(i, bal_ind)] == source)
+
+            bal_signature = (bal_name, balancer, self.bal_params_dicts.get(bal_name, {}), 
+                             seed_streams.random_state('balance', *source) if len(source) == 2 else None)
+            clsf_signature = (clsf_name, classifier, self.clsf_params_dicts.get(clsf_name, {}), 
+                              seed_streams.random_state('classify', i, fit_ind, k))
+
+            cell_keys[(i,j,k)] = self.manifest.cell_key(self.dataset_keys[i], bal_signature, clsf_signature)
+        
+        return cell_keys
+    
+
+    def load_cells(self, cells):
+
+        for (i,j,k) in cells:
+
+            cell_dict = self.manifest.get(self.cell_keys[(i,j,k)])
+
+            self.data_dict['clsf_predictions_y'][i,j,k] = cell_dict['y_pred']
+            self.data_dict['clsf_predictions_proba'][i,j,k] = cell_dict['proba']
+            self.data_dict['classes_order'][i,j,k] = cell_dict['classes']
+
+
+    def store_cells(self, cells, classifier_dict):
+
+        items = []
+        for (i,j,k) in sorted(cells):
+
+            gen_dict, (bal_name, balancer), (clsf_name, classifier) = self.data_dict['assignment_dict'][(i,j,k)]
+
+            arrays_dict = {'y_pred': self.data_dict['clsf_predictions_y'][i,j,k],
+                           'proba': self.data_dict['clsf_predictions_proba'][i,j,k],
+                           'classes': self.data_dict['classes_order'][i,j,k]}
+            
+            record = {'dataset': extract_table_info(gen_dict), 'balancer': bal_name, 'classifier': clsf_name}
+            
+            items.append((self.cell_keys[(i,j,k)], arrays_dict, classifier_dict[(i,j,k)][1], record))
+
+        # one rewrite of manifest.json per run instead of one per cell
+        self.manifest.store_cells(items)
+
+
+    def run_signature(self):
+        """
+        Hash of the definition of the run, shared by its checkpoint and its shards.
+        """
+        signature = {'test_size': self.test_size,
+                     'generation_dict_list': [{key: value for key, value in gen_dict.items() if key != 'gen_index'}
+                                              for gen_dict in self.generation_dict_list],
+                     'balancers': self.balancer_list,
+                     'classifiers': self.clsf_list,
+                     'clsf_params_dicts': self.clsf_params_dicts,
+                     'seed': self.seed,
+                     'repetition': self.repetition,
+                     'n_folds': self.n_folds}
+        
+        if dtype_signature(self.dtypes) is not None:
+            signature['dtypes'] = dtype_signature(self.dtypes)
+
+        return stable_hash(signature)
+    
+
+    def assessor_kwargs(self):
+        """
+        Arguments of an Assessor on the same grid and seed streams.
+        """
+        return {'test_size': self.test_size,
+                'generation_dict_list': self.generation_dict_list,
+                'balancers_dict': dict(self.balancer_list),
+                'classifiers_dict': dict(self.clsf_list),
+                'seed': self.data_dict['seed_streams'].entropy,
+                'clsf_params_dicts': self.clsf_params_dicts,
+                'n_folds': self.n_folds,
+                'dtypes': self.dtypes}
+
+
+    def split_keys(self):
+        """
+        data_dict keys of the generated datasets that the predictions are evaluated on.
+        """
+        if self.n_folds is None:
+            return ['org_X_test', 'org_y_test']
+        
+        return ['org_X', 'org_y', 'folds']
+
+
+    def save_shard(self, store):
+        """
+        Writes the output of the shard to its entry of the ShardStore store: the predictions of its cells packed back to back, 
+        the test sets of its datasets (whole datasets with their folds in K-fold mode), its failures and timings.
+        """
+        if self.shard is None:
+            raise ValueError("Only the outputs of an Assessor with a shard are saved, use a RunManifest to store the cells of a whole run.")
+        
+        cells = sorted(self.shard_cells)
+        y_pred = self.data_dict['clsf_predictions_y']
+        proba = self.data_dict['clsf_predictions_proba']
+
+        arrays_dict = {'cells': np.array(cells, dtype = np.int64).reshape(-1, 3),
+                       'y_pred': np.concatenate([np.empty(0, dtype = y_pred.buffer.dtype)] + [y_pred[cell] for cell in cells]),
+                       'proba': np.concatenate([np.empty((0, 2), dtype = proba.buffer.dtype)] + [proba[cell] for cell in cells]),
+                       'pred_lengths': np.array([y_pred.lengths[cell] for cell in cells], dtype = np.int64),
+                       'classes': np.array([self.data_dict['classes_order'][cell] for cell in cells]).reshape(-1, 2)}
+
+        n_splits = self.n_folds or 1
+        for i in sorted({i // n_splits for (i, j, k) in cells}):
+            for split_key in self.split_keys():
+                arrays_dict[f'{split_key}_{i}'] = self.data_dict[split_key][i]
+
+        objects_dict = {'meta': {'signature': self.run_signature(), 
+                                 'settings': stable_hash({'chunk_size': self.chunk_size, 'bal_params_dicts': self.bal_params_dicts}),
+                                 'shard': self.shard},
+                        'assessor_kwargs': self.assessor_kwargs(),
+                        'failures': self.data_dict['failures'],
+                        'records': None if self.instrumentation is None else self.instrumentation.records}
+        
+        store.replace(store.shard_key(self.shard), arrays_dict, objects_dict)
+
+
+    def load_shards(self, store):
+        """
+        Fills the data_dict with the outputs of all shards of the run in the ShardStore store, 
+        as if the whole grid had been run by this Assessor up to clsf_pred.
+        """
+        shard_keys = store.shard_keys()
+        metas = [store.load_object(key, 'meta') for key in shard_keys]
+
+        if any(meta['signature'] != self.run_signature() or meta['settings'] != metas[0]['settings'] for meta in metas):
+            raise ValueError(f"Shard outputs in {store.cache_dir} belong to different runs.")
+        
+        n_shards = metas[0]['shard'][1]
+        missing = set(range(n_shards)) - {meta['shard'][0] for meta in metas if meta['shard'][1] == n_shards}
+
+        if missing or len(metas) != n_shards:
+            raise ValueError(f"Shard outputs in {store.cache_dir} are incomplete or mix shard counts, missing shards {sorted(missing)} of {n_shards}.")
+        
+        shard_arrays = [store.load(key) for key in shard_keys]
+
+        # every dataset is taken from the first shard that holds it
+        a = len(self.generation_dict_list)
+        X_key, y_key = split_keys = self.split_keys()[:2]
+
+        datasets = {}
+        for arrays_dict in shard_arrays:
+            for i in range(a):
+                if f'{X_key}_{i}' in arrays_dict:
+                    datasets.setdefault(i, arrays_dict)
+        
+        lengths = [len(datasets[i][f'{y_key}_{i}']) for i in range(a)]
+
+        self.allocate_ragged(X_key, (a,), lengths, widths = [datasets[i][f'{X_key}_{i}'].shape[1] for i in range(a)],
+                             dtype = self.dtypes['features'])
+        self.allocate_ragged(y_key, (a,), lengths, dtype = self.dtypes['labels'])
+
+        if self.n_folds is not None:
+            self.allocate_ragged('folds', (a,), lengths, dtype = np.int8)
+            split_keys.append('folds')
+
+        for i in range(a):
+            for split_key in split_keys:
+                self.data_dict[split_key][i] = datasets[i][f'{split_key}_{i}']
+        
+        if self.n_folds is not None:
+            self.create_fold_views()
+
+        self.allocate_predictions(self.data_dict['assignment_dict'])
+
+        for shard_key, arrays_dict in zip(shard_keys, shard_arrays):
+
+            offsets = np.concatenate([[0], np.cumsum(arrays_dict['pred_lengths'])])
+
+            for n, (cell, classes) in enumerate(zip(map(tuple, arrays_dict['cells']), arrays_dict['classes'])):
+                self.data_dict['clsf_predictions_y'][cell] = arrays_dict['y_pred'][offsets[n]: offsets[n+1]]
+                self.data_dict['clsf_predictions_proba'][cell] = arrays_dict['proba'][offsets[n]: offsets[n+1]]
+                self.data_dict['classes_order'][cell] = classes
+
+            self.data_dict['failures'].update(store.load_object(shard_key, 'failures'))
+
+            records = store.load_object(shard_key, 'records')
+            if records is not None and self.instrumentation is not None:
+                for record_key, record in records.items():
+                    self.instrumentation.records.setdefault(record_key, record)
+
+
+    def calc_std_metrics(self, std_metrics_dict = {}, proba_metrics = False, calibration_bins = None, timings = False, pooled = False):
+        """
+        Metrics of every cell of the grid, in K-fold mode one row per fold. 
+        pooled = True computes the metrics of the K-fold mode on the out-of-fold predictions of all folds together, 
+        one row per (dataset, balancer, classifier).
+        """
+        if self.shard is not None:
+            raise ValueError("A shard only holds part of the grid, its metrics are computed after Sharding.merge_shards.")
+        
+        if pooled:
+            if self.n_folds is None:
+                raise ValueError("Pooled metrics are only defined for an Assessor with n_folds.")
+            
+            with self.pooled_folds():
+                return self.calc_std_metrics(std_metrics_dict, proba_metrics, calibration_bins)
 
         default_metrics = {
             'accuracy': accuracy_score,
@@ -165,7 +691,7 @@ class Assessor(Data):
         metrics_dict = std_metrics_dict or default_metrics
         std_metric_list = [(name, metr_func) for name, metr_func in metrics_dict.items()]
 
-        self.data_dict['std_metrics_res'] = np.full(shape = self.exp_dim + (len(metrics_dict),), fill_value = np.nan)
+        self.allocate('std_metrics_res', shape = self.exp_dim + (len(metrics_dict),))
         
         metrics = FMLP_Metrics()
 
@@ -175,6 +701,44 @@ class Assessor(Data):
 
         results_df = pd.DataFrame(std_metrics_res, columns= [name for (name, metr_func) in std_metric_list])
 
+        # ROC and PR AUC of the predicted probabilities instead of the hard labels
+        if proba_metrics:
+            self.allocate('proba_metrics_res', shape = self.exp_dim + (2,))
+            metrics.proba_metrics()
+
+            results_df[['AUROC', 'AUPRC']] = self.data_dict['proba_metrics_res'].reshape(-1, 2)
+
+        # calibration scores over calibration_bins quantile bins
+        if calibration_bins is not None:
+            self.allocate('calibration_res', shape = self.exp_dim + (3,))
+            metrics.calibration_metrics(m = calibration_bins)
+
+            results_df[['ECE', 'MCE', 'Brier score']] = self.data_dict['calibration_res'].reshape(-1, 3)
+
+        # metrics of failed cells are NaN, the failure is recorded in its own columns
+        failures = self.data_dict['failures']
+
+        if failures:
+            failed_rows = [np.ravel_multi_index(cell, self.exp_dim) for cell in failures]
+            results_df.iloc[failed_rows] = np.nan
+
+            failure_df = pd.DataFrame([failures.get(cell, {}) for cell in np.ndindex(self.exp_dim)], 
+                                      columns = ['stage', 'reason', 'message'])
+            results_df[['failed_stage', 'failure_reason', 'failure_message']] = failure_df.to_numpy()
+
+        results_df = pd.concat([self.reference_frame(), results_df], axis = 1)
+
+        # wall times of the generation, balancing and classifier calls each cell depends on
+        if timings and self.instrumentation is not None:
+            results_df = pd.concat([results_df, self.instrumentation.cell_times(self.exp_dim, n_folds = self.n_folds or 1)], axis = 1)
+
+        return results_df
+    
+
+    def reference_frame(self):
+        """
+        Dataset, balancer and classifier descriptors of the (i, j, k) cells, one row per cell in C-order of the grid.
+        """
         reference_list = [self.data_dict['assignment_dict'][(i, j, k)] 
                           for i in range(self.exp_dim[0]) 
                           for j in range(self.exp_dim[1]) 
@@ -188,12 +752,143 @@ class Assessor(Data):
                                                               'distributions', 
                                                               'balancer', 
                                                               'classifier'])
+        
+        if self.fold_labels is not None:
+            reference_df.insert(4, 'fold', np.repeat(self.fold_labels, self.exp_dim[1] * self.exp_dim[2]))
 
-        results_df = pd.concat([reference_df, results_df], axis = 1)
+        return reference_df
+    
 
-        return results_df
+    @contextmanager
+    def pooled_folds(self):
+        """
+        Temporarily replaces the data_dict by one with a (dataset, balancer, classifier) grid, whose test set is the whole
+        dataset and whose predictions are the out-of-fold predictions of the K folds. 
+        As the rows of a dataset are stored in fold order, the concatenated fold predictions line up with org_y.
+        A cell failed if one of its folds failed.
+        """
+        data_dict, storage = Data.data_dict, Data.storage
+        exp_dim, fold_labels = self.exp_dim, self.fold_labels
+
+        K = self.n_folds
+        a, b, c = exp_dim[0] // K, exp_dim[1], exp_dim[2]
+        y_pred = data_dict['clsf_predictions_y']
+        proba = data_dict['clsf_predictions_proba']
+        classes = data_dict['classes_order']
+
+        Data.data_dict, Data.storage = {}, None
+        self.exp_dim, self.fold_labels = (a, b, c), ['pooled'] * a
+
+        try:
+            self.data_dict['assignment_dict'] = {(i // K, j, k): assign_list 
+                                                 for (i, j, k), assign_list in data_dict['assignment_dict'].items() if i % K == 0}
+            self.data_dict['failures'] = {}
+            for (i, j, k), failure in sorted(data_dict['failures'].items()):
+                self.data_dict['failures'].setdefault((i // K, j, k), failure)
+
+            self.data_dict['org_X_test'] = data_dict['org_X']
+            self.data_dict['org_y_test'] = data_dict['org_y']
+
+            self.allocate_predictions(self.data_dict['assignment_dict'])
+
+            for (i, j, k) in np.ndindex(self.exp_dim):
+
+                fold_cells = [(i*K + f, j, k) for f in range(K)]
+
+                # the columns of the probabilities are brought into the order of sorted classes, which every fold shares
+                self.data_dict['clsf_predictions_y'][i, j, k] = np.concatenate([y_pred[cell] for cell in fold_cells])
+                self.data_dict['clsf_predictions_proba'][i, j, k] = np.concatenate([proba[cell][:, np.argsort(classes[cell])] 
+                                                                                    for cell in fold_cells])
+                self.data_dict['classes_order'][i, j, k] = np.sort(classes[fold_cells[0]])
+            
+            yield
+        
+        finally:
+            Data.data_dict, Data.storage = data_dict, storage
+            self.exp_dim, self.fold_labels = exp_dim, fold_labels
+
+
+    def repeat(self, bal_params_dicts = {}, chunk_size = None, dataset_cache = None, resample_cache = None, 
+               std_metrics_dict = {}, proba_metrics = False, calibration_bins = None):
+        """
+        Runs generate, balance, clsf_pred and calc_std_metrics for each of the repetitions of the Assessor.
+        The repetitions are independent jobs over n_jobs processes, each on the seed streams of its repetition index. 
+        Only the metrics of a finished repetition are sent back and folded into running means and variances, 
+        the prediction tensors of a repetition are freed with it.
+
+        Returns:
+        - pd.DataFrame: Descriptor columns and per metric the columns '<metric> mean', '<metric> std' 
+          and 'repetitions', the number of repetitions in which all metrics of the cell could be computed.
+        """
+        # children draw from the entropy of this Assessor, so repetitions of an unseeded Assessor stay reproducible from it
+        assessor_kwargs = {**self.assessor_kwargs(),
+                           'timeout': self.executor.timeout,
+                           'max_memory': self.executor.max_memory,
+                           'isolate': self.executor.isolate}
+        
+        stage_kwargs = {'generate': {'chunk_size': chunk_size, 'cache': dataset_cache},
+                        'balance': {'bal_params_dicts': bal_params_dicts, 'cache': resample_cache},
+                        'metrics': {'std_metrics_dict': std_metrics_dict, 'proba_metrics': proba_metrics, 
+                                    'calibration_bins': calibration_bins}}
+        
+        jobs_dict = {(repetition,): (assessor_kwargs, repetition, stage_kwargs) for repetition in range(self.repetitions)}
+
+        reference_df = self.reference_frame()
+        moments = {}
+
+        def aggregate(key, result):
+            metric_names, values = result
+            if not moments:
+                moments.update({'names': metric_names, 'moments': RunningMoments(values.shape)})
+            moments['moments'].update(values)
+        
+        # with n_jobs = 1 the repetitions run in this process and would leave their data_dict behind
+        data_dict = Data.data_dict
+        try:
+            CellExecutor(self.n_jobs).run(repetition_job, jobs_dict, callback = aggregate)
+        finally:
+            Data.data_dict = data_dict
+
+        names = moments['names']
+        moments = moments['moments']
+
+        results_df = pd.DataFrame({column: values 
+                                   for m, name in enumerate(names) 
+                                   for column, values in [(f'{name} mean', moments.finite_mean()[:, m]), 
+                                                          (f'{name} std', moments.std[:, m])]})
+        results_df['repetitions'] = moments.count.min(axis = 1)
+
+        return pd.concat([reference_df, results_df], axis = 1)
+
+
+    def measure(self, stage, cell):
+        
+        if self.instrumentation is None:
+            return nullcontext()
+        
+        return self.instrumentation.measure(stage, cell)
+
+
+    def timing_report(self, n = 10, by = 'wall_time', file_path = None):
+        """
+        Slowest generator, balancer, fit and predict calls. All records are written to file_path as csv if given.
+        """
+        if self.instrumentation is None:
+            raise ValueError("Timings are only recorded by an Assessor with instrument = True.")
+        
+        if file_path is not None:
+            self.instrumentation.to_frame(self.data_dict).to_csv(file_path)
+
+        return self.instrumentation.slowest_cells(self.data_dict, n = n, by = by)
     
 
+    def close(self):
+        """
+        Frees the shared memory of the data_dict arrays. Also runs automatically when the Assessor is discarded.
+        """
+        self._finalizer()
+
+
     def create_calibration_curves(self, doc_dict, selection_tuple_set = {}, spline = False, save = False, title = f'Calibration Curves'):
 
         metrics = FMLP_Metrics(doc_dict, selection_tuple_set)
@@ -228,6 +923,46 @@ class Assessor(Data):
 
 
 
+def repetition_job(assessor_kwargs, repetition, stage_kwargs):
+    """
+    One repetition of the grid in a fresh Assessor. Returns the metric names and the metrics of the cells, shape (cells, metrics).
+    """
+    assessor = Assessor(**assessor_kwargs, repetition = repetition)
+
+    assessor.generate(**stage_kwargs['generate'])
+    assessor.balance(**stage_kwargs['balance'])
+    assessor.clsf_pred()
+    results_df = assessor.calc_std_metrics(**stage_kwargs['metrics'])
+
+    assessor.close()
+
+    non_metric_columns = ['n_features', 'n_samples', 'class_ratio', 'distributions', 'fold', 'balancer', 'classifier', 
+                          'failed_stage', 'failure_reason', 'failure_message']
+    metric_names = [column for column in results_df.columns if column not in non_metric_columns]
+
+    return metric_names, results_df[metric_names].to_numpy(dtype = float)
+
+
+
+def release_storage(storage, data_dict):
+    """
+    Finalizer of an Assessor: drops the shared arrays from its data_dict and unlinks their memory blocks.
+    """
+    if storage is None:
+        return
+    
+    for key in [key for key, array in data_dict.items() 
+                if key in storage.blocks or isinstance(array, RaggedArray)]:
+        data_dict.pop(key)
+
+    storage.release()
+
+    if Data.storage is storage:
+        Data.storage = None
+
+
+
+
 if __name__=="__main__":
 
     import pandas as pd
@@ -282,4 +1017,66 @@ if __name__=="__main__":
     
     
 
-    
\ No newline at end of file
+    
+
+    """
+    Repeated Assessor Testcase
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    assessor = Assessor(0.2, [presentation_experiment_dict], balancing_methods, classifiers_dict, n_jobs = 4, seed = 42, repetitions = 10)
+
+    results_df = assessor.repeat()
+    print(results_df)
+    """
+
+
+    """
+    Stratified K-fold Testcase
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    assessor = Assessor(0.2, [presentation_experiment_dict], balancing_methods, classifiers_dict, n_jobs = 4, seed = 42, n_folds = 5)
+
+    assessor.generate()
+    assessor.balance()
+    assessor.clsf_pred()
+
+    fold_df = assessor.calc_std_metrics(proba_metrics = True)
+    pooled_df = assessor.calc_std_metrics(proba_metrics = True, pooled = True)
+    print(pd.concat([fold_df, pooled_df]))
+    """
+
+
+    """
+    Sharded Assessor Testcase
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    import sys
+    from Caching import ShardStore
+    from Sharding import merge_shards
+
+    store = ShardStore('Experiments/shards')
+
+    # every host runs one shard, e.g. python Assessors.py 2/4
+    assessor = Assessor(0.2, [presentation_experiment_dict], balancing_methods, classifiers_dict, n_jobs = 4, seed = 42, shard = sys.argv[1])
+
+    assessor.generate()
+    assessor.balance()
+    assessor.clsf_pred()
+    assessor.save_shard(store)
+
+    # after all shards finished
+    results_df = merge_shards(store).calc_std_metrics()
+    print(results_df)
+    """
+
+
+    """
+    Compact Dtypes Testcase
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    from helper_tools import compact_dtypes
+
+    assessor = Assessor(0.2, [presentation_experiment_dict], balancing_methods, classifiers_dict, seed = 42, dtypes = compact_dtypes)
+
+    assessor.generate()
+    assessor.balance()
+    assessor.clsf_pred()
+
+    print(assessor.calc_std_metrics(proba_metrics = True, calibration_bins = 10))
+    """
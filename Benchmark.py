@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+import sklearn
+from imblearn.over_sampling import ADASYN, RandomOverSampler, SMOTE, BorderlineSMOTE
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score
+
+from Assessors import Assessor
+from Fast_SMOTE import FastSMOTE
+from Metrics import FMLP_Metrics
+from Data_Generator import Multi_Modal_Dist_Generator
+from gen_parameters import alt_experiment_dict, presentation_experiment_dict
+from helper_tools import create_simple_normal_dict_list
+
+
+
+
+"""
+Scenarios
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+balancers_dict = {
+    "Unbalanced": None,
+    "RandomOverSampler": RandomOverSampler,
+    "SMOTE": SMOTE,
+    "ADASYN": ADASYN,
+    "BorderlineSMOTE": BorderlineSMOTE,
+    "FastSMOTE": FastSMOTE,
+}
+
+classifiers_dict = {
+    "Logistic Regression": LogisticRegression,
+    "Decision Tree": DecisionTreeClassifier,
+    "Random Forest": RandomForestClassifier,
+}
+
+# one repeat of the quick scenarios takes about a minute, full adds the sizes of the experiments
+scaling_grids = {
+    'quick': {'n_samples': [10e2, 10e3], 'n_features': [2, 8]},
+    'full': {'n_samples': [10e2, 10e3, 10e4], 'n_features': [2, 8, 16]},
+}
+
+
+# imports a job does before any work, timed in fresh interpreters. 'experiment methods' is the header of FMLP_Assessment
+startup_statements = {
+    'Results_Store': 'import Results_Store',
+    'Metrics': 'import Metrics',
+    'Assessors': 'import Assessors',
+    'experiment methods': 'import Registry\nfrom Assessors import Assessor\n'
+                          'balancing_methods = Registry.select(Registry.balancers, list(Registry.balancers))\n'
+                          'classifiers_dict = Registry.select(Registry.classifiers, list(Registry.classifiers))',
+}
+
+
+def create_scenarios(scale = 'quick'):
+    """
+    Dictionary scenario name: generation dict. Every scenario is a single dataset,
+    the simple normal scenarios grow in n_samples and n_features.
+    """
+    scenarios = {'presentation_experiment': presentation_experiment_dict}
+
+    if scale == 'full':
+        scenarios['alt_experiment'] = alt_experiment_dict
+
+    grid = scaling_grids[scale]
+    for n_samples in grid['n_samples']:
+        for n_features in grid['n_features']:
+
+            gen_dict = create_simple_normal_dict_list([n_samples], [n_features], [0.1], [2])[0]
+            scenarios[f'simple_normal_n{int(n_samples)}_d{n_features}'] = gen_dict
+
+    return scenarios
+
+
+
+
+"""
+Timing
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+def time_call(func, *args, **kwargs):
+
+    start_time = time.perf_counter()
+    func(*args, **kwargs)
+
+    return time.perf_counter() - start_time
+
+
+
+def time_pipeline(gen_dict, seed = 42):
+    """
+    Wall times of one run of a scenario. Generation, balancing and the classifier calls are taken from
+    the instrumentation of an Assessor, the metrics are timed per FMLP_Metrics method.
+
+    Returns:
+    - dict: benchmark name: seconds, e.g. 'balance/SMOTE' or 'fit/SMOTE/Decision Tree'.
+    """
+    times = {}
+
+    generator = Multi_Modal_Dist_Generator(gen_dict['distributions'], gen_dict['params_dict_list'], gen_dict['sizes'], seed = seed)
+    times['create_data'] = time_call(generator.create_data)
+
+    assessor = Assessor(0.2, [gen_dict], balancers_dict, classifiers_dict, seed = seed, instrument = True)
+    assessor.generate()
+    assessor.balance()
+    assessor.clsf_pred()
+
+    balancer_names = list(balancers_dict)
+    classifier_names = list(classifiers_dict)
+
+    for (stage, cell), record in assessor.instrumentation.records.items():
+
+        # cells are (i,), (i, j) or (i, j, k), every scenario has the single dataset i = 0
+        names = [stage] + [names_list[ind] for names_list, ind in zip([balancer_names, classifier_names], cell[1:])]
+        times['/'.join(names)] = record['wall_time']
+
+    std_metric_list = [('accuracy', accuracy_score), ('precision', precision_score), ('recall', recall_score),
+                       ('F1 score', f1_score), ('ROC AUC Score', roc_auc_score)]
+
+    assessor.allocate('std_metrics_res', shape = assessor.exp_dim + (len(std_metric_list),))
+    assessor.allocate('proba_metrics_res', shape = assessor.exp_dim + (2,))
+    assessor.allocate('calibration_res', shape = assessor.exp_dim + (3,))
+
+    # the plotting methods are left out, they only add the figure rendering to selected_bins and the threshold curves
+    metrics = FMLP_Metrics()
+    times['metrics/confusion_metrics'] = time_call(metrics.confusion_metrics, std_metric_list)
+    times['metrics/confusion_metrics_loop'] = time_call(metrics.confusion_metrics_loop, std_metric_list)
+    times['metrics/proba_metrics'] = time_call(metrics.proba_metrics)
+    times['metrics/calibration_metrics'] = time_call(metrics.calibration_metrics, 10)
+    times['metrics/selected_bins'] = time_call(metrics.selected_bins, 10)
+
+    assessor.close()
+
+    return times
+
+
+
+def time_startup(statement):
+    """
+    Seconds to execute an import statement in a fresh interpreter, without the start of the interpreter itself.
+    NaN if the statement fails, e.g. for a missing optional dependency.
+    """
+    code = f'import time\nstart_time = time.perf_counter()\n{statement}\nprint(time.perf_counter() - start_time)'
+    
+    result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, 
+                            cwd = os.path.dirname(os.path.abspath(__file__)))
+    
+    if result.returncode != 0:
+        return np.nan
+
+    return float(result.stdout.split()[-1])
+
+
+
+def run_benchmarks(scale = 'quick', repeats = 3, scenario_filter = None, seed = 42):
+    """
+    Runs every scenario repeats times, the scenario 'startup' times the statements of startup_statements.
+
+    Returns:
+    - dict: 'meta' with the environment of the run and 'results' with scenario: benchmark name: statistics in seconds.
+    """
+    results = {}
+
+    if not scenario_filter or scenario_filter in 'startup':
+
+        runs = {f'import/{name}': [time_startup(statement) for _ in range(repeats)] for name, statement in startup_statements.items()}
+
+        # modules whose dependencies are missing are left out
+        results['startup'] = {bench: {'median': float(np.median(bench_times)), 
+                                      'min': float(np.min(bench_times)),
+                                      'times': bench_times}
+                              for bench, bench_times in runs.items() if not np.isnan(bench_times).any()}
+        
+        print(f'startup: {sum(stats["median"] for stats in results["startup"].values()):.2f}s')
+
+    for name, gen_dict in create_scenarios(scale).items():
+
+        if scenario_filter and scenario_filter not in name:
+            continue
+
+        runs = [time_pipeline(gen_dict, seed = seed) for _ in range(repeats)]
+
+        results[name] = {bench: {'median': float(np.median(bench_times)),
+                                 'min': float(np.min(bench_times)),
+                                 'times': bench_times}
+                         for bench in runs[0]
+                         for bench_times in [[run[bench] for run in runs]]}
+
+        print(f'{name}: {sum(stats["median"] for stats in results[name].values()):.2f}s')
+
+    meta = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scale': scale,
+            'repeats': repeats,
+            'seed': seed}
+
+    return {'meta': meta, 'results': results}
+
+
+
+
+"""
+Comparison
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+def compare_runs(baseline, candidate, threshold = 0.1, min_time = 1e-3):
+    """
+    Compares the medians of two benchmark runs.
+
+    Parameters:
+    - baseline, candidate (dict): Outputs of run_benchmarks.
+    - threshold (float): Relative slow-down above which a benchmark counts as regression.
+    - min_time (float): Benchmarks faster than this in both runs are ignored, their timings are mostly noise.
+
+    Returns:
+    - list: Rows (scenario, benchmark, baseline median, candidate median, ratio, status) for the benchmarks of both runs.
+    """
+    rows = []
+    for scenario, benchmarks in candidate['results'].items():
+
+        base_benchmarks = baseline['results'].get(scenario, {})
+
+        for bench, stats in benchmarks.items():
+
+            if bench not in base_benchmarks:
+                continue
+
+            base_time = base_benchmarks[bench]['median']
+            new_time = stats['median']
+            ratio = new_time / base_time if base_time > 0 else np.inf
+
+            if max(base_time, new_time) < min_time:
+                status = 'noise'
+            elif ratio > 1 + threshold:
+                status = 'REGRESSION'
+            elif ratio < 1 - threshold:
+                status = 'improved'
+            else:
+                status = 'ok'
+
+            rows.append((scenario, bench, base_time, new_time, ratio, status))
+
+    return rows
+
+
+
+def print_comparison(rows):
+
+    print(f'{"scenario":<32} {"benchmark":<52} {"baseline":>10} {"candidate":>10} {"ratio":>7}  status')
+    for scenario, bench, base_time, new_time, ratio, status in rows:
+        print(f'{scenario:<32} {bench:<52} {base_time:>10.4f} {new_time:>10.4f} {ratio:>7.2f}  {status}')
+
+
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the generate, balance, classify and metrics stages.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    run_parser = subparsers.add_parser('run', help = 'Run the benchmarks and write the timings as JSON.')
+    run_parser.add_argument('--output', default = 'Experiments/benchmark.json')
+    run_parser.add_argument('--scale', choices = list(scaling_grids), default = 'quick')
+    run_parser.add_argument('--repeats', type = int, default = 3)
+    run_parser.add_argument('--scenario', default = None, help = 'Only run scenarios whose name contains this string.')
+    run_parser.add_argument('--seed', type = int, default = 42)
+
+    compare_parser = subparsers.add_parser('compare', help = 'Compare two benchmark JSON files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type = float, default = 0.1)
+    compare_parser.add_argument('--min-time', type = float, default = 1e-3)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        benchmark = run_benchmarks(args.scale, args.repeats, args.scenario, args.seed)
+
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok = True)
+
+        with open(args.output, 'w') as file:
+            json.dump(benchmark, file, indent = 2)
+
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+
+    rows = compare_runs(baseline, candidate, args.threshold, args.min_time)
+    print_comparison(rows)
+
+    # non-zero exit status for regressions, e.g. to fail a CI job
+    return int(any(row[-1] == 'REGRESSION' for row in rows))
+
+
+
+
+if __name__=="__main__":
+
+    """
+    Usage
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    python Benchmark.py run --output Experiments/benchmark_base.json
+    python Benchmark.py run --output Experiments/benchmark_new.json --scale full --repeats 5
+    python Benchmark.py compare Experiments/benchmark_base.json Experiments/benchmark_new.json --threshold 0.2
+    python Benchmark.py run --output Experiments/benchmark_startup.json --scenario startup --repeats 10
+    """
+    sys.exit(main())
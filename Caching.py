@@ -0,0 +1,354 @@
+import os
+import json
+import pickle
+import shutil
+import uuid
+import numpy as np
+from helper_tools import stable_hash
+
+
+
+
+class DiskCache():
+
+    def __init__(self, cache_dir, max_bytes = None):
+        """
+        Directory of entries, each a subdirectory of .npy files named by a content hash.
+        Loading an entry refreshes its modification time, the least recently used entries 
+        are evicted once the total size exceeds max_bytes.
+
+        Parameters:
+        - cache_dir (str): Directory of the cache, created if it does not exist.
+        - max_bytes (int or None): Size budget of the cache on disk. None for no limit.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok = True)
+
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+
+    def contains(self, key):
+        return os.path.isdir(self.entry_dir(key))
+
+
+    def load(self, key, mmap = True):
+        """
+        Returns the arrays of an entry as a dict name: array, memory-mapped read-only if mmap is set.
+        """
+        entry_dir = self.entry_dir(key)
+        os.utime(entry_dir)
+
+        return {file_name[:-4]: np.load(os.path.join(entry_dir, file_name), mmap_mode = 'r' if mmap else None)
+                for file_name in os.listdir(entry_dir) if file_name.endswith('.npy')}
+
+
+    def get(self, key, mmap = True):
+        """
+        Returns the arrays of an entry or None if it is not cached, counting hits and misses.
+        """
+        if not self.contains(key):
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+
+        return self.load(key, mmap = mmap)
+
+
+    def stats(self):
+
+        entries = self.entry_sizes()
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits, 
+                'misses': self.misses, 
+                'hit_rate': self.hits / lookups if lookups else np.nan,
+                'entries': len(entries),
+                'bytes': sum(size for (access_time, size, key) in entries)}
+
+
+    def load_object(self, key, name):
+        """
+        Returns a pickled object of an entry, stored via the objects_dict of store.
+        """
+        with open(os.path.join(self.entry_dir(key), f'{name}.pkl'), 'rb') as file:
+            return pickle.load(file)
+
+
+    def store(self, key, arrays_dict, objects_dict = {}, evict = True):
+        """
+        Writes the arrays of arrays_dict and the pickled objects of objects_dict as an entry. 
+        The entry is written to a temporary directory first and renamed, so concurrent runs never see half written entries.
+        evict = False leaves the eviction to the caller, e.g. once after a batch of entries.
+        """
+        if self.contains(key):
+            return
+
+        tmp_dir = os.path.join(self.cache_dir, f'.tmp_{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+
+        for name, array in arrays_dict.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), np.asarray(array))
+
+        for name, obj in objects_dict.items():
+            with open(os.path.join(tmp_dir, f'{name}.pkl'), 'wb') as file:
+                pickle.dump(obj, file)
+
+        try:
+            os.rename(tmp_dir, self.entry_dir(key))
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+        if evict:
+            self.evict()
+
+
+    def entry_sizes(self):
+        """
+        Returns a list of (last access time, size in bytes, key) for all entries.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+
+            entry_dir = self.entry_dir(key)
+            if key.startswith('.tmp_') or not os.path.isdir(entry_dir):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, key))
+
+        return entries
+
+
+    def evict(self):
+
+        if self.max_bytes is None:
+            return
+        
+        entries = sorted(self.entry_sizes())
+        total_bytes = sum(size for (access_time, size, key) in entries)
+
+        for access_time, size, key in entries:
+
+            if total_bytes <= self.max_bytes:
+                break
+
+            shutil.rmtree(self.entry_dir(key), ignore_errors = True)
+            total_bytes -= size
+
+
+
+
+class DatasetCache(DiskCache):
+
+    @staticmethod
+    def dataset_key(generation_dict, seed_seq, test_size, chunk_size = None, n_folds = None, dtypes = None):
+        """
+        Content hash of everything that determines a generated train/test split or fold assignment. 
+        gen_index is left out, the position in the grid only enters through the seed.
+        dtypes is the dtype_signature of the run, None for float64 datasets.
+        """
+        generation_dict = {key: value for key, value in generation_dict.items() if key != 'gen_index'}
+
+        split_dict = {'test_size': test_size, 'chunk_size': chunk_size}
+        if n_folds is not None:
+            split_dict = {'n_folds': n_folds}
+
+        if dtypes is not None:
+            split_dict['dtypes'] = dtypes
+
+        return stable_hash({'generation_dict': generation_dict, 
+                            'seed': seed_seq, 
+                            **split_dict})
+
+
+
+
+class ResampleCache(DiskCache):
+
+    def fingerprint(self, X, y):
+        """
+        Content hash of a training set.
+        """
+        return stable_hash((X, y))
+
+
+    def resample_key(self, train_fingerprint, balancer, bal_params):
+        """
+        Key of a resampled training set: fingerprint of the original training set, balancer class
+        and its parameters (including the derived random_state).
+        """
+        return stable_hash({'train_fingerprint': train_fingerprint, 
+                            'balancer': balancer, 
+                            'params': bal_params})
+
+
+
+
+class RunManifest(DiskCache):
+
+    def __init__(self, cache_dir, max_bytes = None):
+        """
+        Persisted record of the evaluated (i, j, k) cells of a study. Every cell is stored under its signature, 
+        a hash of the dataset key, balancer, classifier, their parameters and seeds, together with its predictions, 
+        the fitted classifier and its record. manifest.json lists the records of the stored cells in readable form.
+        """
+        super().__init__(cache_dir, max_bytes)
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+
+
+    def cell_key(self, dataset_key, bal_signature, clsf_signature):
+
+        return stable_hash({'dataset': dataset_key, 
+                            'balancer': bal_signature, 
+                            'classifier': clsf_signature})
+    
+
+    def records(self):
+
+        if not os.path.isfile(self.manifest_path):
+            return {}
+        
+        with open(self.manifest_path) as file:
+            return json.load(file)
+        
+
+    def store_cells(self, items):
+        """
+        Stores the cells of items, tuples (key, arrays_dict, model, record), and then writes manifest.json once.
+        """
+        new_records = {}
+
+        for key, arrays_dict, model, record in items:
+            self.store(key, arrays_dict, objects_dict = {'model': model, 'record': record}, evict = False)
+            new_records[key] = record
+
+        self.evict()
+        self.write_manifest(new_records)
+
+
+    def write_manifest(self, new_records = {}):
+        """
+        Rewrites manifest.json from the entries on disk, records of evicted entries are dropped.
+        Every entry holds its own record, so the records of a concurrent run on the same directory are not lost
+        with the read-modify-replace of the file. Entries of older runs without a record keep that of the old manifest.json.
+        """
+        old_records = self.records()
+        records = {}
+
+        for access_time, size, key in sorted(self.entry_sizes(), key = lambda entry: entry[2]):
+
+            if key in new_records:
+                records[key] = new_records[key]
+            elif os.path.isfile(os.path.join(self.entry_dir(key), 'record.pkl')):
+                records[key] = self.load_object(key, 'record')
+            elif key in old_records:
+                records[key] = old_records[key]
+
+        tmp_path = f'{self.manifest_path}.tmp_{uuid.uuid4().hex}'
+        with open(tmp_path, 'w') as file:
+            json.dump(records, file, indent = 1, default = str)
+        
+        os.replace(tmp_path, self.manifest_path)
+
+
+
+
+class RunCheckpoint(DiskCache):
+
+    def __init__(self, cache_dir):
+        """
+        Checkpoint of a single Assessor run. Every finished cell of a stage (dataset i of generate, (i, j) of balance, 
+        (i, j, k) of clsf_pred) is an entry holding its data_dict segments, its presence marks the cell as done.
+        status.json holds the signature of the run and the finished stages.
+        """
+        super().__init__(cache_dir)
+        self.status_path = os.path.join(cache_dir, 'status.json')
+
+
+    def open(self, signature):
+        """
+        Starts a new checkpoint or resumes an existing one of the same run.
+        """
+        status = self.status()
+
+        if not status:
+            self.write_status({'signature': signature, 'stages': []})
+        
+        elif status['signature'] != signature:
+            raise ValueError(f"Checkpoint in {self.cache_dir} belongs to a different run, use a new directory.")
+        
+
+    def status(self):
+
+        if not os.path.isfile(self.status_path):
+            return {}
+        
+        with open(self.status_path) as file:
+            return json.load(file)
+        
+
+    def write_status(self, status):
+
+        tmp_path = f'{self.status_path}.tmp_{uuid.uuid4().hex}'
+        with open(tmp_path, 'w') as file:
+            json.dump(status, file, indent = 1)
+        
+        os.replace(tmp_path, self.status_path)
+
+
+    def mark_stage(self, stage):
+
+        status = self.status()
+        if stage not in status['stages']:
+            status['stages'].append(stage)
+            self.write_status(status)
+
+
+    def cell_key(self, stage, cell, params = None):
+        """
+        Entry name of a cell, params are the stage settings the cell depends on besides the run signature.
+        """
+        return f"{stage}_{'_'.join(map(str, cell))}_{stable_hash(params)[:16]}"
+
+
+
+
+class ShardStore(DiskCache):
+
+    def __init__(self, cache_dir):
+        """
+        Outputs of the shards of a sharded run, one entry per shard with the predictions of its cells, 
+        the test sets of its datasets, its failures and the definition of the run. 
+        The entries of all shards are collected in one directory to be merged, e.g. copied together from several hosts.
+        """
+        super().__init__(cache_dir)
+
+
+    def shard_key(self, shard):
+        
+        index, n_shards = shard
+        return f'shard_{index}_of_{n_shards}'
+    
+
+    def shard_keys(self):
+
+        return sorted(key for key in os.listdir(self.cache_dir) 
+                      if key.startswith('shard_') and os.path.isdir(self.entry_dir(key)))
+
+
+    def replace(self, key, arrays_dict, objects_dict = {}):
+        """
+        Stores an entry, the output of an earlier run of the same shard is overwritten.
+        """
+        if self.contains(key):
+            shutil.rmtree(self.entry_dir(key))
+
+        self.store(key, arrays_dict, objects_dict)
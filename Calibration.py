@@ -0,0 +1,138 @@
+import numpy as np
+
+
+
+
+def quantile_bounds(n, m):
+    """
+    Start indices of m bins over n sorted samples, the same split as np.array_split.
+    """
+    q, r = divmod(n, m)
+    bin_sizes = np.full(m, q)
+    bin_sizes[:r] += 1
+
+    return np.r_[0, np.cumsum(bin_sizes)]
+
+
+
+def calibration_bins(y_test, pred_proba, m, strategy = 'quantile'):
+    """
+    Bin statistics of a batch of probability vectors that share one test set.
+
+    Parameters:
+    - y_test (array): Labels, shape (n,).
+    - pred_proba (array): Predicted probabilities of class 1, shape (cells, n).
+    - m (int): Number of bins.
+    - strategy (str): 'quantile' for bins of equal size over the sorted probabilities (as np.array_split),
+      'uniform' for bins of equal width on [0, 1].
+
+    Returns:
+    - dict: mean_pred_proba, mean_freq and counts per bin, each of shape (cells, m). Empty bins have NaN means.
+      Cells with non-finite probabilities (failed cells are NaN) have NaN means and no counts.
+    """
+    pred_proba = np.atleast_2d(pred_proba)
+    y_test = (np.asarray(y_test) == 1).astype(float)
+    n_cells, n = pred_proba.shape
+
+    # NaN would give invalid bin indices and scramble the sort, such cells are binned as zeros and masked afterwards
+    valid = np.isfinite(pred_proba).all(axis = 1)
+    pred_proba = np.where(valid[:, None], pred_proba, 0)
+
+    if strategy == 'quantile':
+
+        bounds = quantile_bounds(n, m)
+        counts = np.broadcast_to(np.diff(bounds), (n_cells, m))
+
+        order = np.argsort(pred_proba, axis = 1)
+        sorted_proba = np.take_along_axis(pred_proba, order, axis = 1)
+        sorted_y = y_test[order]
+
+        # reduceat needs valid start indices, empty bins are masked afterwards
+        starts = np.minimum(bounds[:-1], n - 1)
+        # float32 probabilities are summed in float64
+        proba_sums = np.add.reduceat(sorted_proba, starts, axis = 1, dtype = float)
+        y_sums = np.add.reduceat(sorted_y, starts, axis = 1)
+
+        proba_sums[:, counts[0] == 0] = 0
+        y_sums[:, counts[0] == 0] = 0
+
+    elif strategy == 'uniform':
+
+        bin_inds = np.minimum((pred_proba * m).astype(int), m - 1)
+        flat_inds = (bin_inds + m * np.arange(n_cells)[:, None]).ravel()
+
+        counts = np.bincount(flat_inds, minlength = n_cells * m).reshape(n_cells, m)
+        proba_sums = np.bincount(flat_inds, weights = pred_proba.ravel(), minlength = n_cells * m).reshape(n_cells, m)
+        y_sums = np.bincount(flat_inds, weights = np.broadcast_to(y_test, pred_proba.shape).ravel(),
+                             minlength = n_cells * m).reshape(n_cells, m)
+
+    else:
+        raise ValueError(f"Unknown binning strategy {strategy}, use 'quantile' or 'uniform'.")
+
+    counts = np.where(valid[:, None], counts, 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return {'mean_pred_proba': proba_sums / counts,
+                'mean_freq': y_sums / counts,
+                'counts': counts}
+
+
+
+def calibration_scores(y_test, pred_proba, bins_dict):
+    """
+    Expected and maximal calibration error of the bins of calibration_bins and the Brier score.
+
+    Returns:
+    - array: ECE, MCE, Brier score per cell, shape (cells, 3).
+    """
+    pred_proba = np.atleast_2d(pred_proba)
+    y_test = (np.asarray(y_test) == 1).astype(float)
+
+    counts = bins_dict['counts']
+    gaps = np.abs(bins_dict['mean_freq'] - bins_dict['mean_pred_proba'])
+    gaps[counts == 0] = 0
+
+    # cells without counts (non-finite probabilities) score NaN
+    binned = np.sum(counts, axis = 1) > 0
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ece = np.sum(counts * gaps, axis = 1) / np.sum(counts, axis = 1)
+    mce = np.where(binned, np.max(gaps, axis = 1), np.nan)
+    brier = np.mean((pred_proba - y_test)**2, axis = 1)
+
+    return np.stack([ece, mce, brier], axis = 1)
+
+
+
+
+if __name__=="__main__":
+
+    import time
+
+    """
+    Benchmark batched binning against the argsort and array_split loop
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    """
+    rng = np.random.default_rng(42)
+    n, n_cells, m = 20000, 50, 1000
+
+    y_test = (rng.random(n) < 0.01).astype(float)
+    pred_proba = np.clip(rng.random((n_cells, n)) * 0.3 + 0.5 * y_test, 0, 1)
+
+    start_time = time.perf_counter()
+    loop_res = []
+    for proba in pred_proba:
+        sorted_indices = np.argsort(proba)
+        binned_probabilities = np.array_split(proba[sorted_indices], m)
+        binned_y_test = np.array_split(y_test[sorted_indices], m)
+        loop_res.append(([bin.sum()/len(bin) for bin in binned_probabilities], [bin.sum()/len(bin) for bin in binned_y_test]))
+    loop_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    bins_dict = calibration_bins(y_test, pred_proba, m)
+    batched_time = time.perf_counter() - start_time
+
+    deviation = np.max(np.abs(np.array([res[0] for res in loop_res]) - bins_dict['mean_pred_proba']))
+    print(f'Max deviation {deviation:.2e}')
+    print(f'{n_cells} cells, {m} bins: loop {loop_time:.3f}s, batched {batched_time:.3f}s, speed-up {loop_time/batched_time:.2f}')
+    print(calibration_scores(y_test, pred_proba, bins_dict)[:5])
@@ -1,5 +1,8 @@
 from sklearn.base import BaseEstimator, ClassifierMixin
-from helper_tools import Data
+from sklearn.utils.validation import has_fit_parameter
+from helper_tools import Data, accepts_random_state, resolve_array
+from Registry import resolve
+from Executor import CellExecutor, JobFailure
 import numpy as np
 
 class Classifier(BaseEstimator, ClassifierMixin):
@@ -87,62 +90,220 @@ class DictIterClassifier(BaseEstimator, ClassifierMixin):
 
 class FMLP_DataClassifier(Data):
 
-    def __init__(self, clsf_params_dict = {}):
+    def __init__(self, clsf_params_dict = {}, n_jobs = 1, executor = None):
 
-        default_dict = {'random_state': 42}
+        seed_streams = self.data_dict['seed_streams']
         classifier_dict = {key: assign_list[2] for key, assign_list in self.data_dict['assignment_dict'].items()}
+
+        # cells on the same training set with the same classifier are fitted once, on the cell of the first balancer
+        sources = self.data_dict.get('training_sources', {})
+        first_bal_inds = {}
+        self.fit_cells = {}
+
+        for (i,j,k) in sorted(classifier_dict):
+            source = sources.get((i,j), (i,j))
+            self.fit_cells[(i,j,k)] = (i, first_bal_inds.setdefault((source, k), j), k)
         
-        classifier_dict = {key: (name, clsf(**clsf_params_dict[name]))
-                           if name in clsf_params_dict else (name, clsf(**default_dict))
-                           for key, (name, clsf) in classifier_dict.items()}
+        self.sources = {(i,j,k): sources.get((i,j), (i,j)) for (i,j,k) in classifier_dict}
+        self.duplicates = {}
+        for cell, fit_cell in self.fit_cells.items():
+            if cell != fit_cell:
+                self.duplicates.setdefault(fit_cell, []).append(cell)
+
+        # an explicit random_state in the parameter dict takes precedence over the derived one,
+        # classifiers without random_state (GaussianNB) only get their parameters
+        seeded = {name: accepts_random_state(resolve(clsf)) for (name, clsf) in classifier_dict.values()}
+
+        classifier_dict = {(i,j,k): (name, resolve(clsf)(**{**({'random_state': seed_streams.random_state('classify', *self.fit_cells[(i,j,k)])} 
+                                                                if seeded[name] else {}), 
+                                                             **clsf_params_dict.get(name, {})}))
+                           for (i,j,k), (name, clsf) in classifier_dict.items()}
         
         self.classifier_dict = classifier_dict
+        self.executor = CellExecutor(n_jobs) if executor is None else executor
 
+        if self.executor.uses_workers and self.storage is None:
+            raise ValueError("Parallel or isolated classification writes into shared arrays, set Data.storage to a SharedArrayStore first.")
 
+        # (i, j, k): (stage, JobFailure) of the cells whose job failed
+        self.failures = {}
 
-    def fit(self):
 
-        X = self.data_dict['bal_X_train']
-        y = self.data_dict['bal_y_train']
+
+    def fit(self, cells = None):
+        """
+        Fits the (i, j, k) cells given by cells, all cells of the grid if None.
+        """
+        cells = self.classifier_dict.keys() if cells is None else cells
+        fit_cells = {self.fit_cells[cell] for cell in cells}
         
-        for (i,j,k), (name, clsf) in self.classifier_dict.items():
-            
-            X_fit = X[i, j, :, :]
-            y_fit = y[i, j, :]
+        jobs_dict = {cell: (*self.training_refs(cell), clsf) for cell, (name, clsf) in self.classifier_dict.items() 
+                     if cell in fit_cells}
 
-            # Drop rows with NaN values
-            X_fit = X_fit[~np.isnan(X_fit).all(axis = 1)]
-            # Drop columns with NaN values
-            X_fit = X_fit[: , ~np.isnan(X_fit).all(axis = 0)]
-            
-            y_fit = y_fit[~np.isnan(y_fit)]
-            
-            self.classifier_dict[(i,j,k)] = (name, clsf.fit(X_fit, y_fit))
+        fitted_dict = self.executor.run(fit_job, jobs_dict)
+
+        self.update_classifiers(fitted_dict, 'fit')
+
+        for cell in fit_cells:
+            self.share_fit(cell, cells)
 
 
         return self
     
 
-    def predict(self):
+    def predict(self, cells = None):
+
+        cells = self.classifier_dict.keys() if cells is None else cells
+        fit_cells = {self.fit_cells[cell] for cell in cells}
+
+        refs = [self.array_ref(key) for key in ('org_X_test', 'clsf_predictions_y', 'clsf_predictions_proba', 'classes_order')]
+
+        jobs_dict = {(i,j,k): (*refs, i, j, k, clsf) for (i,j,k), (name, clsf) in self.classifier_dict.items()
+                     if (i,j,k) in fit_cells and (i,j,k) not in self.failures}
+
+        results_dict = self.executor.run(predict_job, jobs_dict)
+
+        self.failures.update({cell: ('predict', result) for cell, result in results_dict.items() if isinstance(result, JobFailure)})
+
+        for cell in fit_cells:
+            self.share_predictions(cell, cells)
+
+
+    def fit_predict(self, cells = None, callback = None):
+        """
+        Fits and predicts cell by cell, so that callback((i, j, k), fitted classifier) can be called
+        as soon as the predictions of a cell are written.
+        """
+        cells = self.classifier_dict.keys() if cells is None else cells
+        fit_cells = {self.fit_cells[cell] for cell in cells}
+
+        refs = [self.array_ref(key) for key in ('org_X_test', 'clsf_predictions_y', 'clsf_predictions_proba', 'classes_order')]
+        
+        jobs_dict = {(i,j,k): (*self.training_refs((i,j,k)), *refs, i, j, k, clsf) for (i,j,k), (name, clsf) in self.classifier_dict.items()
+                     if (i,j,k) in fit_cells}
+        
+        def shared_callback(cell, clsf):
+
+            self.update_classifiers({cell: clsf}, 'fit_predict')
+            self.share_fit(cell, cells)
+            self.share_predictions(cell, cells)
+
+            if callback is not None:
+                for callback_cell in [cell] + self.duplicates.get(cell, []):
+                    if callback_cell in cells:
+                        callback(callback_cell, clsf)
+
+        fitted_dict = self.executor.run(fit_predict_job, jobs_dict, callback = shared_callback)
+
+        # failed jobs do not reach the callback
+        failed_dict = {cell: clsf for cell, clsf in fitted_dict.items() if isinstance(clsf, JobFailure)}
+        self.update_classifiers(failed_dict, 'fit_predict')
+
+        for cell in failed_dict:
+            self.share_fit(cell, cells)
+
+        return self
+
+
+    def training_refs(self, cell):
+        """
+        Refs of the training arrays of a cell, the index of its training set in them 
+        and the ref and index of its sample weights, (None, None) for unweighted training sets.
+        """
+        source = self.sources[cell]
+
+        if len(source) == 1:
+            return (self.array_ref('org_X_train'), self.array_ref('org_y_train'), source, None, None)
+        
+        # virtually oversampled cells are fitted on the original rows with the weights of their resample
+        weights = self.data_dict.get('bal_weights')
+        if weights is not None and weights.lengths[source] > 0:
+            return (self.array_ref('org_X_train'), self.array_ref('org_y_train'), source[:1], self.array_ref('bal_weights'), source)
+
+        return (self.array_ref('bal_X_train'), self.array_ref('bal_y_train'), source, None, None)
+
+
+    def share_fit(self, fit_cell, cells):
+        """
+        Hands the fitted classifier or the failure of fit_cell to the cells of cells that duplicate it.
+        """
+        for cell in self.duplicates.get(fit_cell, []):
+
+            if cell not in cells:
+                continue
+
+            if fit_cell in self.failures:
+                self.failures[cell] = self.failures[fit_cell]
+            else:
+                self.classifier_dict[cell] = (self.classifier_dict[cell][0], self.classifier_dict[fit_cell][1])
+
+
+    def share_predictions(self, fit_cell, cells):
 
-        X = self.data_dict['org_X_test']
+        if fit_cell in self.failures:
+            self.share_fit(fit_cell, cells)
+            return
 
-        for (i,j,k), (name, clsf) in self.classifier_dict.items():
+        for cell in self.duplicates.get(fit_cell, []):
+            if cell in cells:
+                for key in ('clsf_predictions_y', 'clsf_predictions_proba', 'classes_order'):
+                    self.data_dict[key][cell] = self.data_dict[key][fit_cell]
+
+
+    def update_classifiers(self, fitted_dict, stage):
+
+        for (i,j,k), clsf in fitted_dict.items():
+
+            if isinstance(clsf, JobFailure):
+                self.failures[(i,j,k)] = (stage, clsf)
+                continue
             
-            X_test = X[i, :, :]
+            name = self.classifier_dict[(i,j,k)][0]
+            self.classifier_dict[(i,j,k)] = (name, clsf)
 
-            # Drop rows with NaN values
-            X_test = X_test[~np.isnan(X_test).all(axis = 1)]
-            # Drop columns with NaN values
-            X_test = X_test[: , ~np.isnan(X_test).all(axis = 0)]
 
-            n_i = len(X_test)
 
-            self.data_dict['clsf_predictions_y'][i, j, k, : n_i] = clsf.predict(X_test)
-            self.data_dict['clsf_predictions_proba'][i, j, k, : n_i, :] = clsf.predict_proba(X_test) 
-            self.data_dict['classes_order'][i, j, k, :] = clsf.classes_
 
+def fit_job(X_ref, y_ref, train_ind, weights_ref, weights_ind, clsf):
+    """
+    Fits a single (i, j, k) cell on its training data, segment train_ind of the arrays, and returns the fitted classifier.
+    Sample weights are passed as sample_weight, classifiers without that fit parameter get the rows repeated instead.
+    """
+    X_fit = resolve_array(X_ref)[train_ind]
+    y_fit = resolve_array(y_ref)[train_ind]
+
+    if weights_ref is None:
+        return clsf.fit(X_fit, y_fit)
     
+    sample_weight = resolve_array(weights_ref)[weights_ind]
+
+    if has_fit_parameter(clsf, 'sample_weight'):
+        return clsf.fit(X_fit, y_fit, sample_weight = sample_weight)
+    
+    repeats = sample_weight.astype(np.int64)
+
+    return clsf.fit(np.repeat(X_fit, repeats, axis = 0), np.repeat(y_fit, repeats))
+
+
+
+def predict_job(X_ref, y_pred_ref, proba_ref, classes_ref, i, j, k, clsf):
+    """
+    Predicts labels and probabilities of a single (i, j, k) cell and writes them into the prediction arrays.
+    """
+    X_test = resolve_array(X_ref)[i]
+
+    resolve_array(y_pred_ref)[i, j, k] = clsf.predict(X_test)
+    resolve_array(proba_ref)[i, j, k] = clsf.predict_proba(X_test) 
+    resolve_array(classes_ref)[i, j, k, :] = clsf.classes_
+
+
+
+def fit_predict_job(X_ref, y_ref, train_ind, weights_ref, weights_ind, X_test_ref, y_pred_ref, proba_ref, classes_ref, i, j, k, clsf):
+
+    clsf = fit_job(X_ref, y_ref, train_ind, weights_ref, weights_ind, clsf)
+    predict_job(X_test_ref, y_pred_ref, proba_ref, classes_ref, i, j, k, clsf)
+
+    return clsf
 
 
 
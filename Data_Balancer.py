@@ -1,4 +1,6 @@
-from helper_tools import Data
+from helper_tools import Data, accepts_random_state, resolve_array, stable_hash
+from Registry import resolve
+from Executor import CellExecutor, JobFailure
 import numpy as np
 
 class DataBalancer:
@@ -54,59 +56,210 @@ class DictIterDataBalancer:
 
 class FMLP_DataBalancer(Data):
 
-    def __init__(self, bal_params_dict = {}):
+    def __init__(self, bal_params_dict = {}, n_jobs = 1, cache = None, executor = None):
 
-        self.balancer_dict = {(i,j): assign_list[1] for (i,j,k), assign_list in self.data_dict['assignment_dict'].items()}
+        # registry entries are imported here, when the balancers are first used
+        self.balancer_dict = {(i,j): (name, resolve(balancer)) 
+                              for (i,j,k), (gen_dict, (name, balancer), clsf) in self.data_dict['assignment_dict'].items()}
         
-        default_dict = {'sampling_strategy': 'auto', 'random_state': 42}
+        default_dict = {'sampling_strategy': 'auto'}
         self.bal_params_dict = {name: bal_params_dict[name]
                                 if name in bal_params_dict else default_dict
                                 for (name, bal) in self.balancer_dict.values()}
         
+        self.seed_streams = self.data_dict['seed_streams']
+        
+        self.executor = CellExecutor(n_jobs) if executor is None else executor
+        self.cache = cache
+        
+        if self.executor.uses_workers and self.storage is None:
+            raise ValueError("Parallel or isolated balancing writes into shared arrays, set Data.storage to a SharedArrayStore first.")
+        
+        # cells with identical training sets are resampled, stored and fitted on once
+        self.sources = self.training_sources()
+        self.data_dict['training_sources'] = self.sources
         
 
-    def balance_data(self):
+    def training_sources(self):
+        """
+        Returns a dict (data_ind, bal_ind): index of the training set of the cell. (data_ind,) is the original training set
+        of org_X_train, used for a balancer None and for oversamplers that have no samples to generate.
+        Cells with the same balancer and parameters share the resample (data_ind, bal_ind) of the first of them.
+        """
+        y_train = self.data_dict['org_y_train']
+        sources = {}
+        first_cells = {}
 
-        X = self.data_dict['org_X_train']
-        y = self.data_dict['org_y_train']
+        for (data_ind, bal_ind), (name, balancer) in sorted(self.balancer_dict.items()):
 
-        for (data_ind, bal_ind), (name, balancer) in self.balancer_dict.items():
+            if is_identity(balancer, self.bal_params_dict[name], y_train[data_ind]):
+                sources[(data_ind, bal_ind)] = (data_ind,)
+                continue
 
-            #n_train, d_train = train_shape_list[data_ind]
+            signature = (data_ind, balancer, stable_hash(self.bal_params_dict[name]))
+            sources[(data_ind, bal_ind)] = first_cells.setdefault(signature, (data_ind, bal_ind))
 
-            X_bal = X[data_ind]
-            y_bal = y[data_ind]
-            #print("Original X shape: \n", np.shape(X_bal))
-            #print("Original y shape: \n", np.shape(y_bal))
-            #print("Original X: \n", X_bal[:5])
-            #print("Original y: \n", y_bal[:5])
-            
-            # Drop rows with NaN values
-            X_bal = X_bal[~np.isnan(X_bal).all(axis = 1)]
-            # Drop columns with NaN values
-            X_bal = X_bal[: , ~np.isnan(X_bal).all(axis = 0)]
-            y_bal = y_bal[~np.isnan(y_bal)]
-            #print("Filtered X shape: \n", np.shape(X_bal))
-            #print("Filtered y shape: \n", np.shape(y_bal))
-            #print("Filtered X: \n", X_bal[:5])
-            #print("Filtered y: \n", y_bal[:5])
+        return sources
+        
+        
 
+    def balance_data(self, cells = None, callback = None):
+        """
+        Resamples the (data_ind, bal_ind) cells given by cells, all cells of the grid if None.
+        Only cells that are their own training source are resampled, the others are read from their source.
+        Balancers with a fit_weights method (VirtualOverSampler) write bal_weights instead of bal_X_train, bal_y_train.
+        callback((data_ind, bal_ind), None) is called as soon as a cell is written.
+        Returns a dict (data_ind, bal_ind): JobFailure of the cells whose job failed.
+        """
+        cells = self.balancer_dict.keys() if cells is None else cells
+
+        refs = [self.array_ref(key) for key in ('org_X_train', 'org_y_train', 'bal_X_train', 'bal_y_train', 'bal_weights')]
+
+        # an explicit random_state in the parameter dict takes precedence over the derived one,
+        # balancers without random_state only get their parameters
+        seeded = {name: balancer is not None and accepts_random_state(balancer) for (name, balancer) in self.balancer_dict.values()}
+
+        jobs_dict = {(data_ind, bal_ind): (*refs, data_ind, bal_ind, balancer, 
+                                           {**({'random_state': self.seed_streams.random_state('balance', data_ind, bal_ind)} 
+                                               if seeded[name] else {}), 
+                                            **self.bal_params_dict[name]})
+                     for (data_ind, bal_ind), (name, balancer) in self.balancer_dict.items()
+                     if (data_ind, bal_ind) in cells and self.sources[(data_ind, bal_ind)] == (data_ind, bal_ind)}
+        
+        if self.cache is None:
+            results_dict = self.executor.run(balance_job, jobs_dict, callback = callback)
+            return self.collect_failures(results_dict)
+        
+        key_dict = self.cached_resamples(jobs_dict)
 
-            if balancer == None:
-                resample = (X_bal,y_bal)
+        if callback is not None:
+            for cell in jobs_dict.keys() - key_dict.keys():
+                callback(cell, None)
+        
+        results_dict = self.executor.run(balance_job, {cell: jobs_dict[cell] for cell in key_dict}, callback = callback)
+        failures = self.collect_failures(results_dict)
+
+        X_bal = self.data_dict['bal_X_train']
+        y_bal = self.data_dict['bal_y_train']
+        weights = self.data_dict['bal_weights']
+
+        for (data_ind, bal_ind), key in key_dict.items():
+            if (data_ind, bal_ind) in failures:
+                continue
 
+            if emits_weights(self.balancer_dict[(data_ind, bal_ind)][1]):
+                self.cache.store(key, {'weights': weights[data_ind, bal_ind]})
             else:
-                balancer = balancer(**self.bal_params_dict[name])
-                resample = balancer.fit_resample(X_bal, y_bal)
+                self.cache.store(key, {'X': X_bal[data_ind, bal_ind], 'y': y_bal[data_ind, bal_ind]})
+        
+        return failures
 
-            n, d = np.shape(resample[0])
-            #self.data_dict['bal_shape_dict'][(data_ind, bal_ind)] = (n, d)
-            #print(n, d)
-            
-            self.data_dict['bal_X_train'][data_ind, bal_ind, :n, :d] = resample[0]
-            self.data_dict['bal_y_train'][data_ind, bal_ind, :n] = resample[1]
 
+    def collect_failures(self, results_dict):
+        """
+        Failed cells of an executor run. Their segments are emptied, a killed job may have left them half written.
+        """
+        failures = {cell: result for cell, result in results_dict.items() if isinstance(result, JobFailure)}
+
+        for cell in failures:
+            for key in ('bal_X_train', 'bal_y_train', 'bal_weights'):
+                self.data_dict[key].lengths[cell] = 0
+        
+        return failures
+
+
+    def cached_resamples(self, jobs_dict):
+        """
+        Writes the cached resamples into bal_X_train, bal_y_train (or bal_weights) and returns a dict cell: cache key
+        of the cells that still have to be resampled.
+        """
+        X_train = self.data_dict['org_X_train']
+        y_train = self.data_dict['org_y_train']
+        X_bal = self.data_dict['bal_X_train']
+        y_bal = self.data_dict['bal_y_train']
+        weights = self.data_dict['bal_weights']
+        
+        # one fingerprint per training set, shared by all balancers of a dataset
+        fingerprints = {data_ind: self.cache.fingerprint(X_train[data_ind], y_train[data_ind]) 
+                        for data_ind in {data_ind for (data_ind, bal_ind) in jobs_dict}}
+        key_dict = {}
+        
+        for (data_ind, bal_ind), (*refs, _, _, balancer, bal_params) in jobs_dict.items():
+
+            key = self.cache.resample_key(fingerprints[data_ind], balancer, bal_params)
+            resample = self.cache.get(key)
+
+            if resample is None:
+                key_dict[(data_ind, bal_ind)] = key
+                continue
             
+            if 'weights' in resample:
+                weights[data_ind, bal_ind] = resample['weights']
+                continue
+
+            X_bal[data_ind, bal_ind] = resample['X']
+            y_bal[data_ind, bal_ind] = resample['y']
+
+        return key_dict
+
+
+
+
+def is_identity(balancer, bal_params, y):
+    """
+    True if the balancer returns the training set unchanged: no balancer or an oversampler
+    whose sampling strategy is already met by y, e.g. RandomOverSampler on balanced classes.
+    """
+    if balancer is None:
+        return True
+    
+    # imblearn is only loaded once a balancer is actually used
+    from imblearn.over_sampling.base import BaseOverSampler
+    from imblearn.utils import check_sampling_strategy
+
+    if not (isinstance(balancer, type) and issubclass(balancer, BaseOverSampler)):
+        return False
+    
+    try:
+        n_samples_dict = check_sampling_strategy(bal_params.get('sampling_strategy', 'auto'), y, 'over-sampling')
+    except ValueError:
+        # the job raises the same error for the cell
+        return False
+    
+    return not any(n_samples_dict.values())
+
+
+
+def emits_weights(balancer):
+    
+    return isinstance(balancer, type) and hasattr(balancer, 'fit_weights')
+
+
+
+def balance_job(X_ref, y_ref, X_bal_ref, y_bal_ref, weights_ref, data_ind, bal_ind, balancer, bal_params):
+    """
+    Resamples a single (data_ind, bal_ind) cell and writes it into the bal_X_train, bal_y_train arrays,
+    or its sample weights into bal_weights for a weighting balancer.
+    Module level so that it can be sent to worker processes, which attach to the arrays via their refs.
+    """
+    X_bal = resolve_array(X_ref)[data_ind]
+    y_bal = resolve_array(y_ref)[data_ind]
+    #print("Original X shape: \n", np.shape(X_bal))
+    #print("Original y shape: \n", np.shape(y_bal))
+
+    if emits_weights(balancer):
+        resolve_array(weights_ref)[data_ind, bal_ind] = balancer(**bal_params).fit_weights(X_bal, y_bal)
+        return
+
+    if balancer == None:
+        resample = (X_bal,y_bal)
+
+    else:
+        balancer = balancer(**bal_params)
+        resample = balancer.fit_resample(X_bal, y_bal)
+
+    resolve_array(X_bal_ref)[data_ind, bal_ind] = resample[0]
+    resolve_array(y_bal_ref)[data_ind, bal_ind] = resample[1]
 
 
 
@@ -270,5 +423,3 @@ if __name__=="__main__":
                                                         feature_map = feature_map,
                                                         title = f'Scatter of {name}-balanced data',
                                                         save = False)
-        
-        
\ No newline at end of file
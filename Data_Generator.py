@@ -2,8 +2,7 @@ import pandas as pd
 import numpy as np
 import scipy.stats as st
 import scipy.special as sp
-import plotly.express as px
-from sklearn.datasets import make_classification
+from functools import lru_cache
 from sklearn.model_selection import train_test_split
 from helper_tools import Data
 
@@ -16,7 +15,8 @@ class ImbalancedDataGenerator:
                  n_features=2, 
                  distance=1.0, 
                  #flip_y=0,
-                 test_size = 0.2
+                 test_size = 0.2,
+                 random_state = 123
                 ):
         """
         Initialize the ImbalancedDataGenerator.
@@ -32,7 +32,7 @@ class ImbalancedDataGenerator:
         self.n_samples = n_samples
         self.n_features = n_features
         self.distance = distance
-        self.random_state = 123
+        self.random_state = random_state
         #self.flip_y = flip_y
         self.test_size = test_size
 
@@ -50,6 +50,8 @@ class ImbalancedDataGenerator:
         - X (numpy array): Array of shape (n_samples, n_features) containing feature values.
         - y (numpy array): Array of shape (n_samples,) containing class labels.
         """
+        from sklearn.datasets import make_classification
+
         self.X, self.y = make_classification(
             n_samples=self.n_samples,
             n_features=self.n_features,
@@ -73,6 +75,8 @@ class ImbalancedDataGenerator:
 
     def plot_2d(self,feature1: int, feature2: int):
 
+        import plotly.express as px
+
         if self.X is None or self.y is None:
             raise ValueError("Data has not been generated yet. Call generate_data() method first.")
 
@@ -103,13 +107,137 @@ class ImbalancedDataGenerator:
 
 
 
+"""
+Batched sampling functions
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+def cov_factor(cov):
+    """
+    Returns a factor L with L @ L.T = cov. Factorisations are cached by the value of cov, 
+    so repeated datasets with the same covariance matrices only factorise once.
+    """
+    cov = np.asarray(cov, dtype = float)
+
+    return cached_factor(cov.shape, cov.tobytes())
+
+
+
+# least recently used factors are dropped beyond maxsize, a sweep over many covariances does not keep all of them
+@lru_cache(maxsize = 256)
+def cached_factor(shape, cov_bytes):
+
+    cov = np.frombuffer(cov_bytes).reshape(shape)
+
+    try:
+        return np.linalg.cholesky(cov)
+
+    except np.linalg.LinAlgError:
+        # singular positive semi-definite matrices are factorised via the eigendecomposition like in scipy
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        return eigvecs * np.sqrt(np.clip(eigvals, 0, None))
+
+
+
+def sample_components(dist, params_dict, comp, rng):
+    """
+    Draws one sample per entry of comp, which holds the mixture component of each row.
+    The values of params_dict are lists with the parameters of each component.
+
+    Multivariate normals are drawn from one block of standard normals with the cached covariance factors,
+    univariate scipy distributions in a single rvs call with the parameters broadcast over the rows.
+    Other distributions fall back to one frozen distribution per component.
+
+    Returns:
+    - samples (numpy array): Array of shape (len(comp), n_features).
+    """
+    n = len(comp)
+
+    if dist is st.multivariate_normal and set(params_dict) <= {'mean', 'cov'}:
+
+        means = [np.atleast_1d(np.asarray(mean, dtype = float)) for mean in params_dict['mean']]
+        d = len(means[0])
+        covs = params_dict.get('cov', [1.0 for _ in means])
+
+        # transform contiguous blocks of rows per component, unsorted components are scattered back afterwards
+        is_sorted = np.all(comp[:-1] <= comp[1:])
+        order = None if is_sorted else np.argsort(comp, kind = 'stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(comp, minlength = len(means)))])
+
+        samples = rng.standard_normal(size = (n, d))
+
+        for c in range(len(means)):
+
+            if bounds[c] == bounds[c+1]:
+                continue
+            
+            cov = np.asarray(covs[c], dtype = float)
+            if cov.ndim < 2:
+                cov = np.diag(np.broadcast_to(cov, (d,)))
+
+            block = samples[bounds[c]: bounds[c+1]]
+            block[...] = block @ cov_factor(cov).T
+            block += means[c]
+
+        if order is not None:
+            samples[order] = samples.copy()
+
+        return samples
+    
+    if isinstance(dist, (st.rv_continuous, st.rv_discrete)):
+
+        params = {key: np.asarray(value)[comp] for key, value in params_dict.items()}
+
+        return dist.rvs(**params, size = n, random_state = rng).reshape(n, -1)
+    
+    samples = None
+    for c in np.unique(comp):
+
+        mask = (comp == c)
+        frozen_dist = dist(**{key: value[c] for key, value in params_dict.items()})
+        comp_samples = frozen_dist.rvs(size = np.sum(mask), random_state = rng).reshape(np.sum(mask), -1)
+
+        if samples is None:
+            samples = np.empty(shape = (n, comp_samples.shape[1]))
+        samples[mask] = comp_samples
+
+    return samples
+
+
+
+def stratified_folds(y, n_folds):
+    """
+    Assigns every row to one of n_folds folds such that the rows of each class are spread evenly,
+    fold sizes and the class counts per fold differ by at most one. The rows are expected in random order.
+
+    Returns:
+    - folds (numpy array): int8 array of shape (len(y),) with the fold of every row.
+    """
+    if not 1 < n_folds <= np.iinfo(np.int8).max:
+        raise ValueError(f"n_folds has to be between 2 and {np.iinfo(np.int8).max}, got {n_folds}.")
+
+    classes, counts = np.unique(y, return_counts = True)
+    if counts.min() < n_folds:
+        raise ValueError(f"Class {classes[np.argmin(counts)]} has {counts.min()} rows, fewer than n_folds = {n_folds}.")
+
+    # dealing the rows of the classes one after another to the folds in turn keeps every class stratified
+    folds = np.empty(len(y), dtype = np.int8)
+    folds[np.argsort(y, kind = 'stable')] = np.arange(len(y)) % n_folds
+
+    return folds
+
+
+
+
+
+
 class Multi_Modal_Dist_Generator:
     
-    def __init__(self, distributions, params_dict_list, sizes, random_state = 1234):
+    def __init__(self, distributions, params_dict_list, sizes, random_state = 1234, seed = None):
         self.sizes = sizes
         self.dists = distributions
         self.params_dict_list = params_dict_list
         self.random_state = random_state
+        self.rng = np.random.default_rng(seed)
 
 
 
@@ -155,7 +283,7 @@ class Multi_Modal_Dist_Generator:
         self.y = np.concatenate( (y_c0, y_c1), axis = 0)
 
         # Generate a random permutation of indices
-        permuted_indices = np.random.permutation(len(self.X))
+        permuted_indices = self.rng.permutation(len(self.X))
 
         self.X = self.X[permuted_indices]
         self.y = self.y[permuted_indices]
@@ -166,24 +294,10 @@ class Multi_Modal_Dist_Generator:
 
         size = self.sizes[c_id]
 
-        k = modes
-
-        multinomial = st.multinomial(size, mixing_weights)
-        comp_sizes = multinomial.rvs(size = 1)[0]
-
-        acc_list = []
-
-        for i in range(k):
-
-            params = {key: value[i] for key, value in params_dict.items()}
-
-            frozen_dist = dist(**params)
+        comp_sizes = self.rng.multinomial(size, mixing_weights)
+        comp = np.repeat(np.arange(modes), comp_sizes)
 
-            acc_list.append(frozen_dist.rvs(size = comp_sizes[i]))
-
-        feature_samples = np.concatenate( acc_list, axis = 0)
-
-        feature_samples = feature_samples.reshape(size, -1)
+        feature_samples = sample_components(dist, params_dict, comp, self.rng)
 
         self.dists_sample_lists[f'c{c_id}'].append(feature_samples)
         
@@ -195,17 +309,16 @@ class Multi_Modal_Dist_Generator:
 
         k = len(next(iter(params_dict.values())))
 
-        sample_features_list = []
-
-        for i in range(k):
-
-            params = {key: value[i] for key, value in params_dict.items()}
+        comp = np.zeros(size, dtype = int)
 
-            frozen_dist = dist(**params)
+        if isinstance(dist, (st.rv_continuous, st.rv_discrete)) and all(np.ndim(value) == 1 for value in params_dict.values()):
+            # the k scalar parameter entries are k independent features, drawn as the columns of one call
+            params = {key: np.asarray(value) for key, value in params_dict.items()}
+            sample_features_list = [dist.rvs(**params, size = (size, k), random_state = self.rng)]
 
-            sample_features_list.append(frozen_dist.rvs(size = size))
-
-        sample_features_list = [sample.reshape(size, -1) for sample in sample_features_list]
+        else:
+            sample_features_list = [sample_components(dist, {key: [value[i]] for key, value in params_dict.items()}, comp, self.rng)
+                                    for i in range(k)]
 
         self.dists_sample_lists[f'c{c_id}'].extend(sample_features_list)
 
@@ -231,15 +344,22 @@ class Multi_Modal_Dist_Generator:
 
 class FMLP_Generator(Data):
     
-    def __init__(self, distributions, params_dict_list, sizes, gen_index, random_state = 1234):
+    def __init__(self, distributions, params_dict_list, sizes, gen_index, random_state = None, seed = None):
         self.sizes = sizes
         self.dists = distributions
         self.params_dict_list = params_dict_list
         self.gen_index = gen_index
-        self.random_state = random_state
+        
+        # seed can be a SeedSequence handed out by SeedStreams, all randomness of the generator derives from it
+        self.seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_seq)
+        self.random_state = random_state if random_state is not None else int(self.seed_seq.generate_state(1)[0])
 
 
-    def create_data(self):
+    def create_data(self, sizes = None, rng = None):
+
+        sizes = self.sizes if sizes is None else sizes
+        rng = self.rng if rng is None else rng
         
         self.dists_sample_lists = {'c0': [], 'c1': []}
         
@@ -254,87 +374,162 @@ class FMLP_Generator(Data):
                                                     dist = self.dists[l], 
                                                     params_dict = parameters_dict[f'params_c{i}'], 
                                                     modes = modes, 
-                                                    mixing_weights = parameters_dict[f'mixing_weights_c{i}'])
+                                                    mixing_weights = parameters_dict[f'mixing_weights_c{i}'],
+                                                    size = sizes[i],
+                                                    rng = rng)
 
                 else:
                     self.create_unimodal_features(c_id = i, 
                                                   dist = self.dists[l], 
-                                                  params_dict = parameters_dict[f'params_c{i}'] )
+                                                  params_dict = parameters_dict[f'params_c{i}'],
+                                                  size = sizes[i],
+                                                  rng = rng)
         
         # if len(array.shape)==2 else array.reshape(-1, 1) 
         self.dists_sample_lists = {key: [array for array in sample_features_list]
                                    for key, sample_features_list in self.dists_sample_lists.items()}
         
-        X_c0 = np.concatenate(self.dists_sample_lists['c0'], axis = 1)
-        X_c1 = np.concatenate(self.dists_sample_lists['c1'], axis = 1)
+        # features and labels are drawn into the dtypes of the data_dict arrays, so the copies of the split are no larger than the stored data
+        X_c0 = np.concatenate(self.dists_sample_lists['c0'], axis = 1, dtype = self.dtypes['features'])
+        X_c1 = np.concatenate(self.dists_sample_lists['c1'], axis = 1, dtype = self.dtypes['features'])
         #print('Class 1: \n', X_c1)
         #print('Class 1 shape: \n', np.shape(X_c1))
         #print('Class 0: \n', X_c0)
         #print('Class 0 shape: \n', np.shape(X_c0))
 
-        y_c0 = np.zeros(self.sizes[0])
-        y_c1 = np.ones(self.sizes[1])
+        y_c0 = np.zeros(sizes[0], dtype = self.dtypes['labels'])
+        y_c1 = np.ones(sizes[1], dtype = self.dtypes['labels'])
 
         self.X = np.concatenate( (X_c0, X_c1), axis = 0)
         self.y = np.concatenate( (y_c0, y_c1), axis = 0)
 
         # Generate a random permutation of indices
-        permuted_indices = np.random.permutation(len(self.X))
+        permuted_indices = rng.permutation(len(self.X))
 
         self.X = self.X[permuted_indices]
         self.y = self.y[permuted_indices]
                 
 
 
-    def create_multimodal_features(self, c_id, dist, params_dict, modes, mixing_weights):
+    def create_multimodal_features(self, c_id, dist, params_dict, modes, mixing_weights, size, rng):
 
-        size = self.sizes[c_id]
+        comp_sizes = rng.multinomial(size, mixing_weights)
+        comp = np.repeat(np.arange(modes), comp_sizes)
 
-        k = modes
+        feature_samples = sample_components(dist, params_dict, comp, rng)
 
-        multinomial = st.multinomial(size, mixing_weights)
-        comp_sizes = multinomial.rvs(size = 1)[0]
+        self.dists_sample_lists[f'c{c_id}'].append(feature_samples)
+        
 
-        acc_list = []
 
-        for i in range(k):
+    def create_unimodal_features(self, c_id, dist, params_dict, size, rng):
 
-            params = {key: value[i] for key, value in params_dict.items()}
+        k = len(next(iter(params_dict.values())))
 
-            frozen_dist = dist(**params)
+        comp = np.zeros(size, dtype = int)
 
-            acc_list.append(frozen_dist.rvs(size = comp_sizes[i]))
+        if isinstance(dist, (st.rv_continuous, st.rv_discrete)) and all(np.ndim(value) == 1 for value in params_dict.values()):
+            # the k scalar parameter entries are k independent features, drawn as the columns of one call
+            params = {key: np.asarray(value) for key, value in params_dict.items()}
+            sample_features_list = [dist.rvs(**params, size = (size, k), random_state = rng)]
 
-        feature_samples = np.concatenate( acc_list, axis = 0)
-        feature_samples = feature_samples.reshape(size, -1)
+        else:
+            sample_features_list = [sample_components(dist, {key: [value[i]] for key, value in params_dict.items()}, comp, rng)
+                                    for i in range(k)]
 
-        self.dists_sample_lists[f'c{c_id}'].append(feature_samples)
-        
+        self.dists_sample_lists[f'c{c_id}'].extend(sample_features_list)
 
+            
+    
+    def iter_chunks(self, chunk_size):
+        """
+        Generates the dataset as consecutive blocks of chunk_size rows (the last one may be smaller).
+        The class counts of each block are drawn as if the rows of the full dataset were permuted,
+        every block has its own random stream, so the blocks are reproducible for a given seed and chunk_size.
 
-    def create_unimodal_features(self, c_id, dist, params_dict):
+        Yields:
+        - X_block (numpy array): Array of shape (chunk_size, n_features).
+        - y_block (numpy array): Array of shape (chunk_size,).
+        """
+        remaining = np.array(self.sizes, dtype = np.int64)
+        n_chunks = int(np.ceil(remaining.sum() / chunk_size))
 
-        size = self.sizes[c_id]
+        for c in range(n_chunks):
 
-        k = len(next(iter(params_dict.values())))
+            chunk_seq = np.random.SeedSequence(self.seed_seq.entropy, spawn_key = self.seed_seq.spawn_key + (c,))
+            rng = np.random.default_rng(chunk_seq)
+
+            chunk_sizes = rng.multivariate_hypergeometric(remaining, min(chunk_size, remaining.sum()))
+            remaining -= chunk_sizes
 
-        sample_features_list = []
+            self.create_data(chunk_sizes, rng)
 
-        for i in range(k):
+            yield self.X, self.y
 
-            params = {key: value[i] for key, value in params_dict.items()}
+        self.X, self.y = None, None
 
-            frozen_dist = dist(**params)
+    
 
-            sample_features_list.append(frozen_dist.rvs(size = size))
+    def prepare_data_chunked(self, test_size, chunk_size):
+        """
+        Writes the blocks of iter_chunks straight into the preallocated org_ arrays, 
+        so peak memory is bounded by chunk_size instead of the dataset size.
+        The rows are exchangeable, hence the first rows form the training and the remaining ones the test set.
+        """
+        n = sum(self.sizes)
+        n_test = int(np.ceil(test_size*n))
+        n_train = n - n_test
 
-        sample_features_list = [sample.reshape(size, -1) for sample in sample_features_list]
+        X_train = self.data_dict['org_X_train'].reserve(self.gen_index, n_train)
+        y_train = self.data_dict['org_y_train'].reserve(self.gen_index, n_train)
 
-        self.dists_sample_lists[f'c{c_id}'].extend(sample_features_list)
+        X_test = self.data_dict['org_X_test'].reserve(self.gen_index, n_test)
+        y_test = self.data_dict['org_y_test'].reserve(self.gen_index, n_test)
+
+        start = 0
+        for X_block, y_block in self.iter_chunks(chunk_size):
+
+            stop = start + len(y_block)
+            split = min(max(n_train - start, 0), len(y_block))
+
+            X_train[start: start + split] = X_block[:split]
+            y_train[start: start + split] = y_block[:split]
+
+            X_test[start + split - n_train: stop - n_train] = X_block[split:]
+            y_test[start + split - n_train: stop - n_train] = y_block[split:]
 
+            start = stop
+
+
+    def prepare_folds(self, n_folds):
+        """
+        Writes the dataset in the order of its stratified folds into org_X, org_y and the int8 fold index into folds.
+        The fold splits are read through FoldView, no training or test set is copied.
+        """
+        self.create_data()
+
+        folds = stratified_folds(self.y, n_folds)
+        order = np.argsort(folds, kind = 'stable')
+
+        self.data_dict['org_X'][self.gen_index] = self.X[order]
+        self.data_dict['org_y'][self.gen_index] = self.y[order]
+        self.data_dict['folds'][self.gen_index] = folds[order]
+
+        self.X, self.y = None, None
+
+
+    def prepare_data(self, test_size = 0.2, chunk_size = None, n_folds = None):
+
+        if n_folds is not None:
+            if chunk_size is not None:
+                raise ValueError("Folds are assigned over the whole dataset and cannot be combined with chunk_size.")
             
-    
-    def prepare_data(self, test_size = 0.2):
+            self.prepare_folds(n_folds)
+            return
+
+        if chunk_size is not None:
+            self.prepare_data_chunked(test_size, chunk_size)
+            return
         
         self.create_data()
         
@@ -345,15 +540,11 @@ class FMLP_Generator(Data):
                                                             random_state=self.random_state
                                                             )
         
-        n_train, d = np.shape(X_train)
-        n_test = np.shape(y_test)[0]
-        #print(n_train, d, n_test)
+        self.data_dict['org_X_train'][self.gen_index] = X_train
+        self.data_dict['org_y_train'][self.gen_index] = y_train
 
-        self.data_dict['org_X_train'][self.gen_index, :n_train, :d] = X_train
-        self.data_dict['org_y_train'][self.gen_index, :n_train] = y_train
-
-        self.data_dict['org_X_test'][self.gen_index, :n_test, :d] = X_test
-        self.data_dict['org_y_test'][self.gen_index, :n_test] = y_test
+        self.data_dict['org_X_test'][self.gen_index] = X_test
+        self.data_dict['org_y_test'][self.gen_index] = y_test
 
 
 
@@ -485,6 +676,50 @@ if __name__ == "__main__":
     """
 
 
+    """
+    Benchmark batched sampling against per component scipy sampling
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    
+    import time
+    from gen_parameters import alt_experiment_dict
+
+    def scipy_per_component(dist, params_dict, size, modes, mixing_weights):
+        comp_sizes = st.multinomial(size, mixing_weights).rvs(size = 1)[0]
+        acc_list = [dist(**{key: value[i] for key, value in params_dict.items()}).rvs(size = comp_sizes[i]) 
+                    for i in range(modes)]
+        return np.concatenate(acc_list, axis = 0).reshape(size, -1)
+
+    params_dict = alt_experiment_dict['params_dict_list'][0]
+    rng = np.random.default_rng(1234)
+
+    for size in [10**6, 2*10**6, 5*10**6]:
+
+        start_time = time.perf_counter()
+        scipy_per_component(st.multivariate_normal, params_dict['params_c0'], size, 2, params_dict['mixing_weights_c0'])
+        scipy_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        comp = np.repeat(np.arange(2), rng.multinomial(size, params_dict['mixing_weights_c0']))
+        sample_components(st.multivariate_normal, params_dict['params_c0'], comp, rng)
+        batched_time = time.perf_counter() - start_time
+
+        print(f'{size} samples: scipy {scipy_time:.3f}s, batched {batched_time:.3f}s, speed-up {scipy_time/batched_time:.2f}')
+
+    start_time = time.perf_counter()
+    for _ in range(1000):
+        scipy_per_component(st.multivariate_normal, params_dict['params_c0'], 1000, 2, params_dict['mixing_weights_c0'])
+    scipy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(1000):
+        comp = np.repeat(np.arange(2), rng.multinomial(1000, params_dict['mixing_weights_c0']))
+        sample_components(st.multivariate_normal, params_dict['params_c0'], comp, rng)
+    batched_time = time.perf_counter() - start_time
+
+    print(f'1000 calls of 1000 samples: scipy {scipy_time:.3f}s, batched {batched_time:.3f}s, speed-up {scipy_time/batched_time:.2f}')
+    """
+
+
     """
     Presentation - Data illustration
     -------------------------------------------------------------------------------------------------------------------------------------------
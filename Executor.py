@@ -0,0 +1,223 @@
+import os
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from Instrumentation import timed_call
+
+try:
+    import resource
+except ImportError:
+    # no address space limits on Windows, max_memory is ignored there
+    resource = None
+
+
+
+
+class JobFailure():
+
+    def __init__(self, reason, message = ''):
+        """
+        Result of a job that did not finish.
+
+        Parameters:
+        - reason (str): 'error' for an exception, 'memory' for a MemoryError,
+          'timeout' if the job was killed after the wall-clock timeout, 'crashed' if the worker died.
+        - message (str): Exception or exit code of the worker.
+        """
+        self.reason = reason
+        self.message = message
+
+
+    def __repr__(self):
+        return f'JobFailure({self.reason!r}, {self.message!r})'
+
+
+
+
+class CellExecutor():
+
+    def __init__(self, n_jobs = 1, timeout = None, max_memory = None, isolate = False, instrumentation = None):
+        """
+        Executes independent grid jobs either serially or over a pool of processes.
+        A job that raises yields a JobFailure as its result in every mode, so one failing cell does not abort the grid.
+        Isolating every job in its own process is opt-in, it is only needed for timeouts, the memory cap and crashing workers.
+
+        Parameters:
+        - n_jobs (int): Number of worker processes. 1 runs every job in the calling process,
+          None or a negative value uses all available cores.
+        - timeout (float or None): Wall-clock limit in seconds per job, implies isolate.
+        - max_memory (int or None): Address space limit in bytes per job, implies isolate.
+          The worker inherits the address space of the calling process, hence the cap has to include it.
+        - isolate (bool): Runs every job in its own process. A hanging or crashing job
+          then yields a JobFailure as its result as well instead of aborting the run.
+        - instrumentation (Instrumentation or None): Receives wall time, CPU time and peak RSS of every job,
+          measured in the process that runs it. The stage is the job function name without '_job'.
+        """
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count()
+
+        self.n_jobs = n_jobs
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.isolate = isolate or timeout is not None or max_memory is not None
+        self.instrumentation = instrumentation
+
+
+    @property
+    def uses_workers(self):
+        return self.n_jobs != 1 or self.isolate
+
+
+    def run(self, func, jobs_dict, callback = None):
+        """
+        Calls func(*args) for every (key, args) pair of jobs_dict and returns a dictionary key: result.
+        The jobs are independent of each other, the results are collected as they finish and
+        the caller writes them back in its own (deterministic) key order.
+        callback(key, result) is called in the calling process as soon as a job has finished.
+        """
+        if self.instrumentation is None:
+            return self.run_jobs(func, jobs_dict, callback)
+        
+        stage = func.__name__.replace('_job', '')
+
+        def unwrap(key, timed_result):
+            if isinstance(timed_result, JobFailure):
+                return timed_result
+            
+            result, record = timed_result
+            self.instrumentation.add(stage, key, record)
+            return result
+        
+        timed_callback = None if callback is None else (lambda key, timed_result: callback(key, unwrap(key, timed_result)))
+        timed_results = self.run_jobs(timed_call, {key: (func, args) for key, args in jobs_dict.items()}, timed_callback)
+
+        return {key: unwrap(key, timed_result) for key, timed_result in timed_results.items()}
+
+
+    def run_jobs(self, func, jobs_dict, callback = None):
+
+        if self.isolate:
+            return self.run_isolated(func, jobs_dict, callback)
+
+        results_dict = {}
+
+        if self.n_jobs == 1 or len(jobs_dict) <= 1:
+            for key, args in jobs_dict.items():
+                results_dict[key] = guarded_call(func, args)
+                if callback is not None and not isinstance(results_dict[key], JobFailure):
+                    callback(key, results_dict[key])
+
+            return results_dict
+
+        with ProcessPoolExecutor(max_workers = min(self.n_jobs, len(jobs_dict))) as pool:
+
+            future_dict = {pool.submit(guarded_call, func, args): key for key, args in jobs_dict.items()}
+
+            for future in as_completed(future_dict):
+                key = future_dict[future]
+
+                # exceptions of the job come back as JobFailure, these are those of the pool, e.g. a dead worker
+                try:
+                    results_dict[key] = future.result()
+                except BrokenProcessPool as e:
+                    results_dict[key] = JobFailure('crashed', f'{type(e).__name__}: {e}')
+                except Exception as e:
+                    results_dict[key] = JobFailure('error', f'{type(e).__name__}: {e}')
+
+                if callback is not None and not isinstance(results_dict[key], JobFailure):
+                    callback(key, results_dict[key])
+
+        return results_dict
+
+
+    def run_isolated(self, func, jobs_dict, callback = None):
+        """
+        Runs every job in a fresh process, at most n_jobs at a time. Jobs over the timeout are killed.
+        Failed jobs get a JobFailure as result, the callback is only called for finished jobs.
+        """
+        context = multiprocessing.get_context()
+        pending = list(jobs_dict.items())
+        running = {}
+        results_dict = {}
+
+        while pending or running:
+
+            while pending and len(running) < self.n_jobs:
+
+                key, args = pending.pop(0)
+                receiver, sender = context.Pipe(duplex = False)
+                process = context.Process(target = isolated_job, args = (sender, func, args, self.max_memory), daemon = True)
+                process.start()
+                sender.close()
+
+                running[receiver] = (key, process, time.monotonic())
+
+            wait_time = None
+            if self.timeout is not None:
+                first_start = min(start_time for (key, process, start_time) in running.values())
+                wait_time = max(0, first_start + self.timeout - time.monotonic())
+
+            for receiver in wait(list(running), timeout = wait_time):
+
+                key, process, start_time = running.pop(receiver)
+
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    process.join()
+                    result = JobFailure('crashed', f'worker exited with code {process.exitcode}')
+
+                receiver.close()
+                process.join()
+                results_dict[key] = result
+
+                if callback is not None and not isinstance(result, JobFailure):
+                    callback(key, result)
+
+            if self.timeout is None:
+                continue
+
+            for receiver, (key, process, start_time) in list(running.items()):
+
+                if time.monotonic() - start_time > self.timeout:
+                    process.kill()
+                    process.join()
+                    receiver.close()
+                    running.pop(receiver)
+                    results_dict[key] = JobFailure('timeout', f'killed after {self.timeout}s')
+
+        return results_dict
+
+
+
+
+def guarded_call(func, args):
+    """
+    Calls func(*args) and returns its result, or a JobFailure if it raises.
+    """
+    try:
+        return func(*args)
+    except MemoryError as e:
+        return JobFailure('memory', f'MemoryError: {e}')
+    except Exception as e:
+        return JobFailure('error', f'{type(e).__name__}: {e}')
+
+
+
+def isolated_job(sender, func, args, max_memory):
+    """
+    Entry point of an isolated worker: applies the memory cap, runs the job and sends back its result or a JobFailure.
+    """
+    if max_memory is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+    result = guarded_call(func, args)
+
+    try:
+        sender.send(result)
+    except Exception as e:
+        sender.send(JobFailure('error', f'result could not be sent: {type(e).__name__}: {e}'))
+
+    sender.close()
@@ -3,17 +3,12 @@ import numpy as np
 import sys
 
 from loguru import logger
-from imblearn.over_sampling import ADASYN, RandomOverSampler, KMeansSMOTE, SMOTE, BorderlineSMOTE, SVMSMOTE, SMOTENC, RandomOverSampler
-from sklearn.linear_model import LogisticRegression
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
-from sklearn.naive_bayes import GaussianNB
-from xgboost import XGBClassifier
-from lightgbm import LGBMClassifier
 
+import Registry
 from Assessors import Assessor
 from Metrics import FMLP_Metrics
+from Caching import DatasetCache, ResampleCache
+from Results_Store import ResultsStore
 from gen_parameters import presentation_experiment_dict
 from helper_tools import extract_table_info, create_simple_normal_dict_list
 
@@ -26,23 +21,24 @@ Methods
 """
 balancing_methods = {
 "Unbalanced": None,
-"ADASYN": ADASYN,
-"RandomOverSampler": RandomOverSampler,
-"KMeansSMOTE": KMeansSMOTE,
-"SMOTE": SMOTE,
-"BorderlineSMOTE": BorderlineSMOTE,
-"SVMSMOTE": SVMSMOTE,
-#"SMOTENC": SMOTENC,
+"ADASYN": Registry.balancers["ADASYN"],
+"RandomOverSampler": Registry.balancers["RandomOverSampler"],
+"KMeansSMOTE": Registry.balancers["KMeansSMOTE"],
+"SMOTE": Registry.balancers["SMOTE"],
+"BorderlineSMOTE": Registry.balancers["BorderlineSMOTE"],
+"SVMSMOTE": Registry.balancers["SVMSMOTE"],
+#"SMOTENC": Registry.balancers["SMOTENC"],
+#"FastSMOTE": Registry.balancers["FastSMOTE"],
 }
 
 classifiers_dict = {
-    "Logistic Regression": LogisticRegression,
-    "Decision Tree": DecisionTreeClassifier,
-    "Random Forest": RandomForestClassifier,
-    #"SVC": SVC,
-    #"Naive Bayes": GaussianNB,
-    "XGboost": XGBClassifier,
-    "Lightgbm": LGBMClassifier
+    "Logistic Regression": Registry.classifiers["Logistic Regression"],
+    "Decision Tree": Registry.classifiers["Decision Tree"],
+    "Random Forest": Registry.classifiers["Random Forest"],
+    #"SVC": Registry.classifiers["SVC"],
+    #"Naive Bayes": Registry.classifiers["Naive Bayes"],
+    "XGboost": Registry.classifiers["XGboost"],
+    "Lightgbm": Registry.classifiers["Lightgbm"]
 }
 
 
@@ -62,32 +58,32 @@ Class distance
 -------------------------------------------------------------------------------------------------------------------------------------------
 
 
-for distance in class_distance_list[6:]:
+dataset_cache = DatasetCache('Dataset_Cache', max_bytes = 20 * 2**30)
+resample_cache = ResampleCache('Resample_Cache', max_bytes = 20 * 2**30)
+
+results_store = ResultsStore('Experiments/results.db', 'cls_dist_std_mv_normal')
+if not results_store.exists():
+    results_store.import_csv('Experiments/cls_dist_std_mv_normal.csv')
 
-    results_df = pd.read_csv('Experiments/cls_dist_std_mv_normal.csv', index_col=0)
-    #print(results_df)
+for distance in class_distance_list[6:]:
 
     gen_dict_list = create_simple_normal_dict_list(n_samples_list[1:2], n_features_list[:2], class_ratio_list[:2], [distance])
     print([extract_table_info(gen_dict) for gen_dict in gen_dict_list])
 
-    assessor = Assessor(0.2, gen_dict_list, balancing_methods, classifiers_dict)
+    assessor = Assessor(0.2, gen_dict_list, balancing_methods, classifiers_dict, seed = 42)
 
-    assessor.generate()
-    assessor.balance()
+    assessor.generate(cache = dataset_cache)
+    assessor.balance(cache = resample_cache)
     assessor.clsf_pred()
 
     new_results_df = assessor.calc_std_metrics()
     
-    new_results_df['cluster distance'] = [distance for _ in range(len(new_results_df))]
-
-    
     #print(new_results_df)
-    results_df = pd.concat([results_df, new_results_df],
-                           ignore_index=True,
-                           axis = 0).reset_index(drop=True)
+    # a rerun of a distance replaces its rows
+    results_store.delete(filters = {'cluster distance': distance})
+    results_store.append(new_results_df, constant_columns = {'cluster distance': distance})
     
-    print(results_df)
-    results_df.to_csv('Experiments/cls_dist_std_mv_normal.csv')
+    print(results_store.read(filters = {'cluster distance': distance}))
 
 """
 
@@ -98,23 +94,23 @@ Presentation Experiment
 """
 balancing_methods = {
 "Unbalanced": None,
-"ADASYN": ADASYN,
-"RandomOverSampler": RandomOverSampler,
-"KMeansSMOTE": KMeansSMOTE,
-"SMOTE": SMOTE,
-"BorderlineSMOTE": BorderlineSMOTE,
-"SVMSMOTE": SVMSMOTE,
-#"SMOTENC": SMOTENC,
+"ADASYN": Registry.balancers["ADASYN"],
+"RandomOverSampler": Registry.balancers["RandomOverSampler"],
+"KMeansSMOTE": Registry.balancers["KMeansSMOTE"],
+"SMOTE": Registry.balancers["SMOTE"],
+"BorderlineSMOTE": Registry.balancers["BorderlineSMOTE"],
+"SVMSMOTE": Registry.balancers["SVMSMOTE"],
+#"SMOTENC": Registry.balancers["SMOTENC"],
 }
 
 classifiers_dict = {
-"Logistic Regression": LogisticRegression,
-"Decision Tree": DecisionTreeClassifier,
-"Random Forest": RandomForestClassifier,
-#"SVC": SVC,
-#"Naive Bayes": GaussianNB,
-"XGboost": XGBClassifier,
-"Lightgbm": LGBMClassifier
+"Logistic Regression": Registry.classifiers["Logistic Regression"],
+"Decision Tree": Registry.classifiers["Decision Tree"],
+"Random Forest": Registry.classifiers["Random Forest"],
+#"SVC": Registry.classifiers["SVC"],
+#"Naive Bayes": Registry.classifiers["Naive Bayes"],
+"XGboost": Registry.classifiers["XGboost"],
+"Lightgbm": Registry.classifiers["Lightgbm"]
 }
 
 assessor = Assessor(0.2, [presentation_experiment_dict], balancing_methods, classifiers_dict)
@@ -124,9 +124,13 @@ class Hypothesis_T_Test:
         self.test_combination_classifiers = test_combination_classifiers
         self.alpha = 0.05
 
-    def load_data(self, file_path):
-        # Load the data from the CSV file
-        self.data = pd.read_csv(file_path)
+    def load_data(self, file_path = None, results_store = None):
+        # Load the data from the CSV file or only the tested columns from a ResultsStore
+        if results_store is None:
+            self.data = pd.read_csv(file_path)
+            return
+
+        self.data = results_store.read(columns = [self.column_bal, self.column_clas, *self.target_list])
 
     def perform_t_tests(self):
         results = []
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = None
+
+
+
+
+def current_rss():
+    """
+    Resident set size of the current process in bytes. Where /proc is not available the lifetime peak
+    of getrusage is the best estimate, NaN on platforms without either.
+    """
+    if PAGE_SIZE is not None:
+        try:
+            with open('/proc/self/statm') as file:
+                return int(file.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            pass
+
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    return np.nan
+
+
+
+class PeakRSSMonitor(threading.Thread):
+
+    def __init__(self, interval = 0.005):
+        """
+        Background thread sampling the resident set size, as the lifetime peak of getrusage
+        cannot be attributed to a single call in a long lived worker.
+        """
+        super().__init__(daemon = True)
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+        return max(self.peak, current_rss())
+
+
+
+@contextmanager
+def measure(record):
+    """
+    Fills the dict record with wall time, CPU time (all threads of the process),
+    peak RSS and RSS increase of the enclosed code.
+    """
+    rss_start = current_rss()
+    monitor = PeakRSSMonitor()
+    monitor.start()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield record
+
+    finally:
+        record['wall_time'] = time.perf_counter() - wall_start
+        record['cpu_time'] = time.process_time() - cpu_start
+        record['peak_rss'] = monitor.stop()
+        record['rss_increase'] = record['peak_rss'] - rss_start
+
+
+
+def timed_call(func, args):
+    """
+    Job wrapper of an instrumented CellExecutor, measures func(*args) in the process that runs it.
+    """
+    record = {'pid': os.getpid()}
+
+    with measure(record):
+        result = func(*args)
+
+    return (result, record)
+
+
+
+def tensor_bytes(data_dict, stage, cell):
+    """
+    Bytes of the data_dict tensors a call produced (generate, balance, predict) or fitted on (fit).
+    """
+    def nbytes(keys, key_cell):
+        return sum(data_dict[key][key_cell].nbytes for key in keys if key in data_dict)
+
+    if stage == 'generate':
+        # K-fold runs store every dataset once with its fold index
+        if 'folds' in data_dict:
+            return nbytes(['org_X', 'org_y', 'folds'], cell)
+        
+        return nbytes(['org_X_train', 'org_y_train', 'org_X_test', 'org_y_test'], cell)
+
+    # cells without own resample are fitted on the training set of their source
+    source = data_dict.get('training_sources', {}).get(tuple(cell[:2]), tuple(cell[:2]))
+    training_keys = ['org_X_train', 'org_y_train'] if len(source) == 1 else ['bal_X_train', 'bal_y_train', 'bal_weights']
+    training_bytes = nbytes(training_keys, source)
+
+    if stage == 'balance':
+        return training_bytes
+
+    prediction_bytes = nbytes(['clsf_predictions_y', 'clsf_predictions_proba'], cell)
+
+    return {'fit': training_bytes,
+            'predict': prediction_bytes,
+            'fit_predict': training_bytes + prediction_bytes}.get(stage, np.nan)
+
+
+
+
+class Instrumentation():
+
+    def __init__(self):
+        """
+        Measurements of every generator, balancer, fit and predict call of an Assessor,
+        keyed by (stage, cell) with cell (i,), (i, j) or (i, j, k).
+        """
+        self.records = {}
+
+
+    def add(self, stage, cell, record):
+        self.records[(stage, tuple(cell))] = record
+
+
+    @contextmanager
+    def measure(self, stage, cell):
+
+        record = {'pid': os.getpid()}
+
+        with measure(record):
+            yield record
+
+        self.add(stage, cell, record)
+
+
+    def to_frame(self, data_dict):
+        """
+        All records as a DataFrame with columns stage, i, j, k, the measurements and tensor_bytes.
+        """
+        rows = []
+        for (stage, cell), record in self.records.items():
+
+            i, j, k = (tuple(cell) + (None, None))[:3]
+            rows.append({'stage': stage, 'i': i, 'j': j, 'k': k, **record,
+                         'tensor_bytes': tensor_bytes(data_dict, stage, cell)})
+
+        return pd.DataFrame(rows, columns = ['stage', 'i', 'j', 'k', 'wall_time', 'cpu_time', 'peak_rss', 'rss_increase',
+                                             'tensor_bytes', 'pid'])
+
+
+    def cell_times(self, exp_dim, n_folds = 1):
+        """
+        Wall time of every stage attributed to the (i, j, k) cells, rows in the order of calc_std_metrics.
+        Generation and balancing times are shared by all cells of their dataset and training set,
+        with n_folds grid rows i*n_folds + f generated together as dataset i.
+        """
+        stages = sorted({stage for (stage, cell) in self.records})
+        times = pd.DataFrame(np.nan, index = range(int(np.prod(exp_dim))), columns = [f'{stage} wall_time' for stage in stages])
+
+        for row, cell in enumerate(np.ndindex(exp_dim)):
+            for stage in stages:
+
+                for stage_cell in ((cell[0] // n_folds,) if stage == 'generate' else cell[:1], cell[:2], cell):
+                    if (stage, stage_cell) in self.records:
+                        times.loc[row, f'{stage} wall_time'] = self.records[(stage, stage_cell)]['wall_time']
+
+        return times
+
+
+    def slowest_cells(self, data_dict, n = 10, by = 'wall_time'):
+        """
+        Report of the n slowest calls with the names of their dataset, balancer and classifier.
+        """
+        records_df = self.to_frame(data_dict)
+        assignment_dict = data_dict['assignment_dict']
+
+        def names(row):
+            cell = tuple(int(ind) for ind in (row['i'], row['j'], row['k']) if pd.notna(ind))
+            assign_list = next(assign_list for key, assign_list in assignment_dict.items() if key[:len(cell)] == cell)
+            return pd.Series({'balancer': assign_list[1][0] if len(cell) > 1 else None,
+                              'classifier': assign_list[2][0] if len(cell) > 2 else None})
+
+        slowest_df = records_df.sort_values(by, ascending = False).head(n).reset_index(drop = True)
+
+        return pd.concat([slowest_df[['stage', 'i', 'j', 'k']],
+                          slowest_df.apply(names, axis = 1),
+                          slowest_df.drop(columns = ['stage', 'i', 'j', 'k', 'pid'])], axis = 1)
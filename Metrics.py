@@ -1,11 +1,11 @@
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score, confusion_matrix, classification_report
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score, balanced_accuracy_score, confusion_matrix, classification_report
 import numpy as np
 import pandas as pd
-import plotly.express as px
 from scipy.stats import linregress
-from Visualiser import CLSFVisualiser
 from helper_tools import Data, extract_table_info
+from Calibration import calibration_bins, calibration_scores
 from scipy.interpolate import interp1d
+# plotly and the Visualiser are imported by the plotting methods, metric jobs do not load them
 
 
 
@@ -70,6 +70,8 @@ class OwnMetrics():
 
     def calibration_curve(self, k):
 
+        import plotly.express as px
+
         sorted_indices = np.argsort(self.test_probabilities)
         #print(sorted_indices)
 
@@ -222,6 +224,8 @@ class IterMetrics():
     
     def calibration_curve(self, k = 10):
 
+        import plotly.express as px
+
         predicted_probabilities = [pred_dict['predicted_proba'] for pred_dict in self.predictions_dict_list]
         names = [pred_dict['name'] for pred_dict in self.predictions_dict_list]
         
@@ -266,6 +270,8 @@ class IterMetrics():
 
     def calibration_curve_reg(self, k = 10):
 
+        import plotly.express as px
+
         predicted_probabilities = [pred_dict['predicted_proba'] for pred_dict in self.predictions_dict_list]
         names = [pred_dict['name'] for pred_dict in self.predictions_dict_list]
         
@@ -312,6 +318,137 @@ class IterMetrics():
         
 
 
+def confusion_counts(y_test, y_pred):
+    """
+    Confusion counts of a batch of binary predictions against one test set.
+
+    Parameters:
+    - y_test (array): Labels, shape (n,).
+    - y_pred (array): Predicted labels of several classifiers, shape (m, n).
+
+    Returns:
+    - tuple: TP, FP, TN, FN as arrays of shape (m,).
+    """
+    y_test_1 = (y_test == 1).astype(float)
+    y_pred_1 = (y_pred == 1).astype(float)
+
+    n = len(y_test)
+    n_pos = y_test_1.sum()
+    n_pred_pos = y_pred_1.sum(axis = -1)
+
+    TP = y_pred_1 @ y_test_1
+    FP = n_pred_pos - TP
+    FN = n_pos - TP
+    TN = n - TP - FP - FN
+
+    return (TP, FP, TN, FN)
+
+
+
+def safe_ratio(numerator, denominator):
+    # sklearn's zero_division default: 0 where the denominator vanishes
+    return np.divide(numerator, denominator, out = np.zeros_like(numerator, dtype = float), where = denominator != 0)
+
+
+# sklearn metrics expressed by confusion counts, roc_auc_score on hard labels is the balanced accuracy
+count_metrics = {
+    accuracy_score: lambda TP, FP, TN, FN: (TP + TN) / (TP + FP + TN + FN),
+    precision_score: lambda TP, FP, TN, FN: safe_ratio(TP, TP + FP),
+    recall_score: lambda TP, FP, TN, FN: safe_ratio(TP, TP + FN),
+    f1_score: lambda TP, FP, TN, FN: safe_ratio(2*TP, 2*TP + FP + FN),
+    roc_auc_score: lambda TP, FP, TN, FN: (safe_ratio(TP, TP + FN) + safe_ratio(TN, TN + FP)) / 2,
+    balanced_accuracy_score: lambda TP, FP, TN, FN: (safe_ratio(TP, TP + FN) + safe_ratio(TN, TN + FP)) / 2,
+}
+
+
+
+
+def threshold_curves(y_test, pred_proba):
+    """
+    Confusion counts at every distinct threshold of a probability vector from a single sort and cumulative sums.
+    A sample is predicted positive if its probability is >= threshold, the first entry (threshold inf) predicts none.
+
+    Parameters:
+    - y_test (array): Labels, shape (n,).
+    - pred_proba (array): Predicted probabilities of class 1, shape (n,).
+
+    Returns:
+    - dict: thresholds in descending order and TP, FP, TN, FN at each of them.
+    """
+    order = np.argsort(-pred_proba, kind = 'stable')
+    proba_sorted = pred_proba[order]
+    y_sorted = (y_test[order] == 1)
+
+    # last position of every block of equal probabilities
+    last_inds = np.r_[np.flatnonzero(np.diff(proba_sorted)), len(proba_sorted) - 1]
+
+    TP = np.r_[0, np.cumsum(y_sorted)[last_inds]]
+    FP = np.r_[0, last_inds + 1 - TP[1:]]
+
+    return {'thresholds': np.r_[np.inf, proba_sorted[last_inds]],
+            'TP': TP,
+            'FP': FP,
+            'TN': FP[-1] - FP,
+            'FN': TP[-1] - TP}
+
+
+
+def counts_above(curves, thresholds):
+    """
+    TP, FP, TN, FN of the rule pred_proba > threshold for arbitrary thresholds, looked up in the output of threshold_curves.
+    """
+    # number of distinct probabilities strictly above each threshold, the inf entry is always counted
+    inds = np.searchsorted(-curves['thresholds'], -np.asarray(thresholds), side = 'left') - 1
+
+    return tuple(curves[count][inds] for count in ('TP', 'FP', 'TN', 'FN'))
+
+
+
+def roc_pr_curves(curves):
+    """
+    ROC, precision-recall, lift and net benefit curves over the thresholds of threshold_curves.
+    """
+    TP, FP, TN, FN = (curves[count].astype(float) for count in ('TP', 'FP', 'TN', 'FN'))
+    thresholds = curves['thresholds']
+    
+    n_pos = TP[-1]
+    n_neg = FP[-1]
+    n = n_pos + n_neg
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        tpr = TP / n_pos
+        fpr = FP / n_neg
+        # no positive predictions at threshold inf, precision 1 by convention
+        precision = np.r_[1, TP[1:] / (TP[1:] + FP[1:])]
+        net_benefit = (TP - thresholds / (1 - thresholds) * FP) / n
+        net_benefit[0] = 0
+
+    return {'thresholds': thresholds,
+            'fpr': fpr, 
+            'tpr': tpr, 
+            'precision': precision, 
+            'recall': tpr, 
+            'lift': precision / (n_pos / n),
+            'net_benefit': net_benefit}
+
+
+
+def auroc_auprc(curves):
+    """
+    Probability based ROC AUC (trapezoidal, as roc_auc_score) and PR AUC (as average_precision_score).
+    NaN if the test set contains a single class.
+    """
+    roc_pr = roc_pr_curves(curves)
+    fpr, tpr, precision = roc_pr['fpr'], roc_pr['tpr'], roc_pr['precision']
+
+    auroc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+    auprc = np.sum(np.diff(tpr) * precision[1:])
+
+    return (auroc, auprc)
+
+
+
+
 class FMLP_Metrics(Data):
 
     def __init__(self, doc_dict = {}, selection_tuple_set = {}):
@@ -351,9 +488,69 @@ class FMLP_Metrics(Data):
         else:
             self.selection_set = set(names_dict.keys())
 
+        # cells that failed in balancing or classification have NaN predictions and are not plotted
+        self.failures = self.data_dict.get('failures', {})
+        self.selection_set = self.selection_set - self.failures.keys()
+
 
 
     def confusion_metrics(self, std_metric_list):
+        """
+        Fills std_metrics_res per dataset at once. The predictions of all (j, k) cells of a dataset form one block, 
+        metrics in count_metrics are derived from the batched confusion counts, others are called per cell.
+        """
+        y_test = self.data_dict['org_y_test']
+        y_pred = self.data_dict['clsf_predictions_y']
+        a, b, c = y_pred.grid_shape
+
+        for i in range(a):
+            
+            y_i_test = y_test[i]
+            y_i_pred = y_pred.block(i).reshape(b*c, -1)
+            metrics_res = self.data_dict['std_metrics_res'][i].reshape(b*c, -1)
+
+            TP, FP, TN, FN = confusion_counts(y_i_test, y_i_pred)
+
+            # sklearn raises for a single class in y_test, which the per cell call reproduces
+            single_class = (TP[0] + FN[0] == 0) or (TN[0] + FP[0] == 0)
+
+            for m, (name, metr_func) in enumerate(std_metric_list):
+
+                if metr_func in count_metrics and not single_class:
+                    metrics_res[:, m] = count_metrics[metr_func](TP, FP, TN, FN)
+                
+                else:
+                    metrics_res[:, m] = [np.nan if (i, j, k) in self.failures else metr_func(y_i_test, y_i_pred[j*c + k])
+                                         for j in range(b) for k in range(c)]
+
+
+    def positive_proba(self, i, j, k):
+        """
+        Predicted probabilities of class 1 of cell (i, j, k), NaN for a failed cell.
+        """
+        if (i, j, k) in self.failures:
+            return np.full(self.data_dict['org_y_test'].lengths[i], np.nan)
+        
+        corr_classes = self.data_dict['classes_order'][i, j, k]
+        pred_probabilities = self.data_dict['clsf_predictions_proba'][i, j, k]
+
+        return pred_probabilities[:, np.where(corr_classes == 1)[0]].flatten()
+
+
+    def proba_metrics(self):
+        """
+        Fills proba_metrics_res with the probability based AUROC and AUPRC of every (i, j, k) cell.
+        """
+        y_test = self.data_dict['org_y_test']
+
+        for (i,j,k) in self.data_dict['assignment_dict']:
+
+            curves = threshold_curves(y_test[i], self.positive_proba(i, j, k))
+
+            self.data_dict['proba_metrics_res'][i, j, k, :] = auroc_auprc(curves)
+
+
+    def confusion_metrics_loop(self, std_metric_list):
 
         y_test = self.data_dict['org_y_test']
         y_pred = self.data_dict['clsf_predictions_y']
@@ -361,10 +558,7 @@ class FMLP_Metrics(Data):
         for (i,j,k) in self.data_dict['assignment_dict']:
             
             y_i_test = y_test[i]
-            y_i_test = y_i_test[~np.isnan(y_i_test)]
-
             y_clsf_pred = y_pred[i, j, k]
-            y_clsf_pred = y_clsf_pred[~np.isnan(y_clsf_pred)]
 
             evaluation = np.array([metr_func(y_i_test, y_clsf_pred) for (name, metr_func) in std_metric_list])
 
@@ -374,6 +568,8 @@ class FMLP_Metrics(Data):
 
     def confusion_scatter(self, feature1, feature2, feature_map, save = False):
 
+        from Visualiser import CLSFVisualiser
+
         clsf_visualiser = CLSFVisualiser()
 
         X_test = self.data_dict['org_X_test']
@@ -383,16 +579,8 @@ class FMLP_Metrics(Data):
         for (i,j,k) in self.selection_set:
 
             y_i_test = y_test[i]
-            y_i_test = y_i_test[~np.isnan(y_i_test)]
-
             X_i_test = X_test[i]
-            # Drop rows with NaN values
-            X_i_test = X_i_test[~np.isnan(X_i_test).all(axis = 1)]
-            # Drop columns with NaN values
-            X_i_test = X_i_test[: , ~np.isnan(X_i_test).all(axis = 0)]
-
             y_clsf_pred = y_pred[i, j, k]
-            y_clsf_pred = y_clsf_pred[~np.isnan(y_clsf_pred)]
 
 
             clsf_visualiser.confusion_scatterplot(X_i_test,
@@ -409,6 +597,8 @@ class FMLP_Metrics(Data):
 
     def pred_proba_scatter(self, feature1, feature2, feature_map, save = False):
 
+        from Visualiser import CLSFVisualiser
+
         clsf_visualiser = CLSFVisualiser()
 
         X_test = self.data_dict['org_X_test']
@@ -420,14 +610,7 @@ class FMLP_Metrics(Data):
             corr_classes = class_orders[i, j, k]
 
             X_i_test = X_test[i]
-            # Drop rows with NaN values
-            X_i_test = X_i_test[~np.isnan(X_i_test).all(axis = 1)]
-            # Drop columns with NaN values
-            X_i_test = X_i_test[: , ~np.isnan(X_i_test).all(axis = 0)]
-
             clsf_pred_proba = pred_probabilities[i, j, k]
-            # Drop rows with NaN values
-            clsf_pred_proba = clsf_pred_proba[~np.isnan(clsf_pred_proba).all(axis = 1)]
 
 
             clsf_visualiser.pred_proba_scatterplot(X_i_test,
@@ -442,12 +625,49 @@ class FMLP_Metrics(Data):
 
 
 
+    def selected_bins(self, m, strategy = 'quantile'):
+        """
+        Calibration bins of the selected cells, batched over the cells of each dataset.
+        Returns a dict (i, j, k): dict of calibration_bins for a single cell.
+        """
+        y_test = self.data_dict['org_y_test']
+        bins_dict = {}
+
+        for i in sorted({i for (i,j,k) in self.selection_set}):
+
+            cells = sorted(key for key in self.selection_set if key[0] == i)
+            pred_proba = np.stack([self.positive_proba(*key) for key in cells])
+
+            dataset_bins = calibration_bins(y_test[i], pred_proba, m, strategy = strategy)
+
+            for c, key in enumerate(cells):
+                bins_dict[key] = {name: values[c] for name, values in dataset_bins.items()}
+        
+        return bins_dict
+
+
+    def calibration_metrics(self, m = 10, strategy = 'quantile'):
+        """
+        Fills calibration_res with ECE, MCE and Brier score of every (i, j, k) cell, batched per dataset.
+        """
+        y_test = self.data_dict['org_y_test']
+        a, b, c = self.data_dict['clsf_predictions_proba'].grid_shape
+
+        for i in range(a):
+
+            pred_proba = np.stack([self.positive_proba(i, j, k) for j in range(b) for k in range(c)])
+
+            bins_dict = calibration_bins(y_test[i], pred_proba, m, strategy = strategy)
+
+            self.data_dict['calibration_res'][i] = calibration_scores(y_test[i], pred_proba, bins_dict).reshape(b, c, 3)
+
+
     def calibration_curves(self, save = False, title = f'Calibration Curves'):
-        predicted_proba_raw = self.data_dict['clsf_predictions_proba']
-        class_orders = self.data_dict['classes_order']
+        import plotly.express as px
+
         y_test = self.data_dict['org_y_test']
 
-        class_ratios = np.nansum(y_test, axis=1) / np.sum(~np.isnan(y_test), axis=1)
+        class_ratios = [np.mean(y_test[i]) for i in range(y_test.grid_shape[0])]
         m = int(1 / min(class_ratios))
 
         creation_dict ={
@@ -455,29 +675,10 @@ class FMLP_Metrics(Data):
         'mean_freq': [np.arange(0, 1, 1/m)],
         'name': [['Optimum' for _ in range(m)]]
         }
-        for (i,j,k) in self.selection_set:
-
-            corr_classes = class_orders[i, j, k]
-            
-            y_i_test = y_test[i]
-            y_i_test = y_i_test[~np.isnan(y_i_test)]
-
-            pred_probabilities = predicted_proba_raw[i, j, k]
-
-            # Drop rows with NaN values
-            pred_probabilities = pred_probabilities[~np.isnan(pred_probabilities).all(axis = 1)]
-
-            pred_proba = pred_probabilities[:, np.where(corr_classes == 1)[0]].flatten()
-            
-            sorted_indices = np.argsort(pred_proba)
-            sorted_probabilities = pred_proba[sorted_indices]
-            sorted_y_test = y_i_test[sorted_indices]
-
-            binned_probabilities = np.array_split(sorted_probabilities, m)
-            binned_y_test = np.array_split(sorted_y_test, m)
+        for (i,j,k), bins in self.selected_bins(m).items():
 
-            creation_dict['mean_pred_proba'].append([bin.sum()/len(bin) for bin in binned_probabilities])
-            creation_dict['mean_freq'].append([bin.sum()/len(bin) for bin in binned_y_test])
+            creation_dict['mean_pred_proba'].append(bins['mean_pred_proba'])
+            creation_dict['mean_freq'].append(bins['mean_freq'])
             creation_dict['name'].append([self.names_dict[(i,j,k)] for _ in range(m)])
 
         
@@ -511,11 +712,11 @@ class FMLP_Metrics(Data):
 
 
     def calibration_curves_spline(self, save = False, title = f'Calibration Curves with Spline Interpolation'):
-        predicted_proba_raw = self.data_dict['clsf_predictions_proba']
-        class_orders = self.data_dict['classes_order']
+        import plotly.express as px
+
         y_test = self.data_dict['org_y_test']
 
-        class_ratios = np.nansum(y_test, axis=1) / np.sum(~np.isnan(y_test), axis=1)
+        class_ratios = [np.mean(y_test[i]) for i in range(y_test.grid_shape[0])]
         m = 1 / min(class_ratios)
         #print(m)
         m = int(m)
@@ -525,37 +726,16 @@ class FMLP_Metrics(Data):
         'mean_freq': [np.arange(0, 1, 1/m)],
         'name': [['Optimum' for _ in range(m)]]
         }
-        for (i,j,k) in self.selection_set:
-
-            corr_classes = class_orders[i, j, k]
-            
-            y_i_test = y_test[i].copy()
-            y_i_test = y_i_test[~np.isnan(y_i_test)]
-
-            pred_probabilities = predicted_proba_raw[i, j, k]
-            
-            # Drop rows with NaN values
-            pred_probabilities = pred_probabilities[~np.isnan(pred_probabilities).all(axis = 1)]
-            
-            pred_proba = pred_probabilities[:, np.where(corr_classes == 1)[0]].flatten()
-            
-            sorted_indices = np.argsort(pred_proba)
-            sorted_probabilities = pred_proba[sorted_indices]
-            sorted_y_test = y_i_test[sorted_indices]
-
-            binned_probabilities = np.array_split(sorted_probabilities, m)
-            binned_y_test = np.array_split(sorted_y_test, m)
-
-            mean_predicted_proba = [bin.sum()/len(bin) for bin in binned_probabilities]
+        for (i,j,k), bins in self.selected_bins(m).items():
             
             spline = interp1d(
-                x = mean_predicted_proba, 
-                y = [bin.sum()/len(bin) for bin in binned_y_test],
+                x = bins['mean_pred_proba'], 
+                y = bins['mean_freq'],
                 fill_value = 'extrapolate'
                 )
 
             creation_dict['mean_pred_proba'].append(np.arange(0, 1, 1/m))
-            creation_dict['mean_freq'].append([spline(x) for x in np.arange(0, 1, 1/m)])
+            creation_dict['mean_freq'].append(spline(np.arange(0, 1, 1/m)))
             creation_dict['name'].append([self.names_dict[(i,j,k)] for _ in range(m)])
 
         
@@ -589,12 +769,11 @@ class FMLP_Metrics(Data):
 
 
     def decision_curves(self, data_ind = 0, m = 10, save = False, title = f'Decision Curves'):
-        predicted_proba_raw = self.data_dict['clsf_predictions_proba']
-        class_orders = self.data_dict['classes_order']
+        import plotly.express as px
+
         y_test = self.data_dict['org_y_test']
 
-        y_i_test = y_test[data_ind]
-        y_i_test = y_i_test[~np.isnan(y_i_test)].astype(int)
+        y_i_test = y_test[data_ind].astype(int)
         
         creation_dict ={
         'pred_threshold': [np.arange(0, 1, 1/m)],
@@ -603,33 +782,18 @@ class FMLP_Metrics(Data):
         'name': [['Treat All' for _ in range(m)]]
         }
 
+        thresholds = np.arange(0, 1, 1/m)
+
         assign_keys = set([(j,k) for (i,j,k) in self.selection_set])
         for (j,k) in assign_keys:
 
-            corr_classes = class_orders[data_ind, j, k]
+            pred_proba = self.positive_proba(data_ind, j, k)
 
-            pred_probabilities = predicted_proba_raw[data_ind, j, k]
+            curves = threshold_curves(y_i_test, pred_proba)
+            true_pos, false_pos, true_neg, false_neg = counts_above(curves, thresholds)
+            #print('True Positives:', true_pos, 'False Positives:', false_pos)
 
-            # Drop rows with NaN values
-            pred_probabilities = pred_probabilities[~np.isnan(pred_probabilities).all(axis = 1)]
-
-            pred_proba = pred_probabilities[:, np.where(corr_classes == 1)[0]].flatten()
-
-            net_benefit_list = []
-            for threshold in np.arange(0, 1, 1/m):
-                
-                y_pred = (pred_proba > threshold).astype(int)
-
-                y_test_1_mask = y_i_test == 1
-                y_pred_1_mask = y_pred == 1
-                #print('Number predicted positive:', np.sum(y_pred_1_mask))
-                true_pos = np.sum((y_test_1_mask) & (y_pred_1_mask))
-                false_pos = np.sum((~y_test_1_mask) & (y_pred_1_mask))
-                #print('True Positives:', true_pos, 'False Positives:', false_pos)
-                #print('Threshold:', threshold, 'Net Benefit:', (true_pos - (threshold/(1-threshold))*false_pos)/len(y_i_test))
-                
-                net_benefit = (true_pos - (threshold/(1-threshold))*false_pos)/len(y_i_test)
-                net_benefit_list.append(net_benefit)
+            net_benefit_list = (true_pos - (thresholds/(1-thresholds))*false_pos)/len(y_i_test)
 
             creation_dict['pred_threshold'].append(np.arange(0, 1, 1/m))
             creation_dict['net_benefit'].append(net_benefit_list)
@@ -725,6 +889,41 @@ if __name__=="__main__":
     print(test_confusion_matrix)
     """
 
+    """
+    Benchmark batched confusion metrics against the per cell sklearn loop
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    
+    import time
+    from Assessors import Assessor
+    from helper_tools import create_simple_normal_dict_list
+    from imblearn.over_sampling import SMOTE
+
+    std_metric_list = [('accuracy', accuracy_score), ('precision', precision_score), ('recall', recall_score), 
+                       ('F1 score', f1_score), ('ROC AUC Score', roc_auc_score)]
+
+    gen_dict_list = create_simple_normal_dict_list([10e3, 10e4], [2, 4], [0.1, 0.01], [2])
+    assessor = Assessor(0.2, gen_dict_list, {'Unbalanced': None, 'SMOTE': SMOTE}, classifiers_dict, seed = 42)
+    assessor.generate()
+    assessor.balance()
+    assessor.clsf_pred()
+    assessor.allocate('std_metrics_res', shape = assessor.exp_dim + (len(std_metric_list),))
+
+    metrics = FMLP_Metrics()
+
+    start_time = time.perf_counter()
+    metrics.confusion_metrics_loop(std_metric_list)
+    loop_time = time.perf_counter() - start_time
+    loop_res = assessor.data_dict['std_metrics_res'].copy()
+
+    start_time = time.perf_counter()
+    metrics.confusion_metrics(std_metric_list)
+    batched_time = time.perf_counter() - start_time
+
+    deviation = np.max(np.abs(loop_res - assessor.data_dict['std_metrics_res']))
+    print(f'Max deviation {deviation:.2e}')
+    print(f'{np.prod(assessor.exp_dim)} cells: loop {loop_time:.3f}s, batched {batched_time:.3f}s, speed-up {loop_time/batched_time:.2f}')
+    """
+
     """
     IterMetrics Test Case
     -------------------------------------------------------------------------------------------------------------------------------------------
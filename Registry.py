@@ -0,0 +1,97 @@
+import importlib
+
+
+
+
+class LazyClass():
+
+    def __init__(self, module, name):
+        """
+        Stands in for the class name of module, which is only imported when the class is resolved or called.
+        Balancer and classifier dicts of registry entries can be built, pickled and hashed
+        without loading imblearn, xgboost or lightgbm.
+
+        Parameters:
+        - module (str): Import path of the module, e.g. 'imblearn.over_sampling'.
+        - name (str): Name of the class in the module.
+        """
+        self.module = module
+        self.name = name
+
+
+    def resolve(self):
+        return getattr(importlib.import_module(self.module), self.name)
+
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+
+    def __eq__(self, other):
+        return isinstance(other, LazyClass) and (self.module, self.name) == (other.module, other.name)
+
+
+    def __hash__(self):
+        return hash((self.module, self.name))
+
+
+    def __repr__(self):
+        return f'LazyClass({self.module!r}, {self.name!r})'
+
+
+
+
+def resolve(entry):
+    """
+    The class of a registry entry, other entries (classes, None for no balancer) are returned unchanged.
+    """
+    return entry.resolve() if isinstance(entry, LazyClass) else entry
+
+
+
+
+"""
+Registries
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+balancers = {
+    "Unbalanced": None,
+    "ADASYN": LazyClass('imblearn.over_sampling', 'ADASYN'),
+    "RandomOverSampler": LazyClass('imblearn.over_sampling', 'RandomOverSampler'),
+    "KMeansSMOTE": LazyClass('imblearn.over_sampling', 'KMeansSMOTE'),
+    "SMOTE": LazyClass('imblearn.over_sampling', 'SMOTE'),
+    "BorderlineSMOTE": LazyClass('imblearn.over_sampling', 'BorderlineSMOTE'),
+    "SVMSMOTE": LazyClass('imblearn.over_sampling', 'SVMSMOTE'),
+    "SMOTENC": LazyClass('imblearn.over_sampling', 'SMOTENC'),
+    "FastSMOTE": LazyClass('Fast_SMOTE', 'FastSMOTE'),
+    "VirtualOverSampler": LazyClass('Virtual_Oversampling', 'VirtualOverSampler'),
+}
+
+classifiers = {
+    "Logistic Regression": LazyClass('sklearn.linear_model', 'LogisticRegression'),
+    "Decision Tree": LazyClass('sklearn.tree', 'DecisionTreeClassifier'),
+    "Random Forest": LazyClass('sklearn.ensemble', 'RandomForestClassifier'),
+    "SVC": LazyClass('sklearn.svm', 'SVC'),
+    "Naive Bayes": LazyClass('sklearn.naive_bayes', 'GaussianNB'),
+    "XGboost": LazyClass('xgboost', 'XGBClassifier'),
+    "Lightgbm": LazyClass('lightgbm', 'LGBMClassifier'),
+}
+
+
+def register(registry, name, module, class_name):
+    """
+    Adds a class to the balancers or classifiers registry under name, e.g.
+    register(balancers, 'SMOTETomek', 'imblearn.combine', 'SMOTETomek').
+    """
+    registry[name] = LazyClass(module, class_name)
+
+
+def select(registry, names):
+    """
+    Dictionary name: registry entry of names, in their order, as balancers_dict or classifiers_dict of an Assessor.
+    """
+    unknown = [name for name in names if name not in registry]
+    if unknown:
+        raise KeyError(f"Not registered: {unknown}, registered are {list(registry)}.")
+
+    return {name: registry[name] for name in names}
@@ -0,0 +1,206 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+
+
+
+class ResultsStore():
+
+    # descriptor columns of extract_table_info and the grid names, indexed for filtered reads
+    meta_columns = ['n_features', 'n_samples', 'class_ratio', 'distributions', 'balancer', 'balancing_method', 'classifier']
+
+    def __init__(self, db_path, table):
+        """
+        Table of experiment results in a SQLite database. Every experiment is a table of the database,
+        metric columns are added to the table as they first appear in an appended DataFrame.
+
+        Parameters:
+        - db_path (str): Path of the database file, e.g. 'Experiments/results.db'.
+        - table (str): Name of the experiment table.
+        """
+        self.db_path = db_path
+        self.table = table
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok = True)
+
+
+    @contextmanager
+    def connect(self):
+        """
+        Connection to the database that commits on success, rolls back on an exception and is closed afterwards.
+        sqlite3 connections only end the transaction as context managers, they are not closed.
+        """
+        connection = sqlite3.connect(self.db_path)
+
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+    def columns(self, connection = None):
+        """
+        Columns of the table in order, empty if the table does not exist yet. Uses connection if one is open.
+        """
+        if connection is None:
+            with self.connect() as connection:
+                return self.columns(connection)
+
+        return [row[1] for row in connection.execute(f'PRAGMA table_info("{self.table}")')]
+
+
+    def exists(self):
+        return bool(self.columns())
+
+
+    def append(self, results_df, constant_columns = {}, if_exists = 'append'):
+        """
+        Appends the rows of results_df, costs only the new rows.
+        constant_columns adds columns with one value for all rows, e.g. {'cluster distance': 2}.
+        if_exists 'replace' drops the rows of an earlier run of the experiment first, so that a rerun does not duplicate them.
+        """
+        if if_exists not in ('append', 'replace'):
+            raise ValueError(f"Unknown if_exists {if_exists}, use 'append' or 'replace'.")
+
+        results_df = results_df.assign(**constant_columns)
+
+        with self.connect() as connection:
+
+            if if_exists == 'replace':
+                connection.execute(f'DROP TABLE IF EXISTS "{self.table}"')
+
+            existing_columns = self.columns(connection)
+
+            for column in results_df.columns:
+                if existing_columns and column not in existing_columns:
+                    connection.execute(f'ALTER TABLE "{self.table}" ADD COLUMN "{column}" {sql_type(results_df[column])}')
+
+            results_df.to_sql(self.table, connection, if_exists = 'append', index = False)
+
+            if not existing_columns:
+                for column in self.meta_columns:
+                    if column in results_df.columns:
+                        connection.execute(f'CREATE INDEX IF NOT EXISTS "{self.table}_{column}" ON "{self.table}" ("{column}")')
+
+
+    def read(self, columns = None, filters = {}):
+        """
+        Reads the table with the selection of columns and rows done by SQLite.
+
+        Parameters:
+        - columns (list or None): Columns to read, all if None.
+        - filters (dict): column: value for equality or column: list of values for membership, combined by AND.
+
+        Returns:
+        - pd.DataFrame: Selected rows and columns.
+        """
+        select = '*' if columns is None else ', '.join(f'"{column}"' for column in columns)
+        where, params = where_clause(filters)
+
+        with self.connect() as connection:
+            return pd.read_sql_query(f'SELECT {select} FROM "{self.table}"{where}', connection, params = params)
+
+
+    def delete(self, filters = {}):
+        """
+        Deletes the rows selected by filters as in read, e.g. {'cluster distance': 2} before the rerun of that distance.
+        """
+        where, params = where_clause(filters)
+
+        with self.connect() as connection:
+            if self.columns(connection):
+                connection.execute(f'DELETE FROM "{self.table}"{where}', params)
+
+
+    def drop(self):
+        """
+        Drops the table with its indices.
+        """
+        with self.connect() as connection:
+            connection.execute(f'DROP TABLE IF EXISTS "{self.table}"')
+
+
+    def import_csv(self, csv_path, chunksize = 10**5):
+        """
+        Appends the rows of a results CSV of the Experiments directory, written with its index as first column.
+        """
+        for chunk in pd.read_csv(csv_path, index_col = 0, chunksize = chunksize):
+            self.append(chunk)
+
+
+
+
+def where_clause(filters):
+    """
+    WHERE clause and its parameters of filters column: value for equality or column: list of values for membership, combined by AND.
+    """
+    conditions = []
+    params = []
+    for column, value in filters.items():
+
+        if isinstance(value, (list, tuple, set)):
+            value = list(value)
+            conditions.append(f'"{column}" IN ({", ".join("?" for _ in value)})')
+            params.extend(value)
+        else:
+            conditions.append(f'"{column}" = ?')
+            params.append(value)
+
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+
+
+def sql_type(series):
+
+    if pd.api.types.is_integer_dtype(series) or pd.api.types.is_bool_dtype(series):
+        return 'INTEGER'
+
+    if pd.api.types.is_float_dtype(series):
+        return 'REAL'
+
+    return 'TEXT'
+
+
+
+
+if __name__=="__main__":
+
+    import time
+
+    """
+    Append cost of the store against rewriting a growing CSV
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    """
+    store = ResultsStore('Experiments/store_benchmark.db', 'benchmark')
+    rng = np.random.default_rng(42)
+    eval_columns = ['accuracy', 'precision', 'recall', 'F1 score', 'ROC AUC Score']
+
+    def new_rows(n):
+        return pd.DataFrame({'n_features': rng.integers(2, 10, n),
+                             'class_ratio': rng.choice([0.1, 0.01], n),
+                             'balancer': rng.choice(['SMOTE', 'ADASYN', 'Unbalanced'], n),
+                             'classifier': rng.choice(['Logistic Regression', 'Decision Tree'], n),
+                             **{column: rng.random(n) for column in eval_columns}})
+
+    start_time = time.perf_counter()
+    results_df = pd.DataFrame()
+    for _ in range(200):
+        results_df = pd.concat([results_df, new_rows(100)], ignore_index = True)
+        results_df.to_csv('Experiments/store_benchmark.csv')
+    csv_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(200):
+        store.append(new_rows(100))
+    store_time = time.perf_counter() - start_time
+
+    print(f'200 appends of 100 rows: csv rewrite {csv_time:.3f}s, store {store_time:.3f}s')
+    print(store.read(columns = ['balancer', 'accuracy'], filters = {'balancer': ['SMOTE', 'ADASYN'], 'class_ratio': 0.01}))
+
+    os.remove('Experiments/store_benchmark.db')
+    os.remove('Experiments/store_benchmark.csv')
@@ -0,0 +1,190 @@
+import sys
+import heapq
+import argparse
+from helper_tools import extract_table_info
+from Registry import resolve
+from Caching import ShardStore
+
+
+
+
+"""
+Partition
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+def parse_shard(spec):
+    """
+    Parses a shard given as 'i/N', shard i (counted from 0) of N, e.g. from a --shard i/N argument.
+
+    Returns:
+    - tuple: (index, n_shards).
+    """
+    try:
+        index, n_shards = (int(part) for part in str(spec).split('/'))
+    except ValueError:
+        raise ValueError(f"Shard {spec!r} is not of the form 'i/N'.") from None
+
+    if not 0 <= index < n_shards:
+        raise ValueError(f"Shard index {index} is not in 0..{n_shards - 1}.")
+
+    return index, n_shards
+
+
+
+def training_groups(assignment_dict):
+    """
+    Group of every (i, j) slot, (i, j) of the first slot of dataset i with the same balancer class.
+    FMLP_DataBalancer.training_sources lets slots with the same balancer and parameters share one resample, 
+    and FMLP_DataClassifier fits their classifiers once, hence they have to run in the same shard. The parameters are
+    only passed to balance, so the groups are the coarser ones of the balancer class, which contain the training_sources groups. 
+    Slots whose oversampler turns out to leave the training set unchanged share it with balancer None,
+    which the shard handles by running the fit cell of the other group as well.
+
+    Returns:
+    - dict: (i, j): (i, first j) of its group.
+    """
+    groups = {}
+    first_slots = {}
+
+    for (i, j, k), (gen_dict, (bal_name, balancer), clsf) in sorted(assignment_dict.items()):
+        groups[(i, j)] = first_slots.setdefault((i, resolve(balancer)), (i, j))
+
+    return groups
+
+
+
+def group_costs(assignment_dict, cost_weights = {}):
+    """
+    Expected cost of the training_groups of the grid, the classifiers of a training set are kept together as they share its resample.
+    The cost of a cell is n_samples * n_features of its dataset times the weights of its balancer and classifier name,
+    1 for names not in cost_weights. Weights can be taken from the timings of an earlier run, e.g. {'Random Forest': 10}.
+
+    Returns:
+    - dict: group: expected cost.
+    """
+    groups = training_groups(assignment_dict)
+    costs = {}
+
+    for (i, j, k), (gen_dict, (bal_name, balancer), (clsf_name, classifier)) in assignment_dict.items():
+
+        n_features, n_samples = extract_table_info(gen_dict)[:2]
+        cost = n_samples * n_features * cost_weights.get(bal_name, 1) * cost_weights.get(clsf_name, 1)
+
+        costs[groups[(i, j)]] = costs.get(groups[(i, j)], 0) + cost
+
+    return costs
+
+
+
+def partition(assignment_dict, n_shards, cost_weights = {}):
+    """
+    Splits the grid into n_shards sets of cells of similar expected cost by longest processing time first:
+    the training_groups in order of decreasing cost go to the shard with the least cost so far.
+    The partition only depends on the grid, hence every host computes the same one without coordination.
+
+    Returns:
+    - list: Set of (i, j, k) cells of every shard.
+    """
+    groups = training_groups(assignment_dict)
+    costs = group_costs(assignment_dict, cost_weights)
+    loads = [(0, index) for index in range(n_shards)]
+    shard_groups = [set() for _ in range(n_shards)]
+
+    for group in sorted(costs, key = lambda group: (-costs[group], group)):
+
+        load, index = heapq.heappop(loads)
+        shard_groups[index].add(group)
+        heapq.heappush(loads, (load + costs[group], index))
+
+    return [{(i, j, k) for (i, j, k) in assignment_dict if groups[(i, j)] in group_set} for group_set in shard_groups]
+
+
+
+def shard_cells(assignment_dict, shard, cost_weights = {}):
+    """
+    Cells of shard (index, n_shards) or 'i/N' of the grid.
+    """
+    index, n_shards = parse_shard(shard) if isinstance(shard, str) else shard
+
+    return partition(assignment_dict, n_shards, cost_weights)[index]
+
+
+
+
+"""
+Merge
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+def merge_shards(store):
+    """
+    Rebuilds the Assessor of a sharded run from the outputs of all its shards. Its data_dict holds the test sets,
+    predictions and failures of the whole grid as after clsf_pred of a single-node run, so calc_std_metrics
+    and FMLP_Metrics give the same results.
+
+    Parameters:
+    - store (ShardStore or str): Store or directory holding the entries of all shards.
+
+    Returns:
+    - Assessor: Merged Assessor of the run.
+    """
+    from Assessors import Assessor
+
+    store = ShardStore(store) if isinstance(store, str) else store
+    shard_keys = store.shard_keys()
+
+    if not shard_keys:
+        raise ValueError(f"No shard outputs in {store.cache_dir}.")
+
+    # timings are merged if the shards were instrumented
+    assessor_kwargs = store.load_object(shard_keys[0], 'assessor_kwargs')
+    instrument = any(store.load_object(key, 'records') is not None for key in shard_keys)
+
+    assessor = Assessor(**assessor_kwargs, instrument = instrument)
+    assessor.load_shards(store)
+
+    return assessor
+
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Merges the outputs of the shards of a sharded Assessor run.')
+    parser.add_argument('store', help = 'Directory of the ShardStore with the entries of all shards.')
+    parser.add_argument('--output', default = 'Experiments/results.csv')
+    parser.add_argument('--proba-metrics', action = 'store_true')
+    parser.add_argument('--calibration-bins', type = int, default = None)
+    parser.add_argument('--pooled', action = 'store_true', help = 'Metrics on the pooled out-of-fold predictions of a K-fold run.')
+    parser.add_argument('--timings', action = 'store_true')
+
+    args = parser.parse_args(argv)
+
+    assessor = merge_shards(args.store)
+    results_df = assessor.calc_std_metrics(proba_metrics = args.proba_metrics, calibration_bins = args.calibration_bins,
+                                           timings = args.timings, pooled = args.pooled)
+    results_df.to_csv(args.output)
+
+    assessor.close()
+
+    return 0
+
+
+
+
+if __name__=="__main__":
+
+    """
+    Usage
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    Every host runs its shard of the same experiment script and writes its entry into a ShardStore, e.g.
+
+        assessor = Assessor(0.2, gen_dict_list, balancing_methods, classifiers_dict, seed = 42, shard = args.shard)
+        assessor.generate()
+        assessor.balance()
+        assessor.clsf_pred()
+        assessor.save_shard(ShardStore('Experiments/shards'))
+
+    with python experiment.py --shard 0/4, ..., --shard 3/4. Once all entries are copied into one directory:
+
+    python Sharding.py Experiments/shards --output Experiments/results.csv --proba-metrics --calibration-bins 10
+    """
+    sys.exit(main())
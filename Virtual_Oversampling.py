@@ -0,0 +1,67 @@
+import numpy as np
+from imblearn.over_sampling import RandomOverSampler
+from sklearn.utils import check_random_state
+
+
+
+
+class VirtualOverSampler(RandomOverSampler):
+    """
+    RandomOverSampler that expresses the drawn duplicates as integer sample weights of the original rows
+    instead of materialising them. The bootstrap draws are the same as those of RandomOverSampler 
+    with the same random_state, smoothed bootstraps (shrinkage) are not supported.
+    """
+    
+    def fit_weights(self, X, y):
+        """
+        Returns the number of times every row of X occurs in the resample of RandomOverSampler, shape (n,).
+        """
+        if self.shrinkage is not None:
+            raise ValueError("Smoothed bootstraps create new rows and cannot be expressed by sample weights.")
+        
+        self.fit(X, y)
+        random_state = check_random_state(self.random_state)
+        weights = np.ones(len(y), dtype = np.int64)
+
+        for class_sample, num_samples in self.sampling_strategy_.items():
+            target_class_indices = np.flatnonzero(y == class_sample)
+            bootstrap_indices = random_state.choice(target_class_indices, size = num_samples, replace = True)
+            weights += np.bincount(bootstrap_indices, minlength = len(y))
+        
+        return weights
+
+
+
+
+if __name__=="__main__":
+
+    """
+    Virtual oversampling: sample weights against materialised RandomOverSampler duplicates
+    -------------------------------------------------------------------------------------------------------------------------------------------
+    """
+    import time
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.tree import DecisionTreeClassifier
+    from Data_Generator import Multi_Modal_Dist_Generator
+    from helper_tools import create_simple_normal_dict_list
+
+    gen_dict = create_simple_normal_dict_list([10e5], [8], [0.001], [2])[0]
+    data_generator = Multi_Modal_Dist_Generator(gen_dict['distributions'], gen_dict['params_dict_list'], gen_dict['sizes'], seed = 42)
+    X_train, X_test, y_train, y_test = data_generator.prepare_data(0.2)
+
+    X_ros, y_ros = RandomOverSampler(random_state = 42).fit_resample(X_train, y_train)
+    weights = VirtualOverSampler(random_state = 42).fit_weights(X_train, y_train)
+    print(f'Training bytes: RandomOverSampler {X_ros.nbytes + y_ros.nbytes}, virtual {X_train.nbytes + y_train.nbytes + weights.nbytes}')
+
+    for classifier in [LogisticRegression, DecisionTreeClassifier]:
+
+        start_time = time.perf_counter()
+        ros_clsf = classifier(random_state = 42).fit(X_ros, y_ros)
+        ros_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        virtual_clsf = classifier(random_state = 42).fit(X_train, y_train, sample_weight = weights)
+        virtual_time = time.perf_counter() - start_time
+
+        agreement = np.mean(ros_clsf.predict(X_test) == virtual_clsf.predict(X_test))
+        print(f'{classifier.__name__}: fit RandomOverSampler {ros_time:.3f}s, virtual {virtual_time:.3f}s, prediction agreement {agreement:.4f}')
@@ -1,7 +1,11 @@
 import numpy as np
 import scipy.stats as st
 import re
+import hashlib
+import inspect
 from itertools import product
+from multiprocessing import shared_memory
+from Registry import LazyClass
 
 """
 Helper functions
@@ -109,6 +113,67 @@ def create_simple_normal_dict_list(n_samples_list, n_features_list, class_ratio_
 
 
 
+def accepts_random_state(estimator):
+    """
+    True if the estimator class takes a random_state parameter, e.g. False for GaussianNB.
+    The parameters are read from an instance, estimators like XGBClassifier take them through **kwargs.
+    """
+    if hasattr(estimator, 'get_params'):
+        return 'random_state' in estimator().get_params()
+    
+    return 'random_state' in inspect.signature(estimator).parameters
+
+
+
+def stable_hash(obj):
+    """
+    Hex digest that only depends on the content of obj and is the same in every process and session.
+    Supports (nested) dicts, lists, tuples, numpy arrays, scalars, strings, classes, SeedSequences and 
+    scipy distributions, which are identified by the class of their generator.
+    Registry entries hash like the class they stand for.
+    """
+    hasher = hashlib.sha256()
+
+    def update(obj):
+        if isinstance(obj, dict):
+            hasher.update(b'dict')
+            for key in sorted(obj, key = str):
+                update(key)
+                update(obj[key])
+
+        elif isinstance(obj, (list, tuple)):
+            hasher.update(f'{type(obj).__name__}{len(obj)}'.encode())
+            for elem in obj:
+                update(elem)
+
+        elif isinstance(obj, np.ndarray):
+            hasher.update(f'ndarray{obj.dtype.str}{obj.shape}'.encode())
+            hasher.update(np.ascontiguousarray(obj).tobytes())
+
+        elif isinstance(obj, np.generic):
+            update(obj.item())
+
+        elif isinstance(obj, np.random.SeedSequence):
+            update(('SeedSequence', obj.entropy, tuple(obj.spawn_key)))
+
+        elif isinstance(obj, LazyClass):
+            update(obj.resolve())
+
+        elif isinstance(obj, type):
+            hasher.update(f'type{obj.__module__}.{obj.__qualname__}'.encode())
+
+        elif isinstance(obj, (st.rv_continuous, st.rv_discrete)) or type(obj).__module__.startswith('scipy.stats'):
+            hasher.update(f'dist{type(obj).__module__}.{type(obj).__qualname__}'.encode())
+
+        else:
+            hasher.update(f'{type(obj).__name__}{obj!r}'.encode())
+
+    update(obj)
+
+    return hasher.hexdigest()
+
+
+
 def calculate_no_samples(y, sampling_strategy):
     unique, counts = np.unique(y, return_counts=True)
     class_counts = dict(zip(unique, counts))
@@ -167,6 +232,60 @@ def calculate_no_samples(y, sampling_strategy):
 
 
 
+"""
+Dtype Policy
+-------------------------------------------------------------------------------------------------------------------------------------------
+"""
+# dtypes of the data_dict tensors of features (org_X, bal_X), labels (org_y, bal_y, predicted labels), predicted probabilities
+# and sample weights (bal_weights), which count the rows of a resample
+default_dtypes = {'features': np.float64, 'labels': np.float64, 'proba': np.float64, 'weights': np.int32}
+
+# a half of the memory of features and probabilities, an eighth of the labels.
+# Opt-in: float32 fits can flip single predictions (accuracy up to ~1e-3), the default reproduces earlier results and cache keys
+compact_dtypes = {'features': np.float32, 'labels': np.int8, 'proba': np.float32, 'weights': np.int32}
+
+
+def dtype_policy(dtypes = {}):
+    """
+    Complete dtype policy from a dict kind: dtype, kinds that are not given keep their default_dtypes entry.
+    Features and probabilities have to be floating point, labels can be integers and weights have to be integers.
+    """
+    unknown = set(dtypes) - set(default_dtypes)
+    if unknown:
+        raise ValueError(f"Unknown dtype kinds {sorted(unknown)}, use {list(default_dtypes)}.")
+    
+    policy = {kind: np.dtype(dtype) for kind, dtype in {**default_dtypes, **dtypes}.items()}
+
+    for kind in ('features', 'proba'):
+        if not np.issubdtype(policy[kind], np.floating):
+            raise ValueError(f"The dtype of {kind} has to be floating point, got {policy[kind]}.")
+    
+    if not np.issubdtype(policy['weights'], np.integer):
+        raise ValueError(f"The dtype of weights has to be an integer, got {policy['weights']}.")
+
+    return policy
+
+
+def dtype_signature(policy):
+    """
+    Names of the dtypes of a policy for cache keys and run signatures, None for the default policy so that keys of float64 runs are kept.
+    """
+    if policy == dtype_policy():
+        return None
+    
+    return {kind: dtype.name for kind, dtype in policy.items()}
+
+
+def default_fill(dtype):
+    """
+    Fill value of unwritten entries: NaN for floating point dtypes, 0 for integer dtypes, which have no NaN.
+    Failed cells are known from data_dict['failures'], not from their values.
+    """
+    return np.nan if np.issubdtype(np.dtype(dtype), np.inexact) else 0
+
+
+
+
 """
 Helper Classes
 -------------------------------------------------------------------------------------------------------------------------------------------
@@ -175,6 +294,447 @@ Helper Classes
 class Data():
 
     data_dict = {}
+    storage = None
+    dtypes = dtype_policy()
+
+
+    @classmethod
+    def allocate(cls, key, shape, fill_value = None, dtype = float):
+        """
+        Creates the array for data_dict[key]. If a storage backend is set the array lives in its shared memory,
+        otherwise it is an ordinary process-local array. Filled with NaN or 0 for integer dtypes if fill_value is None.
+        """
+        fill_value = default_fill(dtype) if fill_value is None else fill_value
+
+        if cls.storage is None:
+            array = np.full(shape = shape, fill_value = fill_value, dtype = dtype)
+        else:
+            array = cls.storage.allocate(key, shape, fill_value = fill_value, dtype = dtype)
+
+        cls.data_dict[key] = array
+
+        return array
+
+
+    @classmethod
+    def allocate_ragged(cls, key, grid_shape, capacities, widths = None, fill_value = None, dtype = float):
+        """
+        Creates a RaggedArray for data_dict[key] whose segments only take up the space of their capacities.
+        Buffer and lengths are allocated like ordinary arrays, i.e. in shared memory if a storage backend is set.
+        """
+        n_elements = RaggedArray.buffer_size(capacities, widths)
+
+        buffer = cls.allocate(f'{key}.buffer', shape = (n_elements,), fill_value = fill_value, dtype = dtype)
+        lengths = cls.allocate(f'{key}.lengths', shape = tuple(grid_shape), fill_value = 0, dtype = np.int64)
+
+        ragged = RaggedArray(grid_shape, capacities, widths, buffer, lengths)
+        cls.data_dict[key] = ragged
+
+        return ragged
+
+
+    @classmethod
+    def array_ref(cls, key):
+        """
+        Returns what a job needs to access data_dict[key]: 
+        a handle to attach to if the array is shared, the array itself otherwise.
+        """
+        array = cls.data_dict[key]
+
+        if isinstance(array, RaggedArray):
+            return array.with_arrays(cls.array_ref(f'{key}.buffer'), cls.array_ref(f'{key}.lengths'))
+        
+        if isinstance(array, FoldView):
+            return array.with_arrays(cls.array_ref(array.keys[0]), cls.array_ref(array.keys[1]))
+
+        if cls.storage is not None and key in cls.storage.blocks:
+            return cls.storage.handle(key)
+        
+        return array
+
+
+
+
+class SeedStreams():
+
+    stage_codes = {'generate': 0, 'balance': 1, 'classify': 2}
+
+    def __init__(self, master_seed = None, repetition = 0):
+        """
+        Derives independent random streams for every stage and cell of the grid from one master seed.
+        The streams only depend on (stage, gen_index, bal_ind, clsf_ind, repetition), 
+        not on the order in which cells are executed, so serial, parallel and sharded runs draw the same numbers.
+
+        Parameters:
+        - master_seed (int or None): Entropy of all streams. None draws fresh entropy, which is kept in self.entropy.
+        - repetition (int): Index of the repetition of the whole grid.
+        """
+        self.entropy = np.random.SeedSequence(master_seed).entropy
+        self.repetition = repetition
+
+
+    def seed_seq(self, stage, gen_index, bal_ind = 0, clsf_ind = 0):
+
+        spawn_key = (self.stage_codes[stage], gen_index, bal_ind, clsf_ind, self.repetition)
+
+        return np.random.SeedSequence(self.entropy, spawn_key = spawn_key)
+
+
+    def generator(self, stage, gen_index, bal_ind = 0, clsf_ind = 0):
+        
+        return np.random.default_rng(self.seed_seq(stage, gen_index, bal_ind, clsf_ind))
+
+
+    def random_state(self, stage, gen_index, bal_ind = 0, clsf_ind = 0):
+        """
+        Integer seed of a stream, for the random_state parameter of sklearn and imblearn estimators.
+        """
+        return int(self.seed_seq(stage, gen_index, bal_ind, clsf_ind).generate_state(1)[0])
+
+
+
+
+class RunningMoments():
+
+    def __init__(self, shape):
+        """
+        Elementwise mean and variance of a sequence of arrays by Welford's online update,
+        NaN entries (e.g. metrics of failed cells) are left out of the moments of their element.
+        """
+        self.count = np.zeros(shape, dtype = np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+
+    def update(self, values):
+
+        values = np.asarray(values, dtype = float)
+        valid = ~np.isnan(values)
+
+        self.count += valid
+        delta = np.where(valid, values - self.mean, 0)
+        self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0)
+        self.m2 += np.where(valid, delta * (values - self.mean), 0)
+
+
+    @property
+    def variance(self):
+        """
+        Sample variance, NaN for elements with less than two values.
+        """
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+    def finite_mean(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+
+
+
+class RaggedArray():
+
+    def __init__(self, grid_shape, capacities, widths, buffer, lengths):
+        """
+        Grid of variable sized 2d (or 1d) arrays stored back to back in one flat buffer.
+
+        Parameters:
+        - grid_shape (tuple): Shape of the grid of segments, e.g. (a, b) for the (data_ind, bal_ind) cells.
+        - capacities (array): Maximal number of rows of each segment, shape grid_shape.
+        - widths (array or None): Number of columns of each segment, shape grid_shape. None for 1d segments.
+        - buffer (array): Flat buffer holding all segments in C-order of the grid.
+        - lengths (array): Number of rows actually filled per segment, shape grid_shape.
+        """
+        self.grid_shape = tuple(grid_shape)
+        self.capacities = np.asarray(capacities, dtype = np.int64).reshape(self.grid_shape)
+        self.widths = widths if widths is None else np.asarray(widths, dtype = np.int64).reshape(self.grid_shape)
+        self.buffer = buffer
+        self.lengths = lengths
+
+        row_sizes = self.capacities if self.widths is None else self.capacities * self.widths
+        self.offsets = np.concatenate([[0], np.cumsum(row_sizes.ravel())])
+
+
+    @classmethod
+    def buffer_size(cls, capacities, widths):
+
+        capacities = np.asarray(capacities, dtype = np.int64)
+
+        return int(np.sum(capacities if widths is None else capacities * np.asarray(widths, dtype = np.int64)))
+
+
+    def segment(self, key):
+        """
+        Returns the filled part of the segment at grid index key as a view into the buffer.
+        """
+        flat_ind = np.ravel_multi_index(key, self.grid_shape)
+        n = self.lengths[key]
+        start = self.offsets[flat_ind]
+
+        if self.widths is None:
+            return self.buffer[start: start + n]
+        
+        d = self.widths[key]
+
+        return self.buffer[start: start + n*d].reshape(n, d)
+
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        return self.segment(key)
+
+
+    def block(self, key):
+        """
+        Returns all segments below grid index key as one view of shape (remaining grid, n) or (remaining grid, n, d).
+        The segments have to be filled to their capacity and share the same number of rows and columns.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        sub_grid = self.grid_shape[len(key):]
+        lengths = self.lengths[key]
+        n = lengths.flat[0]
+
+        if np.any(lengths != self.capacities[key]) or np.any(lengths != n):
+            raise ValueError(f"Segments below {key} are not filled to a common capacity.")
+        
+        start = np.ravel_multi_index(key + (0,)*len(sub_grid), self.grid_shape)
+        stop = start + int(np.prod(sub_grid))
+        block = self.buffer[self.offsets[start]: self.offsets[stop]]
+
+        if self.widths is None:
+            return block.reshape(sub_grid + (n,))
+        
+        d = self.widths[key].flat[0]
+
+        if np.any(self.widths[key] != d):
+            raise ValueError(f"Segments below {key} differ in width.")
+
+        return block.reshape(sub_grid + (n, d))
+
+
+    def reserve(self, key, n):
+        """
+        Marks the first n rows of a segment as filled and returns them as a view to be written into.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if n > self.capacities[key]:
+            raise ValueError(f"{n} rows do not fit into segment {key} with capacity {self.capacities[key]}.")
+
+        self.lengths[key] = n
+
+        return self.segment(key)
+
+
+    def __setitem__(self, key, values):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        values = np.asarray(values)
+
+        if self.widths is not None and values.shape[1:] != (self.widths[key],):
+            raise ValueError(f"Rows of shape {values.shape[1:]} do not match segment {key} of width {self.widths[key]}.")
+
+        self.reserve(key, len(values))[...] = values
+
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes + self.lengths.nbytes
+
+
+    def with_arrays(self, buffer, lengths):
+        """
+        Same layout on other buffer, lengths arrays. Used to send handles to jobs and to attach to them there.
+        """
+        return RaggedArray(self.grid_shape, self.capacities, self.widths, buffer, lengths)
+
+
+
+
+class FoldView():
+
+    def __init__(self, data, folds, n_folds, test, keys):
+        """
+        Training or test sets of the K folds of every dataset as a read-only grid of shape (a*K,), 
+        grid index i*K + f is fold f of dataset i. The rows of a dataset are stored once in fold order,
+        so the test set of a fold is a view, the training set the concatenation of the rows before and after it.
+        Training sets of the first and last fold are views as well. Those of the middle folds are copied by the job that reads them:
+        estimators need one array, a mask or index ranges would only move the copy into the fancy indexing of the fit.
+
+        Parameters:
+        - data (RaggedArray): Rows of the datasets in fold order, grid shape (a,).
+        - folds (RaggedArray): int8 fold index of every row, grid shape (a,).
+        - n_folds (int): Number of folds K.
+        - test (bool): True for the test sets (rows of the fold), False for the training sets (all other rows).
+        - keys (tuple): data_dict keys of data and folds, to send refs of them to jobs.
+        """
+        self.data = data
+        self.folds = folds
+        self.n_folds = n_folds
+        self.test = test
+        self.keys = keys
+
+        self.grid_shape = (len(folds.lengths) * n_folds,)
+
+        fold_sizes = np.array([np.bincount(folds[i], minlength = n_folds) for i in range(len(folds.lengths))], dtype = np.int64)
+        test_lengths = fold_sizes.reshape(self.grid_shape)
+
+        self.lengths = test_lengths if test else np.repeat(folds.lengths, n_folds) - test_lengths
+        self.capacities = self.lengths
+
+
+    def __getitem__(self, key):
+
+        data_ind, fold = divmod(key[0] if isinstance(key, tuple) else key, self.n_folds)
+
+        rows = self.data[data_ind]
+        start, stop = np.searchsorted(self.folds[data_ind], [fold, fold + 1])
+
+        if self.test:
+            return rows[start: stop]
+        
+        if start == 0 or stop == len(rows):
+            return rows[stop:] if start == 0 else rows[:start]
+        
+        # transient copy in the job, freed with the fitted training set
+        return np.concatenate((rows[:start], rows[stop:]))
+
+
+    def with_arrays(self, data, folds):
+
+        view = FoldView.__new__(FoldView)
+        view.__dict__.update({**self.__dict__, 'data': data, 'folds': folds})
+
+        return view
+
+
+
+
+class SharedArrayHandle():
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+    def attach(self):
+        """
+        Maps the shared block into the current process without copying. 
+        Attached blocks are kept for the lifetime of the worker so the returned array stays valid, in the parent until the block is freed.
+        """
+        if self.name not in _attached_blocks:
+            _attached_blocks[self.name] = shared_memory.SharedMemory(name = self.name)
+
+        return np.ndarray(shape = self.shape, dtype = self.dtype, buffer = _attached_blocks[self.name].buf)
+
+
+
+_attached_blocks = {}
+
+
+def detach(name):
+    """
+    Closes the attachment of this process to the shared block name, e.g. made by a job run in the parent, if there is one.
+    """
+    shm = _attached_blocks.pop(name, None)
+
+    if shm is None:
+        return
+    
+    try:
+        shm.close()
+    except BufferError:
+        # arrays on the block are still referenced, the mapping goes away with them
+        pass
+
+
+def resolve_array(ref):
+    """
+    Counterpart of Data.array_ref in a job: attaches to shared arrays and passes ordinary arrays through.
+    """
+    if isinstance(ref, SharedArrayHandle):
+        return ref.attach()
+
+    if isinstance(ref, RaggedArray):
+        return ref.with_arrays(resolve_array(ref.buffer), resolve_array(ref.lengths))
+    
+    if isinstance(ref, FoldView):
+        return ref.with_arrays(resolve_array(ref.data), resolve_array(ref.folds))
+
+    return ref
+
+
+
+
+class SharedArrayStore():
+
+    def __init__(self):
+        """
+        Storage backend for Data that allocates the data_dict arrays in multiprocessing.shared_memory,
+        so that worker processes can attach to them by name instead of receiving pickled copies.
+        """
+        self.blocks = {}
+        self.arrays = {}
+
+
+    def allocate(self, key, shape, fill_value = np.nan, dtype = float):
+
+        if key in self.blocks:
+            self.free(key)
+
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        shm = shared_memory.SharedMemory(create = True, size = max(nbytes, 1))
+        array = np.ndarray(shape = shape, dtype = dtype, buffer = shm.buf)
+        array.fill(fill_value)
+
+        self.blocks[key] = shm
+        self.arrays[key] = (tuple(shape), dtype)
+
+        return array
+
+
+    def handle(self, key):
+
+        shape, dtype = self.arrays[key]
+
+        return SharedArrayHandle(self.blocks[key].name, shape, dtype)
+
+
+    def free(self, key):
+
+        shm = self.blocks.pop(key)
+        del self.arrays[key]
+
+        detach(shm.name)
+
+        try:
+            shm.close()
+        except BufferError:
+            # arrays on the block are still referenced, the mapping goes away with them
+            pass
+        shm.unlink()
+
+
+    def release(self):
+        
+        for key in list(self.blocks):
+            self.free(key)
 
 
 
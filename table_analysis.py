@@ -1,5 +1,19 @@
 import pandas as pd
 import numpy as np
+from Results_Store import ResultsStore
+
+
+
+def load_results(exp_title, columns = None, filters = {}):
+    """
+    Reads an experiment from the results store, the CSV of the Experiments directory is imported on first use.
+    """
+    results_store = ResultsStore('Experiments/results.db', exp_title)
+
+    if not results_store.exists():
+        results_store.import_csv(f'Experiments/{exp_title}.csv')
+
+    return results_store.read(columns = columns, filters = filters)
 
 
 
@@ -7,7 +21,7 @@ import numpy as np
 Distance Experiment
 -------------------------------------------------------------------------------------------------------------------------------------------
 
-dist_results_df = pd.read_csv('Experiments/cls_dist_std_mv_normal.csv', index_col=0)
+dist_results_df = load_results('cls_dist_std_mv_normal')
 
 
 eval_columns = ['accuracy', 'precision', 'recall', 'F1 score', 'ROC AUC Score']
@@ -74,9 +88,8 @@ Alternative Bimodal Multinormal Experiment means at 5, -5
 def geometric_mean(x):
     return np.power(np.prod(x), 1/len(x))
 
-bimodal_results_df = pd.read_csv('Experiments/bimodal_maj_experiment.csv', index_col=0)
-
-bimodal_results_df = bimodal_results_df[['balancer','classifier','accuracy','precision','recall','F1 score','ROC AUC Score']]
+bimodal_results_df = load_results('bimodal_maj_experiment', 
+                                  columns = ['balancer','classifier','accuracy','precision','recall','F1 score','ROC AUC Score'])
 
 #bimodal_results_df = bimodal_results_df.round(4)
 print(bimodal_results_df)
@@ -151,9 +164,8 @@ Alternative Bimodal Multinormal Experiment means at 3, -3
 def geometric_mean(x):
     return np.power(np.prod(x), 1/len(x))
 
-bimodal_results_df = pd.read_csv('Experiments/bimodal_maj_lower_dist.csv', index_col=0)
-
-bimodal_results_df = bimodal_results_df[['balancer','classifier','accuracy','precision','recall','F1 score','ROC AUC Score']]
+bimodal_results_df = load_results('bimodal_maj_lower_dist', 
+                                  columns = ['balancer','classifier','accuracy','precision','recall','F1 score','ROC AUC Score'])
 
 bimodal_results_df = bimodal_results_df.round(4)
 print(bimodal_results_df)
@@ -229,9 +241,8 @@ Presentation Experiment
 def geometric_mean(x):
     return np.power(np.prod(x), 1/len(x))
 
-presentation_results_df = pd.read_csv('Experiments/presentation_results.csv', index_col=0)
-
-presentation_results_df = presentation_results_df[['balancer','classifier','accuracy','precision','recall','F1 score','ROC AUC Score']]
+presentation_results_df = load_results('presentation_results', 
+                                       columns = ['balancer','classifier','accuracy','precision','recall','F1 score','ROC AUC Score'])
 
 presentation_results_df = presentation_results_df.round(4)
 #print(presentation_results_df)